@@ -99,6 +99,90 @@ public class GroundMotionFieldCalculator {
         return groundMotionField;
     }
 
+    /**
+     * Stochastically generate the inter-event residual of a rupture in units
+     * of the inter-event standard deviation, i.e. a standard Gaussian deviate
+     * truncated according to the truncation level and type of the
+     * attenuation relationship.
+     * 
+     * @param attenRel
+     *            : {@link ScalarIntensityMeasureRelationshipAPI} attenuation
+     *            relationship of the rupture
+     * @param rn
+     *            : {@link Random} random number generator
+     * @return : double
+     */
+    public static double getInterEventEpsilon(
+            ScalarIntensityMeasureRelationshipAPI attenRel, Random rn) {
+        checkRandomNumberIsNotNull(rn);
+        return getGaussianDeviate(1.0, (Double) attenRel.getParameter(
+                SigmaTruncLevelParam.NAME).getValue(), (String) attenRel
+                .getParameter(SigmaTruncTypeParam.NAME).getValue(), rn);
+    }
+
+    /**
+     * Computes, for each site, the mean ground motion and the standard
+     * deviations of the residuals, so that the stochastic ground motion
+     * fields can be generated outside (e.g. with random streams that do not
+     * depend on how the sites are split in blocks). If the attenuation
+     * relationship provides inter and intra-event standard deviations, they
+     * are returned as the standard deviations of the residual shared by the
+     * sites and of the site dependent residual; otherwise the first is zero
+     * and the second is the total standard deviation.
+     * 
+     * @param attenRel
+     *            : {@link ScalarIntensityMeasureRelationshipAPI} attenuation
+     *            relationship used for ground motion field calculation
+     * @param rup
+     *            : {@link EqkRupture} earthquake rupture generating the ground
+     *            motion field
+     * @param sites
+     *            : array list of {@link Site} where ground motion values have
+     *            to be computed
+     * @param correlation
+     *            : if true, the site dependent residuals are going to be
+     *            spatially correlated, which requires the intra-event standard
+     *            deviation
+     * @return: for each site, {mean, inter-event standard deviation, site
+     *          dependent standard deviation}
+     */
+    public static double[][] getGroundMotionStatistics(
+            ScalarIntensityMeasureRelationshipAPI attenRel, EqkRupture rup,
+            List<Site> sites, boolean correlation) {
+        validateInput(attenRel, rup, sites);
+        boolean interAndIntra =
+                attenRel.getParameter(StdDevTypeParam.NAME).getConstraint()
+                        .isAllowed(StdDevTypeParam.STD_DEV_TYPE_INTER)
+                        && attenRel.getParameter(StdDevTypeParam.NAME)
+                                .getConstraint()
+                                .isAllowed(StdDevTypeParam.STD_DEV_TYPE_INTRA);
+        if (correlation && !interAndIntra) {
+            throw new IllegalArgumentException(
+                    "The specified attenuation relationship does not provide"
+                            + " intra-event standard deviation");
+        }
+        double[][] statistics = new double[sites.size()][3];
+        attenRel.setEqkRupture(rup);
+        for (int i = 0; i < sites.size(); i++) {
+            attenRel.setSite(sites.get(i));
+            statistics[i][0] = attenRel.getMean();
+            if (interAndIntra) {
+                attenRel.getParameter(StdDevTypeParam.NAME).setValue(
+                        StdDevTypeParam.STD_DEV_TYPE_INTER);
+                statistics[i][1] = attenRel.getStdDev();
+                attenRel.getParameter(StdDevTypeParam.NAME).setValue(
+                        StdDevTypeParam.STD_DEV_TYPE_INTRA);
+                statistics[i][2] = attenRel.getStdDev();
+            } else {
+                attenRel.getParameter(StdDevTypeParam.NAME).setValue(
+                        StdDevTypeParam.STD_DEV_TYPE_TOTAL);
+                statistics[i][1] = 0.0;
+                statistics[i][2] = attenRel.getStdDev();
+            }
+        }
+        return statistics;
+    }
+
     /**
      * Set GMPE standard deviation to inter-event, then stochastically generate
      * a single inter-event residual, and add this value to the already computed
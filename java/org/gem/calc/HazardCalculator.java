@@ -2,6 +2,8 @@ package org.gem.calc;
 
 import java.rmi.RemoteException;
 import java.text.DecimalFormat;
+import java.util.ArrayList;
+import java.util.Arrays;
 import java.util.HashMap;
 import java.util.List;
 import java.util.ListIterator;
@@ -16,9 +18,14 @@ import org.gem.engine.hazard.redis.Cache;
 import org.opensha.commons.data.Site;
 import org.opensha.commons.data.function.ArbitrarilyDiscretizedFunc;
 import org.opensha.commons.data.function.DiscretizedFuncAPI;
+import org.opensha.commons.geo.Location;
+import org.opensha.commons.param.DoubleParameter;
+import org.opensha.commons.param.StringParameter;
 import org.opensha.sha.calc.HazardCurveCalculator;
 import org.opensha.sha.earthquake.EqkRupForecastAPI;
 import org.opensha.sha.earthquake.EqkRupture;
+import org.opensha.sha.earthquake.ProbEqkRupture;
+import org.opensha.sha.earthquake.ProbEqkSource;
 import org.opensha.sha.imr.ScalarIntensityMeasureRelationshipAPI;
 import org.opensha.sha.util.TectonicRegionType;
 
@@ -35,6 +42,57 @@ public class HazardCalculator {
 
     private static Log logger = LogFactory.getLog(HazardCalculator.class);
 
+    /**
+     * Build a list of sites, all sharing the same site parameters, from
+     * arrays of coordinates. This allows the python side to create the whole
+     * site list with a single call across the bridge instead of several calls
+     * per site.
+     * 
+     * @param lons
+     *            : site longitudes
+     * @param lats
+     *            : site latitudes (same length and order as lons)
+     * @param vs30
+     *            : value of the "Vs30" site parameter
+     * @param depthTo2pt5kmPerSec
+     *            : value of the "Depth 2.5 km/sec" site parameter
+     * @param sadighSiteType
+     *            : value of the "Sadigh Site Type" site parameter
+     * @return
+     */
+    public static List<Site> buildSiteList(double[] lons, double[] lats,
+            double vs30, double depthTo2pt5kmPerSec, String sadighSiteType) {
+        if (lons == null || lats == null) {
+            String msg = "Arrays of site coordinates cannot be null";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        if (lons.length != lats.length) {
+            String msg =
+                    "Arrays of site longitudes and latitudes must"
+                            + " have the same length";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        List<Site> siteList = new ArrayList<Site>(lons.length);
+        for (int i = 0; i < lons.length; i++) {
+            Site site = new Site(new Location(lats[i], lons[i]));
+            DoubleParameter vs30Param = new DoubleParameter("Vs30");
+            vs30Param.setValue(vs30);
+            DoubleParameter depthParam =
+                    new DoubleParameter("Depth 2.5 km/sec");
+            depthParam.setValue(depthTo2pt5kmPerSec);
+            StringParameter sadighParam =
+                    new StringParameter("Sadigh Site Type");
+            sadighParam.setValue(sadighSiteType);
+            site.addParameter(vs30Param);
+            site.addParameter(depthParam);
+            site.addParameter(sadighParam);
+            siteList.add(site);
+        }
+        return siteList;
+    }
+
     /**
      * Calculate hazard curves for a set of sites from an earthquake rupture
      * forecast using the classical PSHA approach
@@ -120,6 +178,177 @@ public class HazardCalculator {
         return returnCurves.toArray(new String[returnCurves.size()]);
     }
 
+    /**
+     * Calculate hazard curves for several intensity measure types in a
+     * single pass over the ruptures of an earthquake rupture forecast.
+     * 
+     * Sources and ruptures are enumerated, and sources farther than the
+     * integration distance are discarded, only once per site; every rupture
+     * is then evaluated with the GMPEs of each intensity measure type. The
+     * curves are combined as in {@link HazardCurveCalculator} (Poissonian
+     * and non-Poissonian sources).
+     * 
+     * @param siteList
+     *            : list of sites ({@link Site}) where to compute hazard curves
+     * @param erf
+     *            : earthquake rupture forecast {@link EqkRupForecastAPI}
+     * @param gmpeMaps
+     *            : one map of attenuation relationships per intensity measure
+     *            type, each set up for its own intensity measure type and
+     *            period. The maps must not share attenuation relationship
+     *            instances
+     * @param imlVals
+     *            : intensity measure levels of each intensity measure type
+     *            (same order as gmpeMaps)
+     * @param integrationDistance
+     *            : maximum distance used for integration
+     * @return one site/hazard curve map per intensity measure type
+     */
+    public static
+            List<Map<Site, DiscretizedFuncAPI>>
+            getMultiImtHazardCurves(
+                    List<Site> siteList,
+                    EqkRupForecastAPI erf,
+                    List<Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>> gmpeMaps,
+                    List<List<Double>> imlVals, double integrationDistance) {
+        if (gmpeMaps == null || imlVals == null) {
+            String msg =
+                    "Lists of gmpe maps and intensity measure levels"
+                            + " cannot be null";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        if (gmpeMaps.isEmpty() || gmpeMaps.size() != imlVals.size()) {
+            String msg =
+                    "A gmpe map and a list of intensity measure levels"
+                            + " must be given for each intensity measure type";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        for (int imt = 0; imt < gmpeMaps.size(); imt++) {
+            validateInput(siteList, erf, gmpeMaps.get(imt));
+            if (imlVals.get(imt) == null || imlVals.get(imt).isEmpty()) {
+                String msg =
+                        "Array of intensity measure levels must"
+                                + " contain at least one value";
+                logger.error(msg);
+                throw new IllegalArgumentException(msg);
+            }
+            for (ScalarIntensityMeasureRelationshipAPI imr : gmpeMaps.get(imt)
+                    .values()) {
+                imr.setUserMaxDistance(integrationDistance);
+            }
+        }
+        int numImts = gmpeMaps.size();
+        List<Map<Site, DiscretizedFuncAPI>> results =
+                new ArrayList<Map<Site, DiscretizedFuncAPI>>(numImts);
+        for (int imt = 0; imt < numImts; imt++) {
+            results.add(new HashMap<Site, DiscretizedFuncAPI>());
+        }
+        // probabilities of non exceedance, and conditional probabilities of
+        // exceedance of the current rupture, per intensity measure type
+        DiscretizedFuncAPI[] nonExceedance = new DiscretizedFuncAPI[numImts];
+        DiscretizedFuncAPI[] condProb = new DiscretizedFuncAPI[numImts];
+        double[][] sourceProb = new double[numImts][];
+        for (Site site : siteList) {
+            for (int imt = 0; imt < numImts; imt++) {
+                nonExceedance[imt] = new ArbitrarilyDiscretizedFunc();
+                condProb[imt] = new ArbitrarilyDiscretizedFunc();
+                for (double val : imlVals.get(imt)) {
+                    nonExceedance[imt].set(val, 1.0);
+                    condProb[imt].set(val, 1.0);
+                }
+                sourceProb[imt] = new double[imlVals.get(imt).size()];
+            }
+            for (int i = 0; i < erf.getNumSources(); i++) {
+                ProbEqkSource source = erf.getSource(i);
+                if (source.getMinDistance(site) > integrationDistance) {
+                    continue;
+                }
+                boolean poissonian = source.isSourcePoissonian();
+                for (int imt = 0; imt < numImts; imt++) {
+                    gmpeMaps.get(imt).get(source.getTectonicRegionType())
+                            .setSite(site);
+                    Arrays.fill(sourceProb[imt], 0.0);
+                }
+                for (int j = 0; j < source.getNumRuptures(); j++) {
+                    ProbEqkRupture rupture = source.getRupture(j);
+                    double qkProb = rupture.getProbability();
+                    if (qkProb == 0.0) {
+                        continue;
+                    }
+                    for (int imt = 0; imt < numImts; imt++) {
+                        ScalarIntensityMeasureRelationshipAPI imr =
+                                gmpeMaps.get(imt).get(
+                                        source.getTectonicRegionType());
+                        imr.setEqkRupture(rupture);
+                        imr.getExceedProbabilities(condProb[imt]);
+                        for (int k = 0; k < condProb[imt].getNum(); k++) {
+                            if (poissonian) {
+                                nonExceedance[imt].set(k, nonExceedance[imt]
+                                        .getY(k)
+                                        * Math.pow(1 - qkProb, condProb[imt]
+                                                .getY(k)));
+                            } else {
+                                sourceProb[imt][k] +=
+                                        qkProb * condProb[imt].getY(k);
+                            }
+                        }
+                    }
+                }
+                if (!poissonian) {
+                    for (int imt = 0; imt < numImts; imt++) {
+                        for (int k = 0; k < sourceProb[imt].length; k++) {
+                            nonExceedance[imt].set(k, nonExceedance[imt]
+                                    .getY(k)
+                                    * (1 - sourceProb[imt][k]));
+                        }
+                    }
+                }
+            }
+            for (int imt = 0; imt < numImts; imt++) {
+                DiscretizedFuncAPI hazardCurve = nonExceedance[imt];
+                for (int k = 0; k < hazardCurve.getNum(); k++) {
+                    hazardCurve.set(k, 1 - hazardCurve.getY(k));
+                }
+                results.get(imt).put(site, hazardCurve);
+            }
+        }
+        return results;
+    }
+
+    /**
+     * Get the site/hazard curve pairs of each intensity measure type as lists
+     * of JSON Strings (one array per intensity measure type, sites in the
+     * order of siteList).
+     * 
+     * @param siteList
+     * @param erf
+     * @param gmpeMaps
+     * @param imlVals
+     * @param integrationDistance
+     * @return
+     */
+    public static
+            String[][]
+            getMultiImtHazardCurvesAsJson(
+                    List<Site> siteList,
+                    EqkRupForecastAPI erf,
+                    List<Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>> gmpeMaps,
+                    List<List<Double>> imlVals, double integrationDistance) {
+        List<Map<Site, DiscretizedFuncAPI>> curves =
+                getMultiImtHazardCurves(siteList, erf, gmpeMaps, imlVals,
+                        integrationDistance);
+        String[][] result = new String[curves.size()][];
+        for (int imt = 0; imt < curves.size(); imt++) {
+            List<String> imtCurves =
+                    JsonSerializer.hazardCurvesToJson(curves.get(imt),
+                            siteList);
+            result[imt] = imtCurves.toArray(new String[imtCurves.size()]);
+        }
+        return result;
+    }
+
     /**
      * Calculate ground motion fields (correlated or uncorrelated) from a
      * stochastic event set generated through random sampling of an earthquake
@@ -209,6 +438,115 @@ public class HazardCalculator {
         gmfToMemcache(cache, key, gmf_id, rupture_ids, site_ids, gmfs);
     }
 
+    /**
+     * Samples a stochastic event set from a Poissonian ERF and saves it to
+     * the cache, so that the ground motion fields of its ruptures can then be
+     * computed for several blocks of sites (see getBlockGroundMotionStatistics).
+     * The event set is saved as a json array with an element [source index,
+     * rupture index, inter-event epsilon] per occurrence of a rupture. The
+     * inter-event residual (in units of the inter-event standard deviation)
+     * is sampled here, once per occurrence, so that all the blocks of sites
+     * share it.
+     * 
+     * @param cache
+     *            : cache where the event set is saved
+     * @param key
+     *            : key of the event set
+     * @param erf
+     *            : earthquake rupture forecast {@link EqkRupForecastAPI}
+     * @param gmpeMap
+     *            : map associating tectonic region types with attenuation
+     *            relationships, giving the truncation of the residuals
+     * @param rn
+     *            : random ({@link Random}) number generator
+     */
+    public static
+            void
+            sampleAndSaveStochasticEventSet(
+                    Cache cache,
+                    String key,
+                    EqkRupForecastAPI erf,
+                    Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpeMap,
+                    Random rn) {
+        List<int[]> indexes =
+                StochasticEventSetGenerator
+                        .getStochasticEventSetIndexesFromPoissonianERF(erf, rn);
+        double[][] stochasticEventSet = new double[indexes.size()][];
+        for (int i = 0; i < indexes.size(); i++) {
+            int[] index = indexes.get(i);
+            TectonicRegionType trt =
+                    erf.getSource(index[0]).getTectonicRegionType();
+            stochasticEventSet[i] =
+                    new double[] {
+                            index[0],
+                            index[1],
+                            GroundMotionFieldCalculator.getInterEventEpsilon(
+                                    gmpeMap.get(trt), rn) };
+        }
+        logger.debug("Saving stochastic event set of "
+                + stochasticEventSet.length + " ruptures to " + key);
+        cache.set(key, new Gson().toJson(stochasticEventSet));
+    }
+
+    /**
+     * Computes the mean ground motion and the standard deviations of the
+     * residuals of the ruptures of a stochastic event set saved by
+     * sampleAndSaveStochasticEventSet, for a block of sites (see
+     * GroundMotionFieldCalculator.getGroundMotionStatistics). The residuals
+     * are then sampled on the python side. The statistics are returned as a
+     * single array, rupture by rupture (in the order of the event set), site
+     * by site (in the order of siteList), so that they can be crossed to
+     * python in one call.
+     * 
+     * @param cache
+     *            : cache where the event set is read
+     * @param stochasticEventSetKey
+     *            : key of the stochastic event set
+     * @param siteList
+     *            : sites of the block
+     * @param erf
+     *            : earthquake rupture forecast the event set was sampled from
+     * @param gmpeMap
+     *            : map associating tectonic region types with attenuation
+     *            relationships
+     * @param correlation
+     *            : if true, the intra-event residuals are going to be
+     *            correlated
+     * @return {mean, inter-event std, site dependent std}, ruptures x sites
+     */
+    public static
+            double[]
+            getBlockGroundMotionStatistics(
+                    Cache cache,
+                    String stochasticEventSetKey,
+                    List<Site> siteList,
+                    EqkRupForecastAPI erf,
+                    Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpeMap,
+                    boolean correlation) {
+        validateInput(siteList, erf, gmpeMap);
+        double[][] stochasticEventSet =
+                new Gson().fromJson((String) cache.get(stochasticEventSetKey),
+                        double[][].class);
+        int numberOfSites = siteList.size();
+        double[] statistics =
+                new double[stochasticEventSet.length * numberOfSites * 3];
+        for (int i = 0; i < stochasticEventSet.length; i++) {
+            double[] occurrence = stochasticEventSet[i];
+            EqkRupture rup =
+                    StochasticEventSetGenerator.getRupture(erf,
+                            (int) occurrence[0], (int) occurrence[1]);
+            double[][] ruptureStatistics =
+                    GroundMotionFieldCalculator.getGroundMotionStatistics(
+                            gmpeMap.get(rup.getTectRegType()), rup, siteList,
+                            correlation);
+            for (int j = 0; j < numberOfSites; j++) {
+                System.arraycopy(ruptureStatistics[j], 0, statistics,
+                        (i * numberOfSites + j) * 3, 3);
+            }
+        }
+        return statistics;
+    }
+
     public static
             Boolean
             validateInput(
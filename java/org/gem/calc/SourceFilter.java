@@ -0,0 +1,227 @@
+package org.gem.calc;
+
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Comparator;
+import java.util.List;
+
+import org.apache.commons.logging.Log;
+import org.apache.commons.logging.LogFactory;
+import org.opensha.commons.geo.Location;
+import org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData.GEMAreaSourceData;
+import org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData.GEMFaultSourceData;
+import org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData.GEMPointSourceData;
+import org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData.GEMSourceData;
+import org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData.GEMSubductionFaultSourceData;
+
+/**
+ * Spatial index over the geometries of a source model, used to discard the
+ * sources that are farther than the integration distance from a block of
+ * sites before building the earthquake rupture forecast.
+ *
+ * Each source is indexed by the bounding box of its geometry (point
+ * location, area border, fault trace extended down dip, subduction top and
+ * bottom traces). Boxes are sorted by minimum longitude, so a query only
+ * scans the sources whose box starts west of the search window.
+ *
+ * The search window is the block bounding box enlarged by the integration
+ * distance. Degrees are converted to km in a conservative way, so a source
+ * is never discarded if it may contribute to the hazard of the block.
+ * Sources of unknown type are always kept. Regions crossing the date line
+ * are not supported.
+ */
+public class SourceFilter {
+
+    private static Log logger = LogFactory.getLog(SourceFilter.class);
+
+    /**
+     * Slightly smaller than the actual length of a degree of latitude, to
+     * keep the search window on the safe side
+     */
+    private static final double KM_PER_DEGREE = 111.0;
+
+    private static final int MIN_LAT = 0;
+    private static final int MIN_LON = 1;
+    private static final int MAX_LAT = 2;
+    private static final int MAX_LON = 3;
+
+    private final List<GEMSourceData> sources;
+    private final double[][] boxes;
+    private final Integer[] sortedByMinLon;
+    private final double[] sortedMinLons;
+
+    /**
+     * @param sources
+     *            : list of sources ({@link GEMSourceData}) to index
+     */
+    public SourceFilter(List<GEMSourceData> sources) {
+        if (sources == null) {
+            String msg = "List of sources cannot be null";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        this.sources = sources;
+        boxes = new double[sources.size()][];
+        sortedByMinLon = new Integer[sources.size()];
+        for (int i = 0; i < sources.size(); i++) {
+            boxes[i] = boundingBox(sources.get(i));
+            sortedByMinLon[i] = i;
+        }
+        Arrays.sort(sortedByMinLon, new Comparator<Integer>() {
+            @Override
+            public int compare(Integer a, Integer b) {
+                return Double.compare(minLon(a), minLon(b));
+            }
+        });
+        sortedMinLons = new double[sortedByMinLon.length];
+        for (int i = 0; i < sortedByMinLon.length; i++) {
+            sortedMinLons[i] = minLon(sortedByMinLon[i]);
+        }
+    }
+
+    /**
+     * Return the sources that are not farther than maxDistance from the
+     * given bounding box, in the same order of the indexed list.
+     *
+     * @param minLon
+     * @param minLat
+     * @param maxLon
+     * @param maxLat
+     * @param maxDistance
+     *            : integration distance (km)
+     * @return
+     */
+    public List<GEMSourceData> filter(double minLon, double minLat,
+            double maxLon, double maxLat, double maxDistance) {
+        double deltaLat = maxDistance / KM_PER_DEGREE;
+        double windowMinLat = minLat - deltaLat;
+        double windowMaxLat = maxLat + deltaLat;
+        double maxAbsLat =
+                Math.min(Math.max(Math.abs(windowMinLat), Math
+                        .abs(windowMaxLat)), 89.0);
+        double deltaLon = deltaLat / Math.cos(Math.toRadians(maxAbsLat));
+        double windowMinLon = minLon - deltaLon;
+        double windowMaxLon = maxLon + deltaLon;
+
+        // sources starting east of the window can't intersect it
+        int end = upperBound(windowMaxLon);
+        boolean[] keep = new boolean[sources.size()];
+        for (int i = 0; i < end; i++) {
+            int index = sortedByMinLon[i];
+            double[] box = boxes[index];
+            keep[index] =
+                    box == null
+                            || (box[MAX_LON] >= windowMinLon
+                                    && box[MIN_LAT] <= windowMaxLat && box[MAX_LAT] >= windowMinLat);
+        }
+        List<GEMSourceData> result = new ArrayList<GEMSourceData>();
+        for (int i = 0; i < sources.size(); i++) {
+            if (keep[i]) {
+                result.add(sources.get(i));
+            }
+        }
+        logger.debug("Kept " + result.size() + " of " + sources.size()
+                + " sources within " + maxDistance + " km");
+        return result;
+    }
+
+    /**
+     * Shortcut to index a list of sources and filter it against a single
+     * bounding box
+     */
+    public static List<GEMSourceData> filterSources(
+            List<GEMSourceData> sources, double minLon, double minLat,
+            double maxLon, double maxLat, double maxDistance) {
+        return new SourceFilter(sources).filter(minLon, minLat, maxLon,
+                maxLat, maxDistance);
+    }
+
+    private double minLon(int index) {
+        // unknown geometries sort first, so they are always scanned
+        return boxes[index] == null ? Double.NEGATIVE_INFINITY
+                : boxes[index][MIN_LON];
+    }
+
+    /**
+     * Number of indexed boxes with minimum longitude not greater than the
+     * given value
+     */
+    private int upperBound(double lon) {
+        int low = 0;
+        int high = sortedMinLons.length;
+        while (low < high) {
+            int mid = (low + high) >>> 1;
+            if (sortedMinLons[mid] <= lon) {
+                low = mid + 1;
+            } else {
+                high = mid;
+            }
+        }
+        return low;
+    }
+
+    /**
+     * Bounding box (minLat, minLon, maxLat, maxLon) of the surface
+     * projection of the source geometry, null if the source type is unknown
+     */
+    private static double[] boundingBox(GEMSourceData src) {
+        List<Location> locs = new ArrayList<Location>();
+        double extension = 0.0;
+        if (src instanceof GEMPointSourceData) {
+            locs.add(((GEMPointSourceData) src).getHypoMagFreqDistAtLoc()
+                    .getLocation());
+        } else if (src instanceof GEMAreaSourceData) {
+            for (Location loc : ((GEMAreaSourceData) src).getRegion()
+                    .getBorder()) {
+                locs.add(loc);
+            }
+        } else if (src instanceof GEMFaultSourceData) {
+            GEMFaultSourceData fault = (GEMFaultSourceData) src;
+            for (Location loc : fault.getTrace()) {
+                locs.add(loc);
+            }
+            // the surface projection of a dipping fault extends from the
+            // trace in the dip direction
+            double dip = Math.toRadians(Math.abs(fault.getDip()));
+            if (dip > 0.0 && dip < Math.PI / 2) {
+                extension = fault.getSeismDepthLow() / Math.tan(dip);
+            }
+        } else if (src instanceof GEMSubductionFaultSourceData) {
+            GEMSubductionFaultSourceData subduction =
+                    (GEMSubductionFaultSourceData) src;
+            for (Location loc : subduction.getTopTrace()) {
+                locs.add(loc);
+            }
+            for (Location loc : subduction.getBottomTrace()) {
+                locs.add(loc);
+            }
+        }
+        if (locs.isEmpty()) {
+            return null;
+        }
+        double[] box =
+                new double[] { Double.POSITIVE_INFINITY,
+                        Double.POSITIVE_INFINITY, Double.NEGATIVE_INFINITY,
+                        Double.NEGATIVE_INFINITY };
+        for (Location loc : locs) {
+            box[MIN_LAT] = Math.min(box[MIN_LAT], loc.getLatitude());
+            box[MIN_LON] = Math.min(box[MIN_LON], loc.getLongitude());
+            box[MAX_LAT] = Math.max(box[MAX_LAT], loc.getLatitude());
+            box[MAX_LON] = Math.max(box[MAX_LON], loc.getLongitude());
+        }
+        if (extension > 0.0) {
+            double deltaLat = extension / KM_PER_DEGREE;
+            double maxAbsLat =
+                    Math.min(Math.max(Math.abs(box[MIN_LAT]), Math
+                            .abs(box[MAX_LAT]))
+                            + deltaLat, 89.0);
+            double deltaLon =
+                    deltaLat / Math.cos(Math.toRadians(maxAbsLat));
+            box[MIN_LAT] -= deltaLat;
+            box[MAX_LAT] += deltaLat;
+            box[MIN_LON] -= deltaLon;
+            box[MAX_LON] += deltaLon;
+        }
+        return box;
+    }
+}
@@ -54,28 +54,7 @@ public class StochasticEventSetGenerator {
                                 rup.getRuptureSurface(),
                                 rup.getHypocenterLocation());
                 eqk.setTectRegType(tectonicRegionType);
-                // sample Poisson distribution using inverse transfom method
-                // p is the Poisson probability
-                // F is the cumulative distribution function
-                // get number of rupture realizations (nRup) given
-                // number of expected ruptures (numExpectedRup). nRup copies of
-                // the same rupture are then added to the stochastic event set.
-                int nRup = 0;
-                boolean flag = true;
-                double u = rn.nextDouble();
-                int i = 0;
-                double p = Math.exp(-numExpectedRup);
-                double F = p;
-                while (flag == true) {
-                    if (u <= F) {
-                        nRup = i;
-                        flag = false;
-                    } else {
-                        p = numExpectedRup * p / (i + 1);
-                        i = i + 1;
-                        F = F + p;
-                    }
-                }
+                int nRup = sampleNumberOfOccurrences(numExpectedRup, rn);
                 for (int j = 0; j < nRup; j++)
                     stochasticEventSet.add(eqk);
             }
@@ -83,6 +62,64 @@ public class StochasticEventSetGenerator {
         return stochasticEventSet;
     }
 
+    /**
+     * Generate a stochastic event set from a Poissonian ERF, as the indexes
+     * of the sampled ruptures. The ruptures are sampled as in
+     * getStochasticEventSetFromPoissonianERF (the same random numbers are
+     * drawn), but each occurrence is given as an array of {source index,
+     * rupture index}. The event set can thus be stored once and the
+     * ruptures rebuilt from the same ERF, e.g. to compute the ground motion
+     * fields of several blocks of sites.
+     * 
+     * @param erf
+     *            {@link EqkRupForecast} earthquake rupture forecast
+     * @param rn
+     *            {@link Random} random number generator
+     * @return: {@link ArrayList} of {source index, rupture index}, one per
+     *          occurrence.
+     */
+    public static ArrayList<int[]> getStochasticEventSetIndexesFromPoissonianERF(
+            EqkRupForecastAPI erf, Random rn) {
+
+        validateInput(erf, rn);
+
+        ArrayList<int[]> stochasticEventSet = new ArrayList<int[]>();
+        for (int sourceIdx = 0; sourceIdx < erf.getNumSources(); sourceIdx++) {
+            ProbEqkSource src = erf.getSource(sourceIdx);
+            for (int ruptureIdx = 0; ruptureIdx < src.getNumRuptures(); ruptureIdx++) {
+                ProbEqkRupture rup = src.getRupture(ruptureIdx);
+                double numExpectedRup = -Math.log(1 - rup.getProbability());
+                int nRup = sampleNumberOfOccurrences(numExpectedRup, rn);
+                for (int j = 0; j < nRup; j++)
+                    stochasticEventSet.add(new int[] { sourceIdx, ruptureIdx });
+            }
+        }
+        return stochasticEventSet;
+    }
+
+    /**
+     * Return the rupture with the given indexes in the ERF, as added to the
+     * stochastic event sets.
+     * 
+     * @param erf
+     *            {@link EqkRupForecast} earthquake rupture forecast
+     * @param sourceIdx
+     *            index of the source in the ERF
+     * @param ruptureIdx
+     *            index of the rupture in the source
+     * @return: {@link EqkRupture}
+     */
+    public static EqkRupture getRupture(EqkRupForecastAPI erf, int sourceIdx,
+            int ruptureIdx) {
+        ProbEqkSource src = erf.getSource(sourceIdx);
+        ProbEqkRupture rup = src.getRupture(ruptureIdx);
+        EqkRupture eqk =
+                new EqkRupture(rup.getMag(), rup.getAveRake(),
+                        rup.getRuptureSurface(), rup.getHypocenterLocation());
+        eqk.setTectRegType(src.getTectonicRegionType());
+        return eqk;
+    }
+
     /**
      * Generate multiple stochastic event sets by calling the
      * getStochasticEvenSetFromPoissonianERF method.
@@ -108,6 +145,34 @@ public class StochasticEventSetGenerator {
         return multiStocEventSet;
     }
 
+    /**
+     * Sample the Poisson distribution using the inverse transform method: p
+     * is the Poisson probability, F the cumulative distribution function.
+     * Return the number of rupture realizations (nRup) given the number of
+     * expected ruptures (numExpectedRup). nRup copies of the same rupture
+     * are then added to the stochastic event set.
+     */
+    private static int sampleNumberOfOccurrences(double numExpectedRup,
+            Random rn) {
+        int nRup = 0;
+        boolean flag = true;
+        double u = rn.nextDouble();
+        int i = 0;
+        double p = Math.exp(-numExpectedRup);
+        double F = p;
+        while (flag == true) {
+            if (u <= F) {
+                nRup = i;
+                flag = false;
+            } else {
+                p = numExpectedRup * p / (i + 1);
+                i = i + 1;
+                F = F + p;
+            }
+        }
+        return nRup;
+    }
+
     /**
      * Check if the ERF contains only Poissonian sources
      * 
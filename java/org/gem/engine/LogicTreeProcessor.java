@@ -1,11 +1,17 @@
 package org.gem.engine;
 
 import java.io.IOException;
+import java.io.UnsupportedEncodingException;
 import java.lang.reflect.Type;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
 import java.util.ArrayList;
+import java.util.Collections;
+import java.util.Comparator;
 import java.util.HashMap;
 import java.util.Iterator;
 import java.util.List;
+import java.util.Map;
 import java.util.Properties;
 import java.util.Random;
 
@@ -215,24 +221,195 @@ public class LogicTreeProcessor {
      * @param key
      *            - key of the data to be stored in the KVS
      * @param seed
+     * @return a fingerprint of the sampled path: two samples with the same
+     *         fingerprint produce the same source model
      * @throws IOException
      */
-    public void sampleAndSaveERFTree(Cache cache, String key, long seed)
+    public String sampleAndSaveERFTree(Cache cache, String key, long seed)
             throws IOException {
         logger.warn("Random seed for ERFLT is " + Long.toString(seed));
+        List<Integer> path = new ArrayList<Integer>();
         ArrayList<GEMSourceData> arrayListSources =
                 new ArrayList(sampleSourceModelLogicTree(
-                        createErfLogicTreeData(), seed));
+                        createErfLogicTreeData(), seed, path));
         JsonSerializer.serializeSourceList(cache, key, arrayListSources);
+        return pathFingerprint(path.toString());
     }
 
-    public void sampleAndSaveGMPETree(Cache cache, String key, long seed)
+    /**
+     * @return a fingerprint of the sampled path: two samples with the same
+     *         fingerprint produce the same GMPE map
+     */
+    public String sampleAndSaveGMPETree(Cache cache, String key, long seed)
             throws IOException {
         logger.warn("Random seed for GMPELT is " + Long.toString(seed));
+        Map<TectonicRegionType, Integer> path =
+                new HashMap<TectonicRegionType, Integer>();
         HashMap<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpe_map =
                 sampleGemLogicTreeGMPE(createGmpeLogicTreeData()
-                        .getGmpeLogicTreeHashMap(), seed);
+                        .getGmpeLogicTreeHashMap(), seed, path);
+
+        saveGmpeMap(cache, key, gmpe_map);
+        return gmpePathFingerprint(path);
+    }
+
+    /**
+     * @return the fingerprint of the GMPE branches sampled for each tectonic
+     *         region type, listed by tectonic region name so that it doesn't
+     *         depend on the iteration order of the map
+     */
+    static String gmpePathFingerprint(Map<TectonicRegionType, Integer> path) {
+        StringBuilder canonicalPath = new StringBuilder();
+        for (TectonicRegionType trt : sortedTectonicRegions(path)) {
+            canonicalPath.append(trt.name()).append('=').append(path.get(trt))
+                    .append(';');
+        }
+        return pathFingerprint(canonicalPath.toString());
+    }
+
+    /**
+     * SHA-1 digest (hex) of the description of a sampled path, to keep
+     * fingerprints short for source models with many sources
+     */
+    private static String pathFingerprint(String path) {
+        try {
+            byte[] digest =
+                    MessageDigest.getInstance("SHA-1").digest(
+                            path.getBytes("UTF-8"));
+            StringBuilder hex = new StringBuilder();
+            for (byte b : digest) {
+                hex.append(String.format("%02x", b));
+            }
+            return hex.toString();
+        } catch (NoSuchAlgorithmException e) {
+            throw new RuntimeException(e);
+        } catch (UnsupportedEncodingException e) {
+            throw new RuntimeException(e);
+        }
+    }
+
+    /**
+     * Enumerates the end branches of the source model logic tree.
+     * 
+     * @return a JSON list of {"path": [branch numbers], "weight": weight}
+     *         objects, one for each end branch
+     * @throws IOException
+     */
+    public String enumerateERFTree() throws IOException {
+        return new Gson().toJson(enumerateEndBranches(createErfLogicTreeData()));
+    }
+
+    /**
+     * Builds the source model of an end branch of the source model logic
+     * tree and writes it to the KVS, serialized as JSON.
+     * 
+     * @param cache
+     *            - KVS
+     * @param key
+     *            - key of the data to be stored in the KVS
+     * @param path
+     *            - branch number for each branching level, as returned by
+     *            enumerateERFTree
+     * @throws IOException
+     */
+    public void saveERFEndBranch(Cache cache, String key, int[] path)
+            throws IOException {
+        ArrayList<GEMSourceData> arrayListSources =
+                new ArrayList<GEMSourceData>(getSourceModelForEndBranch(
+                        createErfLogicTreeData(), path));
+        JsonSerializer.serializeSourceList(cache, key, arrayListSources);
+    }
 
+    /**
+     * Enumerates the end branches of the GMPE logic tree, i.e. all the
+     * combinations of the GMPEs defined for each tectonic region type.
+     * 
+     * @return a JSON list of {"path": [branch numbers], "weight": weight}
+     *         objects, one for each end branch. Branch numbers are given for
+     *         each tectonic region type, in the order of
+     *         getGmpeTectonicRegions
+     * @throws IOException
+     */
+    public String enumerateGMPETree() throws IOException {
+        HashMap<TectonicRegionType, LogicTree<ScalarIntensityMeasureRelationshipAPI>> ltMap =
+                createGmpeLogicTreeData().getGmpeLogicTreeHashMap();
+        List<TectonicRegionType> regions = sortedTectonicRegions(ltMap);
+        List<EndBranch> endBranches = new ArrayList<EndBranch>();
+        endBranches.add(new EndBranch(new int[0], 1.0));
+        for (TectonicRegionType trt : regions) {
+            List<EndBranch> combined = new ArrayList<EndBranch>();
+            for (EndBranch partial : endBranches) {
+                for (LogicTreeBranch branch : ltMap.get(trt)
+                        .getBranchingLevel(0).getBranchList()) {
+                    int[] path = new int[partial.getPath().length + 1];
+                    System.arraycopy(partial.getPath(), 0, path, 0,
+                            partial.getPath().length);
+                    path[path.length - 1] = branch.getRelativeID();
+                    combined.add(new EndBranch(path, partial.getWeight()
+                            * branch.getWeight()));
+                }
+            }
+            endBranches = combined;
+        }
+        return new Gson().toJson(endBranches);
+    }
+
+    /**
+     * Builds the GMPE map of an end branch of the GMPE logic tree and writes
+     * it to the KVS, serialized as JSON.
+     * 
+     * @param cache
+     *            - KVS
+     * @param key
+     *            - key of the data to be stored in the KVS
+     * @param path
+     *            - branch number for each tectonic region type, as returned
+     *            by enumerateGMPETree
+     * @throws IOException
+     */
+    public void saveGMPEEndBranch(Cache cache, String key, int[] path)
+            throws IOException {
+        HashMap<TectonicRegionType, LogicTree<ScalarIntensityMeasureRelationshipAPI>> ltMap =
+                createGmpeLogicTreeData().getGmpeLogicTreeHashMap();
+        List<TectonicRegionType> regions = sortedTectonicRegions(ltMap);
+        if (path == null || path.length != regions.size()) {
+            String msg =
+                    "The end branch must define a GMPE for each of the "
+                            + regions.size() + " tectonic region types";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        HashMap<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpe_map =
+                new HashMap<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>();
+        for (int i = 0; i < path.length; i++) {
+            TectonicRegionType trt = regions.get(i);
+            gmpe_map.put(trt, ltMap.get(trt).getEBMap().get(
+                    Integer.toString(path[i])));
+        }
+        saveGmpeMap(cache, key, gmpe_map);
+    }
+
+    /**
+     * Tectonic region types of the GMPE logic tree, sorted by name so that
+     * GMPE end branches are enumerated in a repeatable order
+     */
+    private static List<TectonicRegionType> sortedTectonicRegions(
+            Map<TectonicRegionType, ?> ltMap) {
+        List<TectonicRegionType> regions =
+                new ArrayList<TectonicRegionType>(ltMap.keySet());
+        Collections.sort(regions, new Comparator<TectonicRegionType>() {
+            @Override
+            public int compare(TectonicRegionType a, TectonicRegionType b) {
+                return a.name().compareTo(b.name());
+            }
+        });
+        return regions;
+    }
+
+    private static void saveGmpeMap(
+            Cache cache,
+            String key,
+            HashMap<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> gmpe_map) {
         GsonBuilder gson = new GsonBuilder();
         gson.registerTypeAdapter(ScalarIntensityMeasureRelationshipAPI.class,
                 new ScalarIMRJsonAdapter());
@@ -259,39 +436,28 @@ public class LogicTreeProcessor {
      */
     public List<GEMSourceData> sampleSourceModelLogicTree(
             LogicTree<ArrayList<GEMSourceData>> lt, long seed) {
+        return sampleSourceModelLogicTree(lt, seed, null);
+    }
+
+    /**
+     * Same as sampleSourceModelLogicTree(lt, seed), also appending the
+     * sampled branch numbers (first branching level, then the remaining
+     * levels for each source) to path, if not null.
+     */
+    public List<GEMSourceData> sampleSourceModelLogicTree(
+            LogicTree<ArrayList<GEMSourceData>> lt, long seed,
+            List<Integer> path) {
 
-        List<GEMSourceData> srcList = null;
         Random rn = new Random(seed);
 
         // sample first branching level to get the starting source model
         int branchNumber = lt.sampleBranchingLevel(0, rn);
+        if (path != null) {
+            path.add(branchNumber);
+        }
         LogicTreeBranch branch =
                 lt.getBranchingLevel(0).getBranch(branchNumber - 1);
-        if (branch.getNameInputFile() != null) {
-            String sourceName = null;
-            if (hasPath) { // job from file
-                sourceName = configFilesPath() + branch.getNameInputFile();
-            } else { // job from kvs
-                sourceName =
-                        FilenameUtils.concat(config.getString("BASE_PATH"),
-                                branch.getNameInputFile());
-            }
-
-            SourceModelReader sourceModelReader =
-                    new SourceModelReader(sourceName, config
-                            .getDouble(ConfigItems.WIDTH_OF_MFD_BIN.name()));
-
-            // load sources
-            srcList = sourceModelReader.read();
-
-        } else {
-            String msg =
-                    "The first branching level of the ERF logic tree does"
-                            + " not contain a source model!!\n"
-                            + "Please correct your input!\n Execution stopped!";
-            logger.info(msg);
-            throw new IllegalArgumentException(msg);
-        }
+        List<GEMSourceData> srcList = readSourceModel(branch);
 
         // loop over sources
         // for each source, loop over remaining branching levels and apply
@@ -302,60 +468,173 @@ public class LogicTreeProcessor {
             for (int i = 1; i < numBranchingLevels; i++) {
                 // sample the current branching level
                 branchNumber = lt.sampleBranchingLevel(i, rn);
+                if (path != null) {
+                    path.add(branchNumber);
+                }
                 // get the sampled branch
                 branch = lt.getBranchingLevel(i).getBranch(branchNumber - 1);
-                if (branch.getRule() != null) {
-                    // at the moment we apply rules to all source
-                    // typologies. In
-                    // the future we may want
-                    // to apply some filter (i.e. apply rule to this source
-                    // type
-                    // only...)
-                    // if area source
-                    if (src instanceof GEMAreaSourceData) {
-                        // replace the old source with the new source
-                        // accordingly to the rule
-                        srcList.set(sourceIndex, applyRuleToAreaSource(
-                                (GEMAreaSourceData) src, branch.getRule()));
-                    }
-                    // if point source
-                    if (src instanceof GEMPointSourceData) {
-                        // replace the old source with the new source
-                        // accordingly to the rule
-                        srcList.set(sourceIndex, applyRuleToPointSource(
-                                (GEMPointSourceData) src, branch.getRule()));
-                    }
-                    // if fault source
-                    if (src instanceof GEMFaultSourceData) {
-                        // replace the old source with the new source
-                        // accordingly to the rule
-                        srcList.set(sourceIndex, applyRuleToFaultSource(
-                                (GEMFaultSourceData) src, branch.getRule()));
-                    }
-                    // if subduction source
-                    if (src instanceof GEMSubductionFaultSourceData) {
-                        // replace the old source with the new source
-                        // accordingly to the rule
-                        srcList.set(sourceIndex,
-                                applyRuleToSubductionFaultSource(
-                                        (GEMSubductionFaultSourceData) src,
-                                        branch.getRule()));
-                    }
-                } else {
-                    // rule is not defined:
-                    String msg =
-                            "No rule is defined at branching level: " + i
-                                    + "\n" + "Please correct your input!\n"
-                                    + "Execution stopped!";
-                    logger.info(msg);
-                    throw new IllegalArgumentException(msg);
-                } // end if no rule is defined
+                srcList.set(sourceIndex, applyBranchToSource(src, branch, i));
             } // end loop over branching levels
             sourceIndex = sourceIndex + 1;
         } // end loop over sources
         return srcList;
     }
 
+    /**
+     * Build the source model corresponding to an end branch of the source
+     * model logic tree. The end branch is identified by the branch number
+     * (relative ID) chosen at each branching level. Contrary to sampling, the
+     * branch chosen at a given level applies to all the sources.
+     * 
+     * @param lt
+     *            : source model logic tree
+     * @param path
+     *            : branch number for each branching level
+     * @return
+     */
+    public List<GEMSourceData> getSourceModelForEndBranch(
+            LogicTree<ArrayList<GEMSourceData>> lt, int[] path) {
+        int numBranchingLevels = lt.getBranchingLevelsList().size();
+        if (path == null || path.length != numBranchingLevels) {
+            String msg =
+                    "The end branch must define a branch for each of the "
+                            + numBranchingLevels + " branching levels";
+            logger.error(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        List<GEMSourceData> srcList =
+                readSourceModel(lt.getBranchingLevel(0).getBranch(path[0] - 1));
+        for (int sourceIndex = 0; sourceIndex < srcList.size(); sourceIndex++) {
+            for (int i = 1; i < numBranchingLevels; i++) {
+                LogicTreeBranch branch =
+                        lt.getBranchingLevel(i).getBranch(path[i] - 1);
+                srcList.set(sourceIndex, applyBranchToSource(srcList
+                        .get(sourceIndex), branch, i));
+            }
+        }
+        return srcList;
+    }
+
+    /**
+     * Enumerate all the end branches of a logic tree, as paths of branch
+     * numbers (one for each branching level) with the corresponding weight
+     * (product of the weights of the branches in the path).
+     * 
+     * @param lt
+     * @return
+     */
+    public static List<EndBranch> enumerateEndBranches(LogicTree<?> lt) {
+        List<EndBranch> endBranches = new ArrayList<EndBranch>();
+        enumerateEndBranches(lt, 0, new int[lt.getBranchingLevelsList()
+                .size()], 1.0, endBranches);
+        return endBranches;
+    }
+
+    private static void enumerateEndBranches(LogicTree<?> lt, int level,
+            int[] path, double weight, List<EndBranch> endBranches) {
+        if (level == path.length) {
+            endBranches.add(new EndBranch(path.clone(), weight));
+            return;
+        }
+        for (LogicTreeBranch branch : lt.getBranchingLevel(level)
+                .getBranchList()) {
+            path[level] = branch.getRelativeID();
+            enumerateEndBranches(lt, level + 1, path, weight
+                    * branch.getWeight(), endBranches);
+        }
+    }
+
+    /**
+     * An end branch of a logic tree: the branch number chosen at each
+     * branching level (or for each tectonic region type, in the case of the
+     * GMPE logic tree) and its weight.
+     */
+    public static class EndBranch {
+        private final int[] path;
+        private final double weight;
+
+        public EndBranch(int[] path, double weight) {
+            this.path = path;
+            this.weight = weight;
+        }
+
+        public int[] getPath() {
+            return path;
+        }
+
+        public double getWeight() {
+            return weight;
+        }
+    }
+
+    /**
+     * Read the source model referenced by a branch of the first branching
+     * level of the source model logic tree
+     */
+    private List<GEMSourceData> readSourceModel(LogicTreeBranch branch) {
+        if (branch.getNameInputFile() == null) {
+            String msg =
+                    "The first branching level of the ERF logic tree does"
+                            + " not contain a source model!!\n"
+                            + "Please correct your input!\n Execution stopped!";
+            logger.info(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        String sourceName = null;
+        if (hasPath) { // job from file
+            sourceName = configFilesPath() + branch.getNameInputFile();
+        } else { // job from kvs
+            sourceName =
+                    FilenameUtils.concat(config.getString("BASE_PATH"), branch
+                            .getNameInputFile());
+        }
+
+        SourceModelReader sourceModelReader =
+                new SourceModelReader(sourceName, config
+                        .getDouble(ConfigItems.WIDTH_OF_MFD_BIN.name()));
+
+        // load sources
+        return sourceModelReader.read();
+    }
+
+    /**
+     * Apply the uncertainty rule of a branch (of a branching level other than
+     * the first one) to a source, and return the resulting source
+     */
+    private static GEMSourceData applyBranchToSource(GEMSourceData src,
+            LogicTreeBranch branch, int branchingLevel) {
+        if (branch.getRule() == null) {
+            // rule is not defined:
+            String msg =
+                    "No rule is defined at branching level: "
+                            + branchingLevel + "\n"
+                            + "Please correct your input!\n"
+                            + "Execution stopped!";
+            logger.info(msg);
+            throw new IllegalArgumentException(msg);
+        }
+        // at the moment we apply rules to all source typologies. In the
+        // future we may want to apply some filter (i.e. apply rule to this
+        // source type only...)
+        if (src instanceof GEMAreaSourceData) {
+            return applyRuleToAreaSource((GEMAreaSourceData) src, branch
+                    .getRule());
+        }
+        if (src instanceof GEMPointSourceData) {
+            return applyRuleToPointSource((GEMPointSourceData) src, branch
+                    .getRule());
+        }
+        if (src instanceof GEMFaultSourceData) {
+            return applyRuleToFaultSource((GEMFaultSourceData) src, branch
+                    .getRule());
+        }
+        if (src instanceof GEMSubductionFaultSourceData) {
+            return applyRuleToSubductionFaultSource(
+                    (GEMSubductionFaultSourceData) src, branch.getRule());
+        }
+        return src;
+    }
+
     /**
      * This method applies an "uncertainty" rule to an area source data object
      * 
@@ -838,6 +1117,17 @@ public class LogicTreeProcessor {
     public static HashMap<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> sampleGemLogicTreeGMPE(
             HashMap<TectonicRegionType, LogicTree<ScalarIntensityMeasureRelationshipAPI>> listLtGMPE,
             long seed) {
+        return sampleGemLogicTreeGMPE(listLtGMPE, seed, null);
+    }
+
+    /**
+     * Same as sampleGemLogicTreeGMPE(listLtGMPE, seed), also storing the
+     * sampled branch number for each tectonic region type in path, if not
+     * null.
+     */
+    public static HashMap<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> sampleGemLogicTreeGMPE(
+            HashMap<TectonicRegionType, LogicTree<ScalarIntensityMeasureRelationshipAPI>> listLtGMPE,
+            long seed, Map<TectonicRegionType, Integer> path) {
 
         Random rn = null;
         if (seed != 0) {
@@ -864,6 +1154,9 @@ public class LogicTreeProcessor {
 
             // sample the first branching level
             int branch = ltGMPE.sampleBranchingLevel(0, rn);
+            if (path != null) {
+                path.put(trt, branch);
+            }
 
             // select the corresponding gmpe from the end-branch mapping
             ScalarIntensityMeasureRelationshipAPI gmpe =
@@ -1,5 +1,6 @@
 package org.gem.calc;
 
+import static org.junit.Assert.assertEquals;
 import static org.junit.Assert.assertNotNull;
 import static org.junit.Assert.assertTrue;
 
@@ -117,6 +118,90 @@ public class HazardCalculatorTest {
         }
     }
 
+    /**
+     * Check that the curves computed in a single pass for several intensity
+     * measure types are those calculated one intensity measure type at a time
+     */
+    @Test
+    public void checkMultiImtHazardCurves() {
+        Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI> firstMap =
+                gmpeMap;
+        setUpGmpeMap();
+        List<Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>> gmpeMaps =
+                new ArrayList<Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>>();
+        gmpeMaps.add(firstMap);
+        gmpeMaps.add(gmpeMap);
+        List<Double> fewerImlVals = imlVals.subList(0, 3);
+        List<List<Double>> imlValsPerImt = new ArrayList<List<Double>>();
+        imlValsPerImt.add(imlVals);
+        imlValsPerImt.add(fewerImlVals);
+        List<Map<Site, DiscretizedFuncAPI>> results =
+                HazardCalculator.getMultiImtHazardCurves(siteList, erf,
+                        gmpeMaps, imlValsPerImt, integrationDistance);
+        assertEquals(2, results.size());
+        for (int imt = 0; imt < 2; imt++) {
+            Map<Site, DiscretizedFuncAPI> expected =
+                    HazardCalculator.getHazardCurves(siteList, erf, gmpeMaps
+                            .get(imt), imlValsPerImt.get(imt),
+                            integrationDistance);
+            for (Site site : siteList) {
+                DiscretizedFuncAPI curve = results.get(imt).get(site);
+                assertEquals(imlValsPerImt.get(imt).size(), curve.getNum());
+                for (int k = 0; k < curve.getNum(); k++) {
+                    assertEquals(expected.get(site).getY(k), curve.getY(k),
+                            1e-12);
+                }
+            }
+        }
+    }
+
+    /**
+     * Test getMultiImtHazardCurves when the intensity measure levels are not
+     * given for each gmpe map
+     */
+    @Test(expected = IllegalArgumentException.class)
+    public void getMultiImtHazardCurvesMismatchingImlVals() {
+        List<Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>> gmpeMaps =
+                new ArrayList<Map<TectonicRegionType, ScalarIntensityMeasureRelationshipAPI>>();
+        gmpeMaps.add(gmpeMap);
+        HazardCalculator.getMultiImtHazardCurves(siteList, erf, gmpeMaps,
+                new ArrayList<List<Double>>(), integrationDistance);
+    }
+
+    /**
+     * Check that the sites built in bulk have the given locations and all
+     * share the same site parameters
+     */
+    @Test
+    public void buildSiteListSetsLocationsAndParams() {
+        double[] lons = { 10.0, 10.5, 11.0 };
+        double[] lats = { 45.0, 45.5, 46.0 };
+        List<Site> sites =
+                HazardCalculator.buildSiteList(lons, lats, 760.0, 1.0,
+                        "Rock");
+        assertTrue(sites.size() == lons.length);
+        for (int i = 0; i < lons.length; i++) {
+            Site site = sites.get(i);
+            assertTrue(site.getLocation().getLongitude() == lons[i]);
+            assertTrue(site.getLocation().getLatitude() == lats[i]);
+            assertTrue(site.getParameter("Vs30").getValue().equals(760.0));
+            assertTrue(site.getParameter("Depth 2.5 km/sec").getValue()
+                    .equals(1.0));
+            assertTrue(site.getParameter("Sadigh Site Type").getValue()
+                    .equals("Rock"));
+        }
+    }
+
+    /**
+     * Test buildSiteList when coordinate arrays of different length are passed
+     */
+    @Test(expected = IllegalArgumentException.class)
+    public void buildSiteListMismatchingCoordinates() {
+        double[] lons = { 10.0, 10.5 };
+        double[] lats = { 45.0 };
+        HazardCalculator.buildSiteList(lons, lats, 760.0, 1.0, "Rock");
+    }
+
     /**
      * Test getHazardCurves when a null list of site is passed
      */
@@ -0,0 +1,81 @@
+package org.gem.calc;
+
+import static org.junit.Assert.assertEquals;
+import static org.junit.Assert.assertTrue;
+
+import java.util.ArrayList;
+import java.util.List;
+
+import org.junit.Before;
+import org.junit.Test;
+import org.opensha.commons.data.function.ArbitrarilyDiscretizedFunc;
+import org.opensha.commons.geo.Location;
+import org.opensha.sha.earthquake.FocalMechanism;
+import org.opensha.sha.earthquake.griddedForecast.HypoMagFreqDistAtLoc;
+import org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData.GEMPointSourceData;
+import org.opensha.sha.earthquake.rupForecastImpl.GEM1.SourceData.GEMSourceData;
+import org.opensha.sha.magdist.GutenbergRichterMagFreqDist;
+import org.opensha.sha.magdist.IncrementalMagFreqDist;
+import org.opensha.sha.util.TectonicRegionType;
+
+public class SourceFilterTest {
+
+    private List<GEMSourceData> sources;
+
+    @Before
+    public void setUp() {
+        sources = new ArrayList<GEMSourceData>();
+        sources.add(pointSource("near", 38.0, -122.0));
+        sources.add(pointSource("far-east", 38.0, -110.0));
+        sources.add(pointSource("far-north", 48.0, -122.0));
+        sources.add(pointSource("close-enough", 38.0, -120.0));
+    }
+
+    /**
+     * Sources within the integration distance from the block are kept, in
+     * their original order
+     */
+    @Test
+    public void keepsTheSourcesCloseToTheBlock() {
+        List<GEMSourceData> result =
+                SourceFilter.filterSources(sources, -122.2, 37.9, -121.9,
+                        38.1, 200.0);
+        assertEquals(2, result.size());
+        assertEquals("near", result.get(0).getID());
+        assertEquals("close-enough", result.get(1).getID());
+    }
+
+    /**
+     * The same index can be used for several blocks
+     */
+    @Test
+    public void indexCanBeQueriedForSeveralBlocks() {
+        SourceFilter filter = new SourceFilter(sources);
+        assertEquals(1, filter.filter(-110.1, 37.9, -109.9, 38.1, 50.0)
+                .size());
+        assertEquals(4, filter.filter(-122.0, 38.0, -110.0, 48.0, 10.0)
+                .size());
+        assertTrue(filter.filter(0.0, 0.0, 1.0, 1.0, 200.0).isEmpty());
+    }
+
+    @Test(expected = IllegalArgumentException.class)
+    public void nullSourceListIsNotAllowed() {
+        new SourceFilter(null);
+    }
+
+    private static GEMPointSourceData pointSource(String id, double lat,
+            double lon) {
+        IncrementalMagFreqDist[] magDists = new IncrementalMagFreqDist[1];
+        magDists[0] = new GutenbergRichterMagFreqDist(0.8, 0.5, 5.05, 6.95,
+                20);
+        FocalMechanism[] focMechs = new FocalMechanism[1];
+        focMechs[0] = new FocalMechanism(0.0, 90.0, 0.0);
+        ArbitrarilyDiscretizedFunc aveRupTopVsMag =
+                new ArbitrarilyDiscretizedFunc();
+        aveRupTopVsMag.set(6.0, 5.0);
+        return new GEMPointSourceData(id, id,
+                TectonicRegionType.ACTIVE_SHALLOW, new HypoMagFreqDistAtLoc(
+                        magDists, new Location(lat, lon), focMechs),
+                aveRupTopVsMag, 5.0);
+    }
+}
@@ -44,6 +44,37 @@ public class StochasticEventSetGeneratorTest {
                 rn);
     }
 
+    /**
+     * The indexes of the sampled ruptures give the same event set as the
+     * ruptures themselves, for the same random numbers
+     */
+    @Test
+    public void indexesOfTheStochasticEventSetGiveTheSameRuptures() {
+        ArrayList<GEMSourceData> faultSourceDataList =
+                new ArrayList<GEMSourceData>();
+        faultSourceDataList.add(getExampleFaultSource());
+        GEM1ERF erf = GEM1ERF.getGEM1ERF(faultSourceDataList, 5000.0);
+
+        ArrayList<EqkRupture> ruptures =
+                StochasticEventSetGenerator
+                        .getStochasticEventSetFromPoissonianERF(erf,
+                                new Random(123456789));
+        ArrayList<int[]> indexes =
+                StochasticEventSetGenerator
+                        .getStochasticEventSetIndexesFromPoissonianERF(erf,
+                                new Random(123456789));
+
+        assertEquals(ruptures.size(), indexes.size());
+        for (int i = 0; i < indexes.size(); i++) {
+            EqkRupture rupture =
+                    StochasticEventSetGenerator.getRupture(erf,
+                            indexes.get(i)[0], indexes.get(i)[1]);
+            assertEquals(ruptures.get(i).getMag(), rupture.getMag(), 0.0);
+            assertEquals(ruptures.get(i).getTectRegType(),
+                    rupture.getTectRegType());
+        }
+    }
+
     // @Test
     // This test needs a lot of memory resources that we don't currently have on
     // our CI VM...
@@ -1,20 +1,29 @@
 package org.gem.engine;
 
+import static org.junit.Assert.assertArrayEquals;
 import static org.junit.Assert.assertEquals;
 import static org.junit.Assert.assertFalse;
 import static org.junit.Assert.assertTrue;
 
+import java.util.LinkedHashMap;
+import java.util.List;
+import java.util.Map;
 import java.util.Properties;
 
 import org.apache.commons.configuration.ConfigurationException;
+import org.gem.engine.LogicTreeProcessor.EndBranch;
 import org.gem.engine.LogicTreeProcessor.EqkRuptureDataForNrml;
 import org.gem.engine.hazard.redis.BaseRedisTest;
 import org.gem.engine.hazard.redis.Cache;
+import org.gem.engine.logictree.LogicTree;
+import org.gem.engine.logictree.LogicTreeBranch;
+import org.gem.engine.logictree.LogicTreeBranchingLevel;
 import org.gem.ipe.PredictionEquationTestHelper;
 import org.junit.Test;
 import org.opensha.commons.geo.Location;
 import org.opensha.sha.earthquake.EqkRupture;
 import org.opensha.sha.faultSurface.EvenlyGriddedSurfaceAPI;
+import org.opensha.sha.util.TectonicRegionType;
 
 import com.google.gson.Gson;
 
@@ -133,4 +142,79 @@ public class LogicTreeProcessorTest extends BaseRedisTest {
         assertEquals(expected, fromKvs);
     }
 
+    /**
+     * All the combinations of branches are enumerated, with the product of
+     * the branch weights
+     */
+    @Test
+    public void enumeratesAllTheEndBranches() {
+        LogicTree<String> lt = new LogicTree<String>();
+        LogicTreeBranchingLevel first =
+                new LogicTreeBranchingLevel(1, "first", 0);
+        first.addBranch(new LogicTreeBranch(1, "a", 0.6));
+        first.addBranch(new LogicTreeBranch(2, "b", 0.4));
+        LogicTreeBranchingLevel second =
+                new LogicTreeBranchingLevel(2, "second", 0);
+        second.addBranch(new LogicTreeBranch(1, "c", 0.5));
+        second.addBranch(new LogicTreeBranch(2, "d", 0.3));
+        second.addBranch(new LogicTreeBranch(3, "e", 0.2));
+        lt.addBranchingLevel(first);
+        lt.addBranchingLevel(second);
+
+        List<EndBranch> endBranches =
+                LogicTreeProcessor.enumerateEndBranches(lt);
+
+        assertEquals(6, endBranches.size());
+        assertArrayEquals(new int[] { 1, 1 }, endBranches.get(0).getPath());
+        assertEquals(0.3, endBranches.get(0).getWeight(), 1e-12);
+        assertArrayEquals(new int[] { 2, 3 }, endBranches.get(5).getPath());
+        assertEquals(0.08, endBranches.get(5).getWeight(), 1e-12);
+        double totalWeight = 0.0;
+        for (EndBranch endBranch : endBranches) {
+            totalWeight += endBranch.getWeight();
+        }
+        assertEquals(1.0, totalWeight, 1e-12);
+    }
+
+    /**
+     * Sampling the logic trees again with the same seed gives the same path
+     * fingerprints
+     */
+    @Test
+    public void theSameSeedGivesTheSameFingerprint() throws Exception {
+        LogicTreeProcessor clc =
+                new LogicTreeProcessor(peerTestSet1Case5ConfigFile);
+
+        assertEquals(clc.sampleAndSaveERFTree(client, "erf1", 42),
+                clc.sampleAndSaveERFTree(client, "erf2", 42));
+        assertEquals(clc.sampleAndSaveGMPETree(client, "gmpe1", 42),
+                clc.sampleAndSaveGMPETree(client, "gmpe2", 42));
+    }
+
+    /**
+     * The GMPE path fingerprint doesn't depend on the order in which the
+     * tectonic region types are iterated
+     */
+    @Test
+    public void theGmpeFingerprintDoesNotDependOnTheMapOrder() {
+        Map<TectonicRegionType, Integer> path =
+                new LinkedHashMap<TectonicRegionType, Integer>();
+        path.put(TectonicRegionType.ACTIVE_SHALLOW, 1);
+        path.put(TectonicRegionType.STABLE_SHALLOW, 2);
+        path.put(TectonicRegionType.SUBDUCTION_INTERFACE, 1);
+
+        Map<TectonicRegionType, Integer> reversedPath =
+                new LinkedHashMap<TectonicRegionType, Integer>();
+        reversedPath.put(TectonicRegionType.SUBDUCTION_INTERFACE, 1);
+        reversedPath.put(TectonicRegionType.STABLE_SHALLOW, 2);
+        reversedPath.put(TectonicRegionType.ACTIVE_SHALLOW, 1);
+
+        assertEquals(LogicTreeProcessor.gmpePathFingerprint(path),
+                LogicTreeProcessor.gmpePathFingerprint(reversedPath));
+
+        reversedPath.put(TectonicRegionType.STABLE_SHALLOW, 1);
+        assertFalse(LogicTreeProcessor.gmpePathFingerprint(path).equals(
+                LogicTreeProcessor.gmpePathFingerprint(reversedPath)));
+    }
+
 } // class LogicTreeProcessorTest
@@ -22,3 +22,4 @@ computation is backed by the Java HazardEngine via the hazard_wrapper
 """
 
 import openquake.hazard.opensha
+import openquake.hazard.classical_numpy
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+"""
+Classical PSHA hazard curves computed with numpy, for source models made
+of point and area sources.
+
+Hazard curves are computed for a whole block of sites at once: distances
+are (site x rupture) matrices, GMPE means and standard deviations are
+rupture arrays and the probabilities of exceedance come from a (possibly
+truncated) normal distribution. The source model and the GMPE map are
+read from the KVS, as stored by the logic tree sampling, and the curves
+are written with the same layout used by the Java calculator, so the
+mean/quantile curves and maps work unchanged. Workers don't need a JVM.
+
+Area sources are treated as point sources on a grid of
+AREA_SOURCE_DISCRETIZATION degrees, with the rate equally shared among
+the nodes inside the area (the grid nodes can be slightly different from
+the ones used by the Java calculator).
+"""
+
+import json
+import math
+
+import numpy
+
+from scipy.stats import norm
+from shapely import geometry
+
+from openquake import kvs
+from openquake.hazard import job
+from openquake.hazard import opensha
+
+EARTH_RADIUS = 6371.0
+
+# GMPE map keys (tectonic region names) for the tectonic region
+# types used in the serialized source models
+TECTONIC_REGIONS = {
+    "ACTIVE_SHALLOW": "Active Shallow Crust",
+    "STABLE_SHALLOW": "Stable Shallow Crust",
+    "SUBDUCTION_INTERFACE": "Subduction Interface",
+    "SUBDUCTION_SLAB": "Subduction IntraSlab",
+    "VOLCANIC": "Volcanic",
+}
+
+# Boore and Atkinson (2008) coefficients, PGA
+BA_2008_PGA = {
+    "e1": -0.53804, "e2": -0.50350, "e3": -0.75472, "e4": -0.50970,
+    "e5": 0.28805, "e6": -0.10164, "e7": 0.0, "mh": 6.75,
+    "c1": -0.66050, "c2": 0.11970, "c3": -0.01151, "h": 1.35,
+    "blin": -0.360, "b1": -0.640, "b2": -0.14,
+    "sigma": 0.502, "tau": 0.260, "sigma_t": 0.564,
+    "m_ref": 4.5, "r_ref": 1.0, "v_ref": 760.0, "v1": 180.0, "v2": 300.0,
+    "a1": 0.03, "a2": 0.09, "pga_low": 0.06,
+}
+
+
+class Ruptures(object):
+    """Point ruptures of a source model, as arrays."""
+
+    def __init__(self, lons, lats, mags, rakes, rates, tect_regions):
+        self.lons = numpy.array(lons, dtype=float)
+        self.lats = numpy.array(lats, dtype=float)
+        self.mags = numpy.array(mags, dtype=float)
+        self.rakes = numpy.array(rakes, dtype=float)
+        self.rates = numpy.array(rates, dtype=float)
+        self.tect_regions = numpy.array(tect_regions, dtype=object)
+
+    def __len__(self):
+        return len(self.mags)
+
+    def subset(self, mask):
+        """Return the ruptures selected by the given boolean mask."""
+        return Ruptures(self.lons[mask], self.lats[mask], self.mags[mask],
+                self.rakes[mask], self.rates[mask], self.tect_regions[mask])
+
+
+def _location(raw_location):
+    """Return (lon, lat) in degrees of a serialized location (radians)."""
+    return (math.degrees(raw_location["lon"]),
+            math.degrees(raw_location["lat"]))
+
+
+def _mfd_ruptures(lons, lats, raw_mfds, raw_mechanisms, tect_region,
+                  min_magnitude):
+    """Return the rupture arrays (lons, lats, mags, rakes, rates, regions)
+    for magnitude frequency distributions and focal mechanisms applied to
+    each of the given locations, with the rate equally shared among them.
+    """
+
+    result = ([], [], [], [], [], [])
+    for raw_mfd, raw_mechanism in zip(raw_mfds, raw_mechanisms):
+        rates = numpy.array(raw_mfd["points"], dtype=float)
+        mags = raw_mfd["minX"] + numpy.arange(len(rates)) * raw_mfd["delta"]
+        selected = (rates > 0.0) & (mags >= min_magnitude)
+        mags, rates = mags[selected], rates[selected] / len(lons)
+
+        # each magnitude at each location
+        result[0].append(numpy.tile(lons, len(mags)))
+        result[1].append(numpy.tile(lats, len(mags)))
+        result[2].append(numpy.repeat(mags, len(lons)))
+        result[3].append(numpy.repeat(raw_mechanism["rake"],
+                len(mags) * len(lons)))
+        result[4].append(numpy.repeat(rates, len(lons)))
+        result[5].append(numpy.repeat(numpy.array([tect_region],
+                dtype=object), len(mags) * len(lons)))
+    return result
+
+
+def _area_nodes(raw_border, spacing):
+    """Return the lons and lats of the grid nodes inside an area."""
+    border = geometry.Polygon([_location(loc) for loc in raw_border])
+    (min_lon, min_lat, max_lon, max_lat) = border.bounds
+
+    lons = []
+    lats = []
+    for lat in numpy.arange(min_lat, max_lat + spacing / 2.0, spacing):
+        for lon in numpy.arange(min_lon, max_lon + spacing / 2.0, spacing):
+            if border.intersects(geometry.Point(lon, lat)):
+                lons.append(lon)
+                lats.append(lat)
+
+    if not lons:
+        lons, lats = [border.centroid.x], [border.centroid.y]
+
+    return lons, lats
+
+
+def ruptures_from_sources(sources, params):
+    """Build the point ruptures of a serialized (json decoded) source model.
+
+    Only point and area sources are supported, other source types raise a
+    ValueError unless they are excluded in the job configuration."""
+
+    min_magnitude = float(params["MINIMUM_MAGNITUDE"])
+    include_points = params["INCLUDE_GRID_SOURCES"].lower() == "true"
+    include_areas = params["INCLUDE_AREA_SOURCES"].lower() == "true"
+    include_faults = params["INCLUDE_FAULT_SOURCE"].lower() == "true"
+    include_subduction = params[
+            "INCLUDE_SUBDUCTION_FAULT_SOURCE"].lower() == "true"
+
+    if include_areas and params["TREAT_AREA_SOURCE_AS"] != "Point Sources":
+        raise ValueError("Area sources can only be treated as point "
+                "sources by the numpy calculator")
+
+    ruptures = ([], [], [], [], [], [])
+    for source in sources:
+        if "hypoMagFreqDistAtLoc" in source:
+            if not include_points:
+                continue
+            raw = source["hypoMagFreqDistAtLoc"]
+            (lon, lat) = _location(raw["location"])
+            lons, lats = [lon], [lat]
+        elif "reg" in source:
+            if not include_areas:
+                continue
+            raw = source["magfreqDistFocMech"]
+            lons, lats = _area_nodes(source["reg"]["border"],
+                    float(params["AREA_SOURCE_DISCRETIZATION"]))
+        elif "trace" in source and not include_faults:
+            continue
+        elif "topTrace" in source and not include_subduction:
+            continue
+        else:
+            raise ValueError("Source %s is not supported by the numpy "
+                    "calculator, only point and area sources are"
+                    % source.get("id"))
+
+        for values, new_values in zip(ruptures, _mfd_ruptures(lons, lats,
+                raw["magFreqDist"], raw["focalMechanism"],
+                TECTONIC_REGIONS[source["tectReg"]], min_magnitude)):
+            values.extend(new_values)
+
+    return Ruptures(*[numpy.concatenate(values) if values else []
+                      for values in ruptures])
+
+
+def distances(site_lons, site_lats, rup_lons, rup_lats):
+    """Return the (sites x ruptures) matrix of great circle distances (km)
+    between sites and (surface projections of) point ruptures."""
+
+    site_lons = numpy.radians(numpy.asarray(site_lons))[:, numpy.newaxis]
+    site_lats = numpy.radians(numpy.asarray(site_lats))[:, numpy.newaxis]
+    rup_lons = numpy.radians(numpy.asarray(rup_lons))[numpy.newaxis, :]
+    rup_lats = numpy.radians(numpy.asarray(rup_lats))[numpy.newaxis, :]
+
+    sin_dlat = numpy.sin((rup_lats - site_lats) / 2.0)
+    sin_dlon = numpy.sin((rup_lons - site_lons) / 2.0)
+    haversine = sin_dlat ** 2 + \
+            numpy.cos(site_lats) * numpy.cos(rup_lats) * sin_dlon ** 2
+
+    return 2.0 * EARTH_RADIUS * numpy.arcsin(
+            numpy.sqrt(numpy.clip(haversine, 0.0, 1.0)))
+
+
+def _ba_2008_rock(coeffs, mags, rjb, rakes):
+    """Boore and Atkinson (2008) ln mean without the site term."""
+
+    normal = (rakes >= -150.0) & (rakes <= -30.0)
+    reverse = (rakes > 30.0) & (rakes < 150.0)
+    strike_slip = ~(normal | reverse)
+
+    mechanism = coeffs["e2"] * strike_slip + coeffs["e3"] * normal + \
+            coeffs["e4"] * reverse
+    delta_mag = mags - coeffs["mh"]
+    magnitude_term = numpy.where(delta_mag <= 0.0,
+            coeffs["e5"] * delta_mag + coeffs["e6"] * delta_mag ** 2,
+            coeffs["e7"] * delta_mag)
+
+    distance = numpy.sqrt(rjb ** 2 + coeffs["h"] ** 2)
+    distance_term = (coeffs["c1"] + coeffs["c2"] *
+            (mags - coeffs["m_ref"])) * numpy.log(distance / coeffs["r_ref"]) \
+            + coeffs["c3"] * (distance - coeffs["r_ref"])
+
+    return mechanism + magnitude_term + distance_term
+
+
+def _ba_2008_site_term(coeffs, vs30, pga4nl):
+    """Boore and Atkinson (2008) linear and nonlinear site amplification."""
+
+    linear = coeffs["blin"] * math.log(vs30 / coeffs["v_ref"])
+
+    if vs30 <= coeffs["v1"]:
+        bnl = coeffs["b1"]
+    elif vs30 <= coeffs["v2"]:
+        bnl = (coeffs["b1"] - coeffs["b2"]) * \
+                math.log(vs30 / coeffs["v2"]) / \
+                math.log(coeffs["v1"] / coeffs["v2"]) + coeffs["b2"]
+    elif vs30 < coeffs["v_ref"]:
+        bnl = coeffs["b2"] * math.log(vs30 / coeffs["v_ref"]) / \
+                math.log(coeffs["v2"] / coeffs["v_ref"])
+    else:
+        bnl = 0.0
+
+    a1, a2 = coeffs["a1"], coeffs["a2"]
+    delta_x = math.log(a2 / a1)
+    delta_y = bnl * math.log(a2 / coeffs["pga_low"])
+    c = (3.0 * delta_y - bnl * delta_x) / delta_x ** 2
+    d = -(2.0 * delta_y - bnl * delta_x) / delta_x ** 3
+
+    low = bnl * math.log(coeffs["pga_low"] / 0.1)
+    ratio = numpy.log(numpy.maximum(pga4nl, a1) / a1)
+    nonlinear = numpy.where(pga4nl <= a1, low,
+            numpy.where(pga4nl <= a2, low + c * ratio ** 2 + d * ratio ** 3,
+            bnl * numpy.log(pga4nl / 0.1)))
+
+    return linear + nonlinear
+
+
+def ba_2008(imt, mags, rjb, rakes, vs30, std_type):
+    """Boore and Atkinson (2008) ln mean and standard deviation, for
+    magnitude and rake arrays (ruptures) and a (sites x ruptures) matrix
+    of Joyner-Boore distances."""
+
+    if imt != "PGA":
+        raise ValueError("The numpy BA_2008 only supports PGA")
+
+    coeffs = BA_2008_PGA
+    rock = _ba_2008_rock(coeffs, mags, rjb, rakes)
+    mean = rock + _ba_2008_site_term(coeffs, vs30, numpy.exp(rock))
+
+    std = {"Total": coeffs["sigma_t"], "Intra-Event": coeffs["sigma"],
+           "Inter-Event": coeffs["tau"], "None (zero)": 0.0}[std_type]
+
+    return mean, numpy.ones_like(mean) * std
+
+
+# GMPEs available to the numpy calculator, by OpenSHA class name
+GMPES = {"BA_2008_AttenRel": ba_2008}
+
+
+def gmpe_function(class_name):
+    """Return the numpy implementation of an OpenSHA GMPE class."""
+    name = class_name.split(".")[-1]
+    if name not in GMPES:
+        raise ValueError("GMPE %s is not supported by the numpy calculator"
+                % name)
+    return GMPES[name]
+
+
+def probabilities_of_exceedance(epsilons, truncation_type, truncation_level):
+    """Return the probabilities of exceeding a level, given the number of
+    standard deviations (epsilons) between the level and the mean."""
+
+    if truncation_type == "None":
+        return norm.sf(epsilons)
+
+    upper = norm.cdf(truncation_level)
+    if truncation_type == "1 Sided":
+        lower = 0.0
+    elif truncation_type == "2 Sided":
+        lower = norm.cdf(-truncation_level)
+    else:
+        raise ValueError("Unknown truncation type %s" % truncation_type)
+
+    return numpy.clip((upper - norm.cdf(epsilons)) / (upper - lower),
+            0.0, 1.0)
+
+
+def hazard_curves(site_list, ruptures, gmpe_map, params, measures=None):
+    """Compute the hazard curves (probabilities of exceedance in the
+    investigation time) of a block of sites, as a (sites x IMLs) array.
+
+    gmpe_map maps tectonic region names to OpenSHA GMPE class names.
+
+    If measures, a list of (IMT, period, IMLs) tuples (see
+    opensha.intensity_measures), is given, a list with the curves of
+    each of them is returned instead. Site to rupture distances are
+    computed only once for all of them."""
+
+    rjb = distances([site.longitude for site in site_list],
+            [site.latitude for site in site_list],
+            ruptures.lons, ruptures.lats)
+
+    if measures is None:
+        imls = [float(x) for x in
+                params["INTENSITY_MEASURE_LEVELS"].split(",")]
+        return _hazard_curves(rjb, ruptures, gmpe_map, params,
+                params["INTENSITY_MEASURE_TYPE"], imls)
+
+    return [_hazard_curves(rjb, ruptures, gmpe_map, params, imt, imls)
+            for (imt, _period, imls) in measures]
+
+
+def _hazard_curves(rjb, ruptures, gmpe_map, params, imt, imls):
+    """Hazard curves of a single IMT, from the (sites x ruptures) matrix
+    of Joyner-Boore distances."""
+
+    log_imls = opensha.IML_SCALING[imt](numpy.array(imls))
+    vs30 = float(params["REFERENCE_VS30_VALUE"])
+    max_distance = float(params["MAXIMUM_DISTANCE"])
+    truncation_type = params["GMPE_TRUNCATION_TYPE"]
+    truncation_level = float(params["TRUNCATION_LEVEL"])
+
+    # annual rate of exceedance of each IML at each site
+    rates = numpy.zeros((rjb.shape[0], len(imls)))
+
+    for tect_region in set(ruptures.tect_regions):
+        selected = ruptures.tect_regions == tect_region
+        region_ruptures = ruptures.subset(selected)
+        region_rjb = rjb[:, selected]
+        in_range = region_rjb <= max_distance
+
+        mean, std = gmpe_function(gmpe_map[tect_region])(imt,
+                region_ruptures.mags, region_rjb, region_ruptures.rakes,
+                vs30, params["STANDARD_DEVIATION_TYPE"])
+
+        for idx, log_iml in enumerate(log_imls):
+            if numpy.any(std > 0.0):
+                epsilons = (log_iml - mean) / numpy.where(std > 0.0, std, 1.0)
+                poes = probabilities_of_exceedance(
+                        epsilons, truncation_type, truncation_level)
+                poes = numpy.where(std > 0.0, poes, mean > log_iml)
+            else:
+                poes = (mean > log_iml).astype(float)
+
+            rates[:, idx] += numpy.dot(poes * in_range,
+                    region_ruptures.rates)
+
+    return 1.0 - numpy.exp(-rates * float(params["INVESTIGATION_TIME"]))
+
+
+def curves_to_json(site_list, poes, log_imls):
+    """Serialize hazard curves in the format of the Java calculator."""
+    return [json.dumps({"site_lon": str(site.longitude),
+                        "site_lat": str(site.latitude),
+                        "curve": [{"x": str(x), "y": str(y)}
+                                  for x, y in zip(log_imls, site_poes)]})
+            for site, site_poes in zip(site_list, poes)]
+
+
+class NumpyClassicalMixin(opensha.ClassicalMixin):
+    """Classical PSHA computing the hazard curves with numpy instead of
+    OpenSHA (see the module documentation for the supported models).
+
+    Logic tree processing is the same of the ClassicalMixin."""
+
+    def _numpy_hazard_curves(self, site_list, ruptures, gmpe_key,
+                             realization):
+        """ Compute the hazard curves of a block of sites for all the
+        intensity measure types, write them to KVS as JSON, and return
+        the KVS keys of the curves of INTENSITY_MEASURE_TYPE. """
+        gmpe_map = kvs.get_value_json_decoded(gmpe_key)
+        measures = opensha.intensity_measures(self.params)
+
+        all_poes = hazard_curves(site_list, ruptures, gmpe_map, self.params,
+                measures)
+
+        curve_keys = []
+        for idx, ((imt, period, imls), poes) in enumerate(
+                zip(measures, all_poes)):
+            log_imls = opensha.IML_SCALING[imt](numpy.array(imls))
+            imt = None if idx == 0 else opensha.imt_id(imt, period)
+            curve_keys.append(self.store_hazard_curves(site_list,
+                    realization, curves_to_json(site_list, poes, log_imls),
+                    imt))
+        return curve_keys[0]
+
+    def _stored_ruptures(self):
+        """ Ruptures of the source model currently stored in the KVS. """
+        sources = kvs.get_value_json_decoded(kvs.generate_product_key(
+                self.id, kvs.tokens.SOURCE_MODEL_TOKEN))
+        return ruptures_from_sources(sources, self.params)
+
+    def compute_hazard_curve(self, site_list, realization):
+        """ Compute hazard curves, write them to KVS as JSON,
+        and return a list of the KVS keys for each curve. """
+        return self._numpy_hazard_curves(site_list, self._stored_ruptures(),
+                kvs.generate_product_key(self.id, kvs.tokens.GMPE_TOKEN),
+                realization)
+
+    def compute_hazard_curves_for_gmpe_branches(self, site_list,
+                                                realizations, gmpe_keys):
+        """ Compute hazard curves for the currently stored source model
+        and each of the GMPE maps stored at gmpe_keys. """
+        ruptures = self._stored_ruptures()
+        return [self._numpy_hazard_curves(site_list, ruptures, gmpe_key,
+                    realization)
+                for realization, gmpe_key in zip(realizations, gmpe_keys)]
+
+
+job.HazJobMixin.register("Classical NumPy", NumpyClassicalMixin, order=2)
@@ -23,6 +23,7 @@ Collection of functions that compute stuff using
 as input data produced with the classical psha method.
 """
 
+import json
 import math
 import numpy
 
@@ -38,14 +39,22 @@ QUANTILE_PARAM_NAME = "QUANTILE_LEVELS"
 POES_PARAM_NAME = "POES_HAZARD_MAPS"
 
 
-def compute_mean_curve(curves):
+def compute_mean_curve(curves, weights=None):
     """Compute a mean hazard curve.
 
     The input parameter is a list of arrays where each array
     contains just the y values of the corresponding hazard curve.
+    If given, weights is the list of the weights of the curves
+    (e.g. when logic tree end branches are enumerated).
     """
 
-    return numpy.array(curves).mean(axis=0)
+    if not curves:
+        return numpy.array([])
+
+    if weights is None:
+        return numpy.array(curves).mean(axis=0)
+
+    return numpy.average(numpy.array(curves), axis=0, weights=weights)
 
 
 def compute_quantile_curve(curves, quantile):
@@ -62,6 +71,30 @@ def compute_quantile_curve(curves, quantile):
     return result
 
 
+def compute_weighted_quantile_curve(curves, weights, quantile):
+    """Compute a quantile hazard curve from curves with different weights.
+
+    For each IML, the PoEs are sorted and the quantile is linearly
+    interpolated on their normalized cumulative weights.
+    """
+    curves = numpy.array(curves)
+
+    if not len(curves.flat):
+        return []
+
+    weights = numpy.array(weights, dtype=float)
+    result = []
+
+    for poes in curves.transpose():
+        order = numpy.argsort(poes)
+        cumulative_weights = numpy.cumsum(weights[order])
+        cumulative_weights /= cumulative_weights[-1]
+        result.append(numpy.interp(
+                quantile, cumulative_weights, poes[order]))
+
+    return numpy.array(result)
+
+
 def _extract_y_values_from(curve):
     """Extract from a serialized hazard curve (in json format)
     the y values (PoEs) used to compute the mean hazard curve.
@@ -100,14 +133,25 @@ def _acceptable(value):
         return False
 
 
-def curves_at(job_id, site):
+def curves_at(job_id, site, from_realization=0):
     """Return all the json deserialized hazard curves for
-    a single site (different realizations)."""
+    a single site (different realizations).
+
+    If from_realization is given, only the curves of the realizations
+    numbered from it on are returned."""
     pattern = "%s*%s*%s*%s" % (kvs.tokens.HAZARD_CURVE_KEY_TOKEN,
             job_id, site.longitude, site.latitude)
 
     curves = []
-    raw_curves = kvs.mget_decoded(pattern)
+
+    if from_realization:
+        keys = [key for key in kvs.get_keys(pattern) if int(
+                kvs.tokens.realization_value_from_hazard_curve_key(key))
+                >= from_realization]
+        raw_curves = [json.loads(raw_curve) for raw_curve
+                      in kvs.get_client(binary=False).mget(keys)]
+    else:
+        raw_curves = kvs.mget_decoded(pattern)
 
     for raw_curve in raw_curves:
         curves.append(raw_curve["curve"])
@@ -115,6 +159,40 @@ def curves_at(job_id, site):
     return curves
 
 
+def weighted_curves_at(job_id, site, weights):
+    """Return all the json deserialized hazard curves for
+    a single site, along with the weights of the realizations
+    they belong to."""
+    pattern = "%s*%s*%s*%s" % (kvs.tokens.HAZARD_CURVE_KEY_TOKEN,
+            job_id, site.longitude, site.latitude)
+
+    keys = kvs.get_keys(pattern)
+    curves = []
+    curve_weights = []
+
+    if keys:
+        raw_curves = kvs.get_client(binary=False).mget(keys)
+
+        for key, raw_curve in zip(keys, raw_curves):
+            curves.append(json.loads(raw_curve)["curve"])
+            curve_weights.append(weights[
+                    kvs.tokens.realization_value_from_hazard_curve_key(key)])
+
+    return curves, curve_weights
+
+
+def realization_weights(job_id):
+    """Return the weights of the realizations of a job, keyed by
+    realization number (as string), or None if all the realizations
+    have the same weight (i.e. the logic trees have been sampled)."""
+    key = kvs.tokens.realization_weights_key(job_id)
+
+    if kvs.get(key) is None:
+        return None
+
+    return kvs.get_value_json_decoded(key)
+
+
 def hazard_curve_keys_for_job(job_id, sites,
                               hc_token=kvs.tokens.HAZARD_CURVE_KEY_TOKEN):
     """Return the KVS keys of hazard curves for a given job_id
@@ -161,23 +239,57 @@ def _extract_values_from_config(job, param_name):
 
 def compute_mean_hazard_curves(job_id, sites):
     """Compute a mean hazard curve for each site in the list
-    using as input all the pre-computed curves for different realizations."""
+    using as input all the pre-computed curves for different realizations.
+
+    When the realizations have the same weight, the number of realizations
+    averaged is stored along with the mean curve. If the job has been
+    extended with further realizations since (numbered after the existing
+    ones), the stored mean is updated with the curves of the new
+    realizations only."""
 
     keys = []
+    weights = realization_weights(job_id)
+
     for site in sites:
-        hazard_curves = curves_at(job_id, site)
+        key = kvs.tokens.mean_hazard_curve_key(job_id, site)
+        previous_curve = None
+
+        if weights:
+            hazard_curves, curve_weights = weighted_curves_at(
+                    job_id, site, weights)
+        else:
+            if kvs.get(key) is not None:
+                previous_curve = kvs.get_value_json_decoded(key)
+            if previous_curve and "realizations" in previous_curve:
+                hazard_curves = curves_at(job_id, site,
+                        previous_curve["realizations"])
+            else:
+                previous_curve = None
+                hazard_curves = curves_at(job_id, site)
+            curve_weights = None
 
         poes = [_extract_y_values_from(curve) for curve in hazard_curves]
-        mean_poes = compute_mean_curve(poes)
 
-        hazard_curve = hazard_curves.pop()
-        x_values = [values["x"] for values in hazard_curve]
+        if previous_curve is None:
+            mean_poes = compute_mean_curve(poes, curve_weights)
+            realizations = len(poes)
+            x_values = []
+
+            if hazard_curves:
+                x_values = [values["x"] for values in hazard_curves[-1]]
+        else:
+            mean_poes, realizations = _update_mean_curve(
+                    _extract_y_values_from(previous_curve["curve"]),
+                    previous_curve["realizations"], poes)
+            x_values = [values["x"] for values in previous_curve["curve"]]
 
         full_curve = _reconstruct_curve_list_from(mean_poes, x_values)
         mean_curve = {"site_lon": site.longitude, "site_lat": site.latitude,
             "curve": full_curve}
 
-        key = kvs.tokens.mean_hazard_curve_key(job_id, site)
+        if not weights:
+            mean_curve["realizations"] = realizations
+
         keys.append(key)
 
         kvs.set_value_json_encoded(key, mean_curve)
@@ -185,6 +297,21 @@ def compute_mean_hazard_curves(job_id, sites):
     return keys
 
 
+def _update_mean_curve(mean_poes, realizations, poes):
+    """Update a mean curve of the given number of realizations with the
+    curves (y values) of further realizations, and return the new mean
+    along with the new number of realizations."""
+
+    if not poes:
+        return mean_poes, realizations
+
+    total = realizations + len(poes)
+    mean_poes = (realizations * numpy.array(mean_poes)
+                 + numpy.sum(numpy.array(poes), axis=0)) / total
+
+    return mean_poes, total
+
+
 def compute_quantile_hazard_curves(job, sites):
     """Compute a quantile hazard curve for each site in the list
     using as input all the pre-computed curves for different realizations.
@@ -198,12 +325,23 @@ def compute_quantile_hazard_curves(job, sites):
 
     LOG.debug("[QUANTILE_HAZARD_CURVES] List of quantiles is %s" % quantiles)
 
+    weights = realization_weights(job.id)
+
     for site in sites:
         for quantile in quantiles:
-            hazard_curves = curves_at(job.id, site)
+            if weights:
+                hazard_curves, curve_weights = weighted_curves_at(
+                        job.id, site, weights)
+            else:
+                hazard_curves = curves_at(job.id, site)
 
             poes = [_extract_y_values_from(curve) for curve in hazard_curves]
-            quantile_poes = compute_quantile_curve(poes, quantile)
+
+            if weights:
+                quantile_poes = compute_weighted_quantile_curve(
+                        poes, curve_weights, quantile)
+            else:
+                quantile_poes = compute_quantile_curve(poes, quantile)
 
             quantile_curve = {"site_lat": site.latitude,
                 "site_lon": site.longitude,
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+"""
+Storage of the ground motion fields of the stochastic event sets.
+
+The sites of an event based job are stored once, and the ground motion
+fields of each rupture of a stochastic event set are stored as a dense
+float32 array (natural logarithm of the ground motion values) indexed
+like that site list, under a key per rupture. Each block of sites writes
+its slice of the arrays of all the ruptures, and consumers read only the
+ruptures they need with numpy.frombuffer, without any parsing. The
+ruptures themselves are described by the stochastic event set stored
+under the STOCHASTIC_SET_RUPTURES_TOKEN key (one entry per rupture).
+
+Consumers working by site (e.g. risk) read the fields transposed once in
+site major order: the ground motion values of a site for all the
+ruptures of all the stochastic event sets are stored as a single array
+under a key per site, each event set writing its own range of the array.
+
+The residuals of the site dependent term of a rupture are drawn from a
+counter based random stream (see openquake.rng) identified by the job
+seed, the stochastic event set and the rupture, at the position of the
+site in that list: without spatial correlation, a field does not depend
+on how the sites are split in blocks nor on the order of the tasks.
+"""
+
+import json
+import numpy
+
+from openquake import kvs
+from openquake import rng
+from openquake import shapes
+
+# ground motion values are stored as little endian float32
+DTYPE = numpy.dtype('<f4')
+
+# ruptures read from the KVS with a single request
+RUPTURES_PER_READ = 100
+
+# mean radius of the earth, in km
+EARTH_RADIUS = 6371.0
+
+
+def sites_key(job_id):
+    """Return the key of the site list of the ground motion fields."""
+    return kvs.generate_product_key(job_id, kvs.tokens.GMF_SITES_TOKEN)
+
+
+def rupture_key(job_id, stochastic_set_id, rupture_index):
+    """Return the key of the ground motion field of a rupture."""
+    return kvs.generate_product_key(job_id, kvs.tokens.GMF_RUPTURE_TOKEN,
+        "%s!%s" % (stochastic_set_id, rupture_index))
+
+
+def store_sites(job_id, sites):
+    """Store the site list of the ground motion fields."""
+    kvs.set_value_json_encoded(sites_key(job_id),
+        [(site.longitude, site.latitude) for site in sites])
+
+
+def load_sites(job_id):
+    """Return the site list of the ground motion fields."""
+    return [shapes.Site(lon, lat)
+            for (lon, lat) in kvs.get_value_json_decoded(sites_key(job_id))]
+
+
+def load_event_set(job_id, stochastic_set_id):
+    """Return the (source, rupture, inter-event residual) of the ruptures
+    of a stochastic event set."""
+    ruptures = kvs.get(kvs.generate_product_key(job_id,
+        kvs.tokens.STOCHASTIC_SET_RUPTURES_TOKEN, stochastic_set_id))
+    if ruptures is None:
+        return []
+    return json.loads(ruptures)
+
+
+def ruptures_count(job_id, stochastic_set_id):
+    """Return the number of ruptures of a stochastic event set."""
+    return len(load_event_set(job_id, stochastic_set_id))
+
+
+def residuals(seed, stochastic_set_id, rupture_index, first_site_id,
+              sites_count, truncation_level=None, truncation_type=None):
+    """Return the standard normal deviates of the site dependent residuals
+    of a rupture at sites_count sites, starting from the site with index
+    first_site_id."""
+    return rng.Stream(seed, stochastic_set_id, rupture_index).normal(
+        sites_count, first_site_id, truncation_level, truncation_type)
+
+
+def correlation_range(period):
+    """Return the range (km) of the spatial correlation of the intra-event
+    residuals, as given by Jayaram and Baker (2009) for sites without
+    clustering of the vs30 values."""
+    if period < 1.0:
+        return 8.5 + 17.2 * period
+    return 22.0 + 3.7 * period
+
+
+def correlation_factor(sites, period):
+    """Return the lower triangular factor L of the correlation matrix of
+    the intra-event residuals at the given sites (L * L.T is the matrix),
+    with the exponential model of Jayaram and Baker (2009)."""
+
+    lons = numpy.radians([site.longitude for site in sites])
+    lats = numpy.radians([site.latitude for site in sites])
+
+    # great circle distances, with the haversine formula
+    sin_dlat = numpy.sin((lats[:, numpy.newaxis] - lats) / 2.0)
+    sin_dlon = numpy.sin((lons[:, numpy.newaxis] - lons) / 2.0)
+    distances = 2.0 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(
+        sin_dlat ** 2 + numpy.cos(lats[:, numpy.newaxis]) * numpy.cos(lats)
+        * sin_dlon ** 2, 1.0)))
+
+    return numpy.linalg.cholesky(
+        numpy.exp(-3.0 * distances / correlation_range(period)))
+
+
+def ground_motion_fields(statistics, inter_epsilons, deviates, factor=None):
+    """Return the (ruptures x sites) natural logarithms of the ground motion
+    values, given the (ruptures x sites x 3) mean, inter-event and site
+    dependent standard deviations, the inter-event residuals of the
+    ruptures (in units of standard deviation) and the (ruptures x sites)
+    deviates of the site dependent residuals. With the factor of a
+    correlation matrix, the deviates of all the ruptures are correlated
+    among the sites with a single matrix product."""
+
+    statistics = numpy.asarray(statistics, dtype=float)
+    deviates = numpy.asarray(deviates, dtype=float)
+    if factor is not None:
+        deviates = numpy.dot(deviates, factor.T)
+
+    return (statistics[:, :, 0]
+            + numpy.asarray(inter_epsilons, dtype=float)[:, numpy.newaxis]
+            * statistics[:, :, 1]
+            + deviates * statistics[:, :, 2])
+
+
+def exceedance_counts(gmfs, imls):
+    """Return a (sites x IMLs) array with the number of ground motion
+    fields of a (ruptures x sites) array (natural logarithms of the ground
+    motion values) exceeding each of the given intensity measure levels."""
+    gmfs = numpy.asarray(gmfs, dtype=float)
+    return (gmfs[:, :, numpy.newaxis]
+            > numpy.log(imls)[numpy.newaxis, numpy.newaxis, :]).sum(axis=0)
+
+
+def probabilities_of_exceedance(counts, tses, time_span):
+    """Convert exceedance counts over stochastic event sets representing
+    a time span of tses to probabilities of exceedance in time_span,
+    assuming Poissonian occurrences."""
+    if tses <= 0:
+        raise ValueError("TSES must be positive")
+    return 1.0 - numpy.exp(
+        -numpy.asarray(counts, dtype=float) / tses * time_span)
+
+
+class SiteStatistics(object):
+    """Summary statistics of the ground motion values at each site over
+    all the ruptures, accumulated as the GMFs are read: maximum, mean,
+    number of exceedances of some thresholds and percentiles.
+
+    Percentiles are taken from a histogram of the values in log space
+    with PERCENTILE_BINS_PER_DECADE bins per decade between
+    PERCENTILE_MIN and PERCENTILE_MAX, and are given as the upper edge of
+    the bin where the percentile falls (values outside the range fall in
+    the first or the last bin)."""
+
+    PERCENTILE_MIN = 1e-5
+    PERCENTILE_MAX = 1e2
+    PERCENTILE_BINS_PER_DECADE = 20
+
+    def __init__(self, sites_count, thresholds):
+        self.thresholds = numpy.asarray(thresholds, dtype=float)
+        self.count = 0
+        self.maximum = numpy.zeros(sites_count)
+        self.total = numpy.zeros(sites_count)
+        self.exceedances = numpy.zeros(
+            (sites_count, len(self.thresholds)), dtype=int)
+
+        decades = numpy.log10(self.PERCENTILE_MAX / self.PERCENTILE_MIN)
+        self.bin_edges = numpy.logspace(numpy.log10(self.PERCENTILE_MIN),
+            numpy.log10(self.PERCENTILE_MAX),
+            int(round(decades * self.PERCENTILE_BINS_PER_DECADE)) + 1)
+        self.histogram = numpy.zeros(
+            (sites_count, len(self.bin_edges) - 1), dtype=int)
+
+    def update(self, gmfs):
+        """Add a (ruptures x sites) array of GMFs (natural logarithms of
+        the ground motion values)."""
+        values = numpy.exp(numpy.asarray(gmfs, dtype=float))
+        if not values.size:
+            return
+
+        self.count += values.shape[0]
+        self.maximum = numpy.maximum(self.maximum, values.max(axis=0))
+        self.total += values.sum(axis=0)
+        self.exceedances += (values[:, :, numpy.newaxis]
+                             > self.thresholds).sum(axis=0)
+
+        bins = numpy.clip(numpy.searchsorted(self.bin_edges, values) - 1,
+                          0, self.histogram.shape[1] - 1)
+        for site_bins, site_histogram in zip(bins.T, self.histogram):
+            site_histogram += numpy.bincount(site_bins,
+                minlength=len(site_histogram))
+
+    def mean(self):
+        """Return the mean ground motion value at each site."""
+        return self.total / max(self.count, 1)
+
+    def percentile(self, fraction):
+        """Return the ground motion value at each site not exceeded by the
+        given fraction (0 to 1) of the ruptures."""
+        cumulative = self.histogram.cumsum(axis=1)
+        bins = (cumulative < fraction * self.count).sum(axis=1)
+        return self.bin_edges[1:][numpy.minimum(bins,
+                                                self.histogram.shape[1] - 1)]
+
+
+def store_block(job_id, stochastic_set_id, first_site_id, gmfs):
+    """Store the ground motion fields of a block of sites, given as a
+    (ruptures x block sites) array, starting from the site with index
+    first_site_id."""
+
+    gmfs = numpy.asarray(gmfs, dtype=DTYPE)
+    offset = first_site_id * DTYPE.itemsize
+
+    pipe = kvs.get_client(binary=False).pipeline()
+    for rupture_index, gmf in enumerate(gmfs):
+        pipe.setrange(rupture_key(job_id, stochastic_set_id, rupture_index),
+                      offset, gmf.tostring())
+    pipe.execute()
+
+
+def load_rupture(job_id, stochastic_set_id, rupture_index):
+    """Return the ground motion field of a rupture at all the sites."""
+    return numpy.frombuffer(kvs.get(
+        rupture_key(job_id, stochastic_set_id, rupture_index)), dtype=DTYPE)
+
+
+def load_ruptures(job_id, stochastic_set_id, rupture_indexes):
+    """Return a (ruptures x sites) array with the ground motion fields of
+    the given ruptures."""
+
+    client = kvs.get_client(binary=False)
+    gmfs = []
+
+    for start in xrange(0, len(rupture_indexes), RUPTURES_PER_READ):
+        gmfs.extend(numpy.frombuffer(raw_gmf, dtype=DTYPE)
+            for raw_gmf in client.mget([
+                rupture_key(job_id, stochastic_set_id, rupture_index)
+                for rupture_index
+                in rupture_indexes[start:start + RUPTURES_PER_READ]]))
+
+    if not gmfs:
+        return numpy.zeros((0, 0), dtype=DTYPE)
+    return numpy.vstack(gmfs)
+
+
+def load_stochastic_set(job_id, stochastic_set_id):
+    """Return a (ruptures x sites) array with the ground motion fields of
+    all the ruptures of a stochastic event set."""
+    return load_ruptures(job_id, stochastic_set_id,
+        range(ruptures_count(job_id, stochastic_set_id)))
+
+
+def site_key(job_id, site_id):
+    """Return the key of the ground motion values of a site for all the
+    ruptures of all the stochastic event sets."""
+    return kvs.generate_product_key(job_id, kvs.tokens.GMF_SITE_TOKEN,
+        site_id)
+
+
+def stochastic_set_offsets(job_id, stochastic_set_ids):
+    """Return the position of the first rupture of each of the given
+    stochastic event sets in the site major arrays, the event sets being
+    stored one after the other in the given order."""
+
+    offsets = []
+    offset = 0
+    for stochastic_set_id in stochastic_set_ids:
+        offsets.append(offset)
+        offset += ruptures_count(job_id, stochastic_set_id)
+    return offsets
+
+
+def transpose_stochastic_set(job_id, stochastic_set_id, offset):
+    """Copy the ground motion fields of a stochastic event set to the site
+    major arrays, starting from the rupture position offset. Each event
+    set writes its own range of the arrays, so the event sets can be
+    transposed in any order and in parallel."""
+
+    ruptures = ruptures_count(job_id, stochastic_set_id)
+    client = kvs.get_client(binary=False)
+
+    for start in xrange(0, ruptures, RUPTURES_PER_READ):
+        gmfs = load_ruptures(job_id, stochastic_set_id,
+            range(start, min(start + RUPTURES_PER_READ, ruptures)))
+
+        pipe = client.pipeline()
+        for site_id, site_gmfs in enumerate(gmfs.T):
+            pipe.setrange(site_key(job_id, site_id),
+                (offset + start) * DTYPE.itemsize,
+                numpy.ascontiguousarray(site_gmfs).tostring())
+        pipe.execute()
+
+
+def load_site_gmfs(job_id, site_ids):
+    """Return the ground motion values (natural logarithms) of the given
+    sites for all the ruptures of all the stochastic event sets, as a list
+    of arrays in the order of site_ids."""
+
+    client = kvs.get_client(binary=False)
+    gmfs = []
+
+    for start in xrange(0, len(site_ids), RUPTURES_PER_READ):
+        gmfs.extend(numpy.frombuffer(raw_gmf or "", dtype=DTYPE)
+            for raw_gmf in client.mget([site_key(job_id, site_id)
+                for site_id in site_ids[start:start + RUPTURES_PER_READ]]))
+
+    return gmfs
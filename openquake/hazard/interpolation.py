@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+"""
+Hazard curves at arbitrary locations, bilinearly interpolated from the
+curves computed at the nodes of a coarse grid.
+
+The coarse grid has its origin at the lower left corner of the region
+and a spacing of HAZARD_INTERPOLATION_GRID_SPACING. Only the nodes of the
+cells containing at least one of the sites to compute are needed. The
+curve at a site is interpolated in log(PoE) space from the curves of the
+four corners of its cell, which is appropriate for hazard fields that
+vary smoothly at the scale of the coarse grid.
+"""
+
+import numpy
+
+from openquake import shapes
+
+# PoEs are interpolated in log space, zeros are floored to this value
+MIN_POE = 1e-300
+
+# tolerance (in units of the coarse grid spacing) to consider a site
+# aligned with a grid line
+ALIGNMENT_TOLERANCE = 1e-6
+
+
+class CoarseGrid(object):
+    """Grid of the nodes where hazard is computed."""
+
+    def __init__(self, origin, spacing):
+        self.origin = origin
+        self.spacing = float(spacing)
+
+    def site_at(self, column, row):
+        """Return the site of the node at the given column and row."""
+        return shapes.Site(self.origin.longitude + column * self.spacing,
+                           self.origin.latitude + row * self.spacing)
+
+    def cells(self, sites):
+        """Return the columns and rows of the lower left nodes of the cells
+        containing the given sites, and a (sites x 4) array with the
+        bilinear weights of the corners of each cell, in the order of
+        corners()."""
+
+        x_values = (numpy.array([site.longitude for site in sites])
+                    - self.origin.longitude) / self.spacing
+        y_values = (numpy.array([site.latitude for site in sites])
+                    - self.origin.latitude) / self.spacing
+
+        columns = numpy.floor(x_values + ALIGNMENT_TOLERANCE).astype(int)
+        rows = numpy.floor(y_values + ALIGNMENT_TOLERANCE).astype(int)
+
+        x_offsets = x_values - columns
+        y_offsets = y_values - rows
+        x_offsets[x_offsets < ALIGNMENT_TOLERANCE] = 0.0
+        y_offsets[y_offsets < ALIGNMENT_TOLERANCE] = 0.0
+
+        weights = numpy.column_stack([
+                (1.0 - x_offsets) * (1.0 - y_offsets),
+                x_offsets * (1.0 - y_offsets),
+                (1.0 - x_offsets) * y_offsets,
+                x_offsets * y_offsets])
+
+        return columns, rows, weights
+
+    def corners(self, column, row):
+        """Return the (column, row) of the four corners of a cell."""
+        return [(column, row), (column + 1, row),
+                (column, row + 1), (column + 1, row + 1)]
+
+    def nodes_for(self, sites):
+        """Return the sites of the nodes needed to interpolate the curves
+        at the given sites, each node once. Corners with a null weight
+        (e.g. for sites on a grid line) are not needed."""
+
+        columns, rows, weights = self.cells(sites)
+        nodes = set()
+
+        for column, row, site_weights in zip(columns, rows, weights):
+            for corner, weight in zip(self.corners(column, row),
+                                      site_weights):
+                if weight > 0.0:
+                    nodes.add(corner)
+
+        return [self.site_at(column, row)
+                for (row, column) in sorted((r, c) for (c, r) in nodes)]
+
+    def corner_sites(self, sites):
+        """Return, for each of the given sites, the sites of the four
+        corners of its cell along with their bilinear weights."""
+
+        columns, rows, weights = self.cells(sites)
+
+        return [([self.site_at(*corner) for corner
+                  in self.corners(column, row)], site_weights)
+                for column, row, site_weights in zip(columns, rows, weights)]
+
+
+def interpolate_curves(corner_poes, weights):
+    """Interpolate hazard curves in log(PoE) space.
+
+    corner_poes is a (sites x 4 x IMLs) array with the curves of the
+    corners of the cell of each site and weights the (sites x 4) array of
+    their bilinear weights. The curves of the corners with a null weight
+    are not used. Return a (sites x IMLs) array."""
+
+    corner_poes = numpy.asarray(corner_poes, dtype=float)
+    weights = numpy.asarray(weights, dtype=float)
+
+    log_poes = numpy.log(numpy.maximum(corner_poes, MIN_POE))
+    log_poes = numpy.where(weights[:, :, numpy.newaxis] > 0.0, log_poes, 0.0)
+
+    result = numpy.exp(
+        (log_poes * weights[:, :, numpy.newaxis]).sum(axis=1))
+
+    # PoEs that are null at any corner used stay null
+    null = ((corner_poes <= 0.0)
+            & (weights[:, :, numpy.newaxis] > 0.0)).any(axis=1)
+    result[null] = 0.0
+
+    return result
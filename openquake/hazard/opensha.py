@@ -22,20 +22,29 @@
 Wrapper around the OpenSHA-lite java library.
 """
 
+import collections
+import hashlib
+import json
 import math
 import os
 import random
+import time
 import numpy
 
 from openquake import java
 from openquake import kvs
 from openquake import logs
+from openquake import rng
 from openquake import settings
 from openquake import shapes
 
 from openquake.hazard import classical_psha
+from openquake.hazard import gmf
+from openquake.hazard import interpolation
 from openquake.hazard import job
+from openquake.hazard import site_amplification
 from openquake.hazard import tasks
+from openquake.job import checkpoint
 from openquake.job.mixins import Mixin
 from openquake.kvs import tokens
 from openquake.output import geotiff
@@ -56,6 +65,23 @@ IML_SCALING = {'PGA': numpy.log,
 HAZARD_CURVE_FILENAME_PREFIX = 'hazardcurve'
 HAZARD_MAP_FILENAME_PREFIX = 'hazardmap'
 
+# hazard curves computed from the ground motion fields of an event based job
+GMF_HAZARD_CURVE_FILENAME_PART = 'gmf-mean'
+
+# Java site lists built by parameterize_sites, kept per block (i.e. per
+# list of sites) on the worker, and the maximum number of blocks cached.
+JSITE_LIST_CACHE = {}
+JSITE_LIST_CACHE_SIZE = 16
+
+# factors of the correlation matrices of the intra-event residuals, kept
+# per block and intensity measure type on the worker (a factor takes
+# 8 * sites ** 2 bytes), and the maximum number of factors cached
+CORRELATION_FACTOR_CACHE = {}
+CORRELATION_FACTOR_CACHE_SIZE = 8
+
+# seconds between two checks of the event based tasks in flight
+GMF_TASKS_POLL_INTERVAL = 0.5
+
 
 def preload(fn):
     """A decorator for preload steps that must run on the Jobber node"""
@@ -73,43 +99,77 @@ def preload(fn):
 class BasePSHAMixin(Mixin):
     """Contains common functionality for PSHA Mixins."""
 
-    def store_source_model(self, seed):
+    def store_source_model(self, seed, key=None):
         """Generates an Earthquake Rupture Forecast, using the source zones and
         logic trees specified in the job config file. Note that this has to be
         done currently using the file itself, since it has nested references to
-        other files."""
+        other files.
+
+        key is the KVS key of the source model, if it is not the default one.
+        Return a fingerprint of the sampled logic tree path."""
 
         LOG.info("Storing source model from job config")
-        key = kvs.generate_product_key(self.id, kvs.tokens.SOURCE_MODEL_TOKEN)
+        if key is None:
+            key = kvs.generate_product_key(
+                self.id, kvs.tokens.SOURCE_MODEL_TOKEN)
         print "source model key is", key
-        self.calc.sampleAndSaveERFTree(self.cache, key, seed)
+        return self.calc.sampleAndSaveERFTree(self.cache, key, seed)
 
-    def store_gmpe_map(self, seed):
+    def store_gmpe_map(self, seed, key=None):
         """Generates a hash of tectonic regions and GMPEs, using the logic tree
-        specified in the job config file."""
-        key = kvs.generate_product_key(self.id, kvs.tokens.GMPE_TOKEN)
+        specified in the job config file.
+
+        key is the KVS key of the GMPE map, if it is not the default one.
+        Return a fingerprint of the sampled logic tree path."""
+        if key is None:
+            key = kvs.generate_product_key(self.id, kvs.tokens.GMPE_TOKEN)
         print "GMPE map key is", key
-        self.calc.sampleAndSaveGMPETree(self.cache, key, seed)
+        return self.calc.sampleAndSaveGMPETree(self.cache, key, seed)
 
-    def generate_erf(self):
+    def generate_erf(self, block_bounds=None, key=None):
         """Generate the Earthquake Rupture Forecast from the currently stored
-        source model logic tree."""
-        key = kvs.generate_product_key(self.id, kvs.tokens.SOURCE_MODEL_TOKEN)
+        source model logic tree.
+
+        If the bounding box (min_lon, min_lat, max_lon, max_lat) of a block
+        of sites is given, the sources farther than MAXIMUM_DISTANCE from
+        it are discarded before building the ERF. key is the KVS key of
+        the source model, if it is not the default one."""
+        if key is None:
+            key = kvs.generate_product_key(
+                self.id, kvs.tokens.SOURCE_MODEL_TOKEN)
         sources = java.jclass("JsonSerializer").getSourceListFromCache(
                     self.cache, key)
+
+        if block_bounds is not None:
+            jpype = java.jvm()
+            max_distance = float(self.params['MAXIMUM_DISTANCE'])
+            total_sources = sources.size()
+            (min_lon, min_lat, max_lon, max_lat) = block_bounds
+            sources = java.jclass("SourceFilter").filterSources(sources,
+                jpype.JDouble(min_lon), jpype.JDouble(min_lat),
+                jpype.JDouble(max_lon), jpype.JDouble(max_lat),
+                jpype.JDouble(max_distance))
+            LOG.info("Pruned %s of %s sources farther than %s km from "
+                     "block %s" % (total_sources - sources.size(),
+                     total_sources, max_distance, block_bounds))
+
         erf = java.jclass("GEM1ERF")(sources)
         self.calc.setGEM1ERFParams(erf)
         return erf
 
-    def set_gmpe_params(self, gmpe_map):
-        """Push parameters from configuration file into the GMPE objects"""
+    def set_gmpe_params(self, gmpe_map, imt=None, period=None):
+        """Push parameters from configuration file into the GMPE objects.
+
+        imt and period default to INTENSITY_MEASURE_TYPE and PERIOD."""
         jpype = java.jvm()
+        if imt is None:
+            imt = self.params['INTENSITY_MEASURE_TYPE']
+            period = float(self.params['PERIOD'])
         gmpe_lt_data = self.calc.createGmpeLogicTreeData()
         for tect_region in gmpe_map.keySet():
             gmpe = gmpe_map.get(tect_region)
             gmpe_lt_data.setGmpeParams(self.params['COMPONENT'],
-                self.params['INTENSITY_MEASURE_TYPE'],
-                jpype.JDouble(float(self.params['PERIOD'])),
+                imt, jpype.JDouble(period),
                 jpype.JDouble(float(self.params['DAMPING'])),
                 self.params['GMPE_TRUNCATION_TYPE'],
                 jpype.JDouble(float(self.params['TRUNCATION_LEVEL'])),
@@ -118,46 +178,66 @@ class BasePSHAMixin(Mixin):
                 jpype.JObject(gmpe, java.jclass("AttenuationRelationship")))
             gmpe_map.put(tect_region, gmpe)
 
-    def generate_gmpe_map(self):
-        """Generate the GMPE map from the stored GMPE logic tree."""
-        key = kvs.generate_product_key(self.id, kvs.tokens.GMPE_TOKEN)
+    def generate_gmpe_map(self, key=None, imt=None, period=None):
+        """Generate the GMPE map from the stored GMPE logic tree.
+
+        key is the KVS key of the GMPE map, if it is not the default one
+        (e.g. when the GMPE logic tree end branches are enumerated).
+        imt and period are those of the GMPEs, if they are not
+        INTENSITY_MEASURE_TYPE and PERIOD."""
+        if key is None:
+            key = kvs.generate_product_key(self.id, kvs.tokens.GMPE_TOKEN)
         gmpe_map = java.jclass(
             "JsonSerializer").getGmpeMapFromCache(self.cache, key)
-        self.set_gmpe_params(gmpe_map)
+        self.set_gmpe_params(gmpe_map, imt, period)
         return gmpe_map
 
-    def get_iml_list(self):
+    def get_iml_list(self, imt=None, levels=None):
         """Build the appropriate Arbitrary Discretized Func from the IMLs,
-        based on the IMT"""
+        based on the IMT.
+
+        imt and levels default to INTENSITY_MEASURE_TYPE and
+        INTENSITY_MEASURE_LEVELS."""
+
+        if imt is None:
+            imt = self.params['INTENSITY_MEASURE_TYPE']
+            levels = [float(val) for val
+                      in self.params['INTENSITY_MEASURE_LEVELS'].split(",")]
 
         iml_list = java.jclass("ArrayList")()
-        for val in self.params['INTENSITY_MEASURE_LEVELS'].split(","):
-            iml_list.add(
-                IML_SCALING[self.params['INTENSITY_MEASURE_TYPE']](
-                float(val)))
+        for val in levels:
+            iml_list.add(IML_SCALING[imt](val))
         return iml_list
 
     def parameterize_sites(self, site_list):
-        """Convert python Sites to Java Sites, and add default parameters."""
-        # TODO(JMC): There's Java code for this already, sets each site to have
-        # the same default parameters
+        """Convert python Sites to Java Sites, and add default parameters.
+
+        The whole list is built on the Java side with a single call, and
+        the result is cached on the worker so that further tasks for the
+        same block (e.g. other realizations) can reuse it."""
+
+        site_params = (float(self.params['REFERENCE_VS30_VALUE']),
+                float(self.params['REFERENCE_DEPTH_TO_2PT5KM_PER_SEC_PARAM']),
+                self.params['SADIGH_SITE_TYPE'])
+
+        cache_key = _site_list_cache_key(site_list, site_params)
+        jsite_list = JSITE_LIST_CACHE.get(cache_key)
+
+        if jsite_list is None:
+            jpype = java.jvm()
+            lons = jpype.JArray(jpype.JDouble)(
+                [site.longitude for site in site_list])
+            lats = jpype.JArray(jpype.JDouble)(
+                [site.latitude for site in site_list])
+
+            jsite_list = java.jclass("HazardCalculator").buildSiteList(
+                lons, lats, jpype.JDouble(site_params[0]),
+                jpype.JDouble(site_params[1]), jpype.JString(site_params[2]))
+
+            if len(JSITE_LIST_CACHE) >= JSITE_LIST_CACHE_SIZE:
+                JSITE_LIST_CACHE.clear()
+            JSITE_LIST_CACHE[cache_key] = jsite_list
 
-        jpype = java.jvm()
-        jsite_list = java.jclass("ArrayList")()
-        for x in site_list:
-            site = x.to_java()
-
-            vs30 = java.jclass("DoubleParameter")(jpype.JString("Vs30"))
-            vs30.setValue(float(self.params['REFERENCE_VS30_VALUE']))
-            depth25 = java.jclass("DoubleParameter")("Depth 2.5 km/sec")
-            depth25.setValue(float(
-                    self.params['REFERENCE_DEPTH_TO_2PT5KM_PER_SEC_PARAM']))
-            sadigh = java.jclass("StringParameter")("Sadigh Site Type")
-            sadigh.setValue(self.params['SADIGH_SITE_TYPE'])
-            site.addParameter(vs30)
-            site.addParameter(depth25)
-            site.addParameter(sadigh)
-            jsite_list.add(site)
         return jsite_list
 
 
@@ -174,19 +254,61 @@ class ClassicalMixin(BasePSHAMixin):
     @preload
     def execute(self):
 
+        site_list = self.sites_to_compute()
+        interpolated_sites = None
+
+        coarse_grid = self.interpolation_grid()
+        if coarse_grid is not None:
+            interpolated_sites = site_list
+            site_list = coarse_grid.nodes_for(interpolated_sites)
+            LOG.info('Computing hazard at %s coarse grid nodes to '
+                     'interpolate the curves of %s sites'
+                     % (len(site_list), len(interpolated_sites)))
+
+        enumerate_trees = self.params.get('ENUMERATE_LOGIC_TREES', 'false')
+
+        if enumerate_trees.lower() == 'true':
+            results = self.execute_enumerated(site_list)
+        else:
+            results = self.execute_sampled(site_list)
+
+        self.compute_statistics(site_list, interpolated_sites)
+
+        return results
+
+    def interpolation_grid(self):
+        """Return the coarse grid where hazard is computed when the curves
+        of the sites are interpolated (HAZARD_INTERPOLATION_GRID_SPACING),
+        None if hazard is computed at the sites."""
+        spacing = self.params.get('HAZARD_INTERPOLATION_GRID_SPACING', '')
+        if not spacing.strip():
+            return None
+        return interpolation.CoarseGrid(
+            self.region.lower_left_corner, float(spacing))
+
+    def execute_sampled(self, site_list):
+        """Compute the hazard curves for NUMBER_OF_LOGIC_TREE_SAMPLES
+        random samples of the logic trees.
+
+        When a sample repeats the logic tree path of a previous realization,
+        the curves of that realization are copied under the new realization
+        number instead of being computed again."""
+
         results = []
+        # logic tree path fingerprint -> first realization with that path
+        computed_paths = {}
 
+        # seeds drawn for the job are stored with it, so that a resumed
+        # job samples the same logic tree paths
         source_model_generator = random.Random()
         source_model_generator.seed(
-                self.params.get('SOURCE_MODEL_LT_RANDOM_SEED', None))
+                self.random_seed('SOURCE_MODEL_LT_RANDOM_SEED'))
 
         gmpe_generator = random.Random()
-        gmpe_generator.seed(self.params.get('GMPE_LT_RANDOM_SEED', None))
+        gmpe_generator.seed(self.random_seed('GMPE_LT_RANDOM_SEED'))
 
         realizations = int(self.params['NUMBER_OF_LOGIC_TREE_SAMPLES'])
 
-        site_list = self.sites_for_region()
-
         LOG.info('Going to run classical PSHA hazard for %s realizations '\
                  'and %s sites' % (realizations, len(site_list)))
 
@@ -195,8 +317,34 @@ class ClassicalMixin(BasePSHAMixin):
                      % realization)
             pending_tasks = []
             results_per_realization = []
-            self.store_source_model(source_model_generator.getrandbits(32))
-            self.store_gmpe_map(source_model_generator.getrandbits(32))
+            source_model_path = self.store_source_model(
+                source_model_generator.getrandbits(32))
+            gmpe_path = self.store_gmpe_map(
+                source_model_generator.getrandbits(32))
+            path = (source_model_path, gmpe_path)
+
+            if checkpoint.is_done(
+                self.id, checkpoint.HAZARD_CURVES, realization):
+                LOG.info('Hazard curves for realization %s already computed'
+                         % realization)
+                computed_paths.setdefault(path, realization)
+                results.extend(self.hazard_curve_keys(site_list, realization))
+                continue
+
+            if path in computed_paths:
+                LOG.info('Realization %s samples the same logic tree path '
+                         'of realization %s, reusing its hazard curves'
+                         % (realization, computed_paths[path]))
+                results_per_realization = self.copy_hazard_curves(
+                    site_list, computed_paths[path], realization)
+                self.write_realization_hazardcurve_files(
+                    site_list, realization, results_per_realization)
+                checkpoint.mark_done(
+                    self.id, checkpoint.HAZARD_CURVES, realization)
+                results.extend(results_per_realization)
+                continue
+
+            computed_paths[path] = realization
 
             pending_tasks.append(
                 tasks.compute_hazard_curve.delay(self.id, site_list,
@@ -208,10 +356,140 @@ class ClassicalMixin(BasePSHAMixin):
                     raise Exception(task.result)
                 results_per_realization.extend(task.result)
 
-            self.write_hazardcurve_file(results_per_realization)
+            self.write_realization_hazardcurve_files(
+                site_list, realization, results_per_realization)
+            checkpoint.mark_done(self.id, checkpoint.HAZARD_CURVES, realization)
             results.extend(results_per_realization)
 
-        del results_per_realization
+        return results
+
+    def execute_enumerated(self, site_list):
+        """Compute the hazard curves for all the end branches of the
+        logic trees.
+
+        Each source model end branch is stored and turned into an ERF once,
+        and all the GMPE end branches are evaluated against it. The weight
+        of each realization (product of the source model and GMPE branch
+        weights) is stored in the KVS and used for mean and quantiles."""
+
+        jpype = java.jvm()
+        erf_branches = json.loads(self.calc.enumerateERFTree())
+        gmpe_branches = json.loads(self.calc.enumerateGMPETree())
+
+        LOG.info('Going to run classical PSHA hazard for %s source model '
+                 'and %s GMPE end branches and %s sites'
+                 % (len(erf_branches), len(gmpe_branches), len(site_list)))
+
+        gmpe_keys = []
+        for gmpe_idx, gmpe_branch in enumerate(gmpe_branches):
+            key = kvs.generate_product_key(
+                self.id, kvs.tokens.GMPE_TOKEN, gmpe_idx)
+            self.calc.saveGMPEEndBranch(self.cache, key,
+                jpype.JArray(jpype.JInt)(gmpe_branch['path']))
+            gmpe_keys.append(key)
+
+        source_model_key = kvs.generate_product_key(
+            self.id, kvs.tokens.SOURCE_MODEL_TOKEN)
+
+        results = []
+        weights = {}
+        for erf_idx, erf_branch in enumerate(erf_branches):
+            realizations = []
+            realization_gmpe_keys = []
+            for gmpe_idx, gmpe_branch in enumerate(gmpe_branches):
+                realization = erf_idx * len(gmpe_branches) + gmpe_idx
+                weights[str(realization)] = \
+                    erf_branch['weight'] * gmpe_branch['weight']
+
+                if checkpoint.is_done(
+                    self.id, checkpoint.HAZARD_CURVES, realization):
+                    results.extend(
+                        self.hazard_curve_keys(site_list, realization))
+                else:
+                    realizations.append(realization)
+                    realization_gmpe_keys.append(gmpe_keys[gmpe_idx])
+
+            if not realizations:
+                LOG.info('Hazard curves for source model end branch %s '
+                         'already computed' % erf_branch['path'])
+                continue
+
+            LOG.info('Calculating hazard curves for source model end '
+                     'branch %s' % erf_branch['path'])
+            self.calc.saveERFEndBranch(self.cache, source_model_key,
+                jpype.JArray(jpype.JInt)(erf_branch['path']))
+
+            task = tasks.compute_hazard_curves_for_gmpe_branches.delay(
+                self.id, site_list, realizations, realization_gmpe_keys)
+            task.wait()
+            if task.status != 'SUCCESS':
+                raise Exception(task.result)
+
+            for realization, results_per_realization in zip(
+                realizations, task.result):
+                self.write_realization_hazardcurve_files(
+                    site_list, realization, results_per_realization)
+                checkpoint.mark_done(
+                    self.id, checkpoint.HAZARD_CURVES, realization)
+                results.extend(results_per_realization)
+
+        kvs.set_value_json_encoded(
+            kvs.tokens.realization_weights_key(self.id), weights)
+
+        return results
+
+    def hazard_curve_keys(self, site_list, realization, imt=None):
+        """Return the KVS keys of the hazard curves of a realization.
+
+        imt is the id of one of the additional intensity measure types,
+        if the curves are not those of INTENSITY_MEASURE_TYPE."""
+        if imt is None:
+            return [kvs.tokens.hazard_curve_key(self.id, realization,
+                        site.longitude, site.latitude) for site in site_list]
+        return [kvs.tokens.imt_hazard_curve_key(self.id, imt, realization,
+                    site.longitude, site.latitude) for site in site_list]
+
+    def copy_hazard_curves(self, site_list, from_realization, realization):
+        """Store the hazard curves of a realization (for all the intensity
+        measure types) also under another realization number, and return
+        the new KVS keys of the curves of INTENSITY_MEASURE_TYPE."""
+
+        kvs_client = kvs.get_client(binary=False)
+        imts = [None] + [imt_id(imt, period) for (imt, period, _levels)
+                         in intensity_measures(self.params)[1:]]
+
+        for imt in imts:
+            from_keys = self.hazard_curve_keys(
+                site_list, from_realization, imt)
+            curve_keys = self.hazard_curve_keys(site_list, realization, imt)
+            kvs_client.mset(dict(zip(curve_keys, kvs_client.mget(from_keys))))
+
+        return self.hazard_curve_keys(site_list, realization)
+
+    def write_realization_hazardcurve_files(self, site_list, realization,
+                                            curve_keys):
+        """Serialize the hazard curves of a realization, one NRML file per
+        intensity measure type.
+
+        curve_keys are the KVS keys of the curves of
+        INTENSITY_MEASURE_TYPE."""
+        self.write_hazardcurve_file(curve_keys)
+        for (imt, period, _levels) in intensity_measures(self.params)[1:]:
+            self.write_hazardcurve_file(self.hazard_curve_keys(
+                site_list, realization, imt_id(imt, period)))
+
+    def compute_statistics(self, site_list, interpolated_sites=None):
+        """Compute and serialize mean and quantile hazard curves and
+        maps from the hazard curves of all the realizations.
+
+        If interpolated_sites is given, site_list are the nodes of the
+        coarse interpolation grid. The mean and quantile curves are then
+        interpolated at interpolated_sites, and the maps are computed
+        from the interpolated curves."""
+
+        if checkpoint.is_done(self.id, checkpoint.HAZARD_STATISTICS):
+            LOG.info('Mean and quantile hazard curves already computed')
+            return
 
         # compute and serialize mean and quantile hazard curves
         pending_tasks_mean = []
@@ -238,6 +516,25 @@ class ClassicalMixin(BasePSHAMixin):
                 raise Exception(task.result)
             results_quantile.extend(task.result)
 
+        if interpolated_sites is not None:
+            LOG.info('Interpolating mean and quantile hazard curves')
+            if results_mean:
+                results_mean = self.interpolate_statistic_curves(
+                    interpolated_sites, results_mean,
+                    lambda site: kvs.tokens.mean_hazard_curve_key(
+                        self.id, site))
+            interpolated_quantiles = []
+            for quantile, key_list in _collect_curve_keys_per_quantile(
+                results_quantile).items():
+                interpolated_quantiles.extend(
+                    self.interpolate_statistic_curves(
+                        interpolated_sites, key_list,
+                        lambda site, quantile=quantile:
+                            kvs.tokens.quantile_hazard_curve_key(
+                                self.id, site, quantile)))
+            results_quantile = interpolated_quantiles
+            site_list = interpolated_sites
+
         if self.params['COMPUTE_MEAN_HAZARD_CURVE'].lower() == 'true':
             LOG.info('Serializing mean hazard curves')
             self.write_hazardcurve_file(results_mean)
@@ -275,7 +572,174 @@ class ClassicalMixin(BasePSHAMixin):
             for key_list in quantile_values.values():
                 self.write_hazardmap_file(key_list)
 
-        return results
+        if self.params.get('SITE_AMPLIFICATION_FACTORS', '').strip():
+            LOG.info('Computing/serializing amplified hazard curves')
+            self.compute_amplified_curves(site_list)
+
+        checkpoint.mark_done(self.id, checkpoint.HAZARD_STATISTICS)
+
+    def interpolate_statistic_curves(self, sites, curve_keys, key_for):
+        """Interpolate at the given sites the curves stored at curve_keys
+        (at the nodes of the coarse interpolation grid) and store them at
+        key_for(site). The curves of the nodes that are not among the
+        sites are removed, so that the statistics and maps only use the
+        interpolated curves. Return the keys of the interpolated curves."""
+
+        kvs_client = kvs.get_client(binary=False)
+        node_curves = {}
+        for raw_curve in kvs_client.mget(curve_keys):
+            curve = json.loads(raw_curve)
+            node_curves[shapes.Site(float(curve['site_lon']),
+                float(curve['site_lat']))] = curve['curve']
+
+        any_curve = node_curves.values()[0]
+        no_curve = [{'y': 1.0}] * len(any_curve)
+        corner_sites = self.interpolation_grid().corner_sites(sites)
+
+        corner_poes = []
+        weights = []
+        for (corners, corner_weights) in corner_sites:
+            # corners with a null weight may not have been computed
+            corner_poes.append([[float(point['y']) for point
+                in node_curves.get(corner, no_curve)] for corner in corners])
+            weights.append(corner_weights)
+
+        poes = interpolation.interpolate_curves(corner_poes, weights)
+
+        keys = []
+        for site, site_poes in zip(sites, poes):
+            curve = {'site_lon': site.longitude, 'site_lat': site.latitude,
+                     'curve': [{'y': poe} for poe in site_poes]}
+            if 'x' in any_curve[0]:
+                for point, node_point in zip(curve['curve'], any_curve):
+                    point['x'] = node_point['x']
+            key = key_for(site)
+            kvs_client.set(key, json.dumps(curve))
+            keys.append(key)
+
+        stale_keys = set(curve_keys) - set(keys)
+        if stale_keys:
+            kvs_client.delete(*stale_keys)
+
+        return keys
+
+    def compute_amplified_curves(self, site_list):
+        """Amplify the mean and quantile rock hazard curves stored in the
+        KVS, without computing hazard again, and serialize the amplified
+        curves and hazard maps.
+
+        Curves are amplified for each site class of
+        SITE_AMPLIFICATION_FACTORS or, if SITE_VS30_MAP_FILE is given, with
+        the factors interpolated at the vs30 of each site."""
+
+        imls = [float(x) for x
+                in self.params['INTENSITY_MEASURE_LEVELS'].split(",")]
+        (class_vs30s, class_factors) = \
+            site_amplification.parse_amplification_factors(
+                self.params['SITE_AMPLIFICATION_FACTORS'], len(imls))
+
+        if self.params.get('SITE_VS30_MAP_FILE'):
+            vs30_map = site_amplification.parse_vs30_map(
+                kvs.get_client(binary=False).get(
+                    self.params['SITE_VS30_MAP_FILE']))
+            reference_vs30 = float(self.params['REFERENCE_VS30_VALUE'])
+            vs30s = [vs30_map.get(site, reference_vs30) for site in site_list]
+            factor_sets = [('vs30map', vs30s,
+                site_amplification.factors_for_vs30(
+                    vs30s, class_vs30s, class_factors))]
+        else:
+            factor_sets = [('vs30-%s' % vs30, [vs30] * len(site_list),
+                            numpy.tile(factors, (len(site_list), 1)))
+                           for vs30, factors in zip(class_vs30s, class_factors)]
+
+        statistics = []
+        if self.params['COMPUTE_MEAN_HAZARD_CURVE'].lower() == 'true':
+            statistics.append(('mean', {'statistics': 'mean'},
+                [kvs.tokens.mean_hazard_curve_key(self.id, site)
+                 for site in site_list]))
+        # the same levels as those of the stored quantile curves
+        for quantile in classical_psha._extract_values_from_config(
+            self, classical_psha.QUANTILE_PARAM_NAME):
+            statistics.append(('quantile-%.2f' % quantile,
+                {'statistics': 'quantile', 'quantileValue': quantile},
+                [kvs.tokens.quantile_hazard_curve_key(self.id, site, quantile)
+                 for site in site_list]))
+
+        poes = classical_psha._extract_values_from_config(
+            self, classical_psha.POES_PARAM_NAME)
+
+        for (site_class, vs30s, factors) in factor_sets:
+            for (label, attrib_update, curve_keys) in statistics:
+                sites, rock_poes = site_amplification.curves_from_kvs(
+                    curve_keys)
+                site_poes = site_amplification.amplify_curves(
+                    imls, rock_poes, factors)
+
+                self.store_amplified_curves(site_class, attrib_update,
+                    sites, imls, site_poes)
+
+                filename_part = "amplified-%s-%s" % (site_class, label)
+                self.write_amplified_curves_file(filename_part,
+                    attrib_update, sites, imls, site_poes)
+                for poe in poes:
+                    self.write_amplified_map_file(filename_part,
+                        attrib_update, sites, vs30s,
+                        site_amplification.hazard_map(imls, site_poes, poe),
+                        poe)
+
+    def store_amplified_curves(self, site_class, attrib_update, sites, imls,
+                               poes):
+        """Write amplified hazard curves to the KVS, in the format of
+        the other hazard curves."""
+        kvs_client = kvs.get_client(binary=False)
+        statistics = attrib_update.get('quantileValue', 'mean')
+        log_imls = [math.log(iml) for iml in imls]
+        for site, site_poes in zip(sites, poes):
+            curve = {"site_lon": site.longitude, "site_lat": site.latitude,
+                     "curve": [{"x": x, "y": y}
+                               for x, y in zip(log_imls, site_poes)]}
+            kvs_client.set(kvs.tokens.amplified_hazard_curve_key(
+                self.id, site_class, statistics, site), json.dumps(curve))
+
+    def write_amplified_curves_file(self, filename_part, attrib_update,
+                                    sites, imls, poes):
+        """Generate a NRML file with amplified hazard curves."""
+        nrml_path = os.path.join(self['BASE_PATH'], self['OUTPUT_DIR'],
+            hazard_curve_filename(filename_part))
+
+        hc_data = []
+        for site, site_poes in zip(sites, poes):
+            hc_attrib = {'investigationTimeSpan':
+                            self.params['INVESTIGATION_TIME'],
+                         'IMLValues': imls,
+                         'IMT': self.params['INTENSITY_MEASURE_TYPE'],
+                         'PoEValues': list(site_poes)}
+            hc_attrib.update(attrib_update)
+            hc_data.append((site, hc_attrib))
+
+        hazard_output.HazardCurveXMLWriter(nrml_path).serialize(hc_data)
+        return nrml_path
+
+    def write_amplified_map_file(self, filename_part, attrib_update, sites,
+                                 vs30s, site_imls, poe):
+        """Generate a NRML file with an amplified hazard map, site_imls
+        being the IML of each site at the given PoE."""
+        nrml_path = os.path.join(self['BASE_PATH'], self['OUTPUT_DIR'],
+            hazard_map_filename("%s-%s" % (poe, filename_part)))
+
+        hm_data = []
+        for site, vs30, iml in zip(sites, vs30s, site_imls):
+            hm_attrib = {'investigationTimeSpan':
+                            self.params['INVESTIGATION_TIME'],
+                         'IMT': self.params['INTENSITY_MEASURE_TYPE'],
+                         'IML': iml,
+                         'vs30': vs30,
+                         'poE': poe}
+            hm_attrib.update(attrib_update)
+            hm_data.append((site, hm_attrib))
+
+        hazard_output.HazardMapXMLWriter(nrml_path).serialize(hm_data)
+        return nrml_path
 
     def write_hazardcurve_file(self, curve_keys):
         """Generate a NRML file with hazard curves for a collection of
@@ -317,6 +781,16 @@ class ClassicalMixin(BasePSHAMixin):
             filename_part = realization_reference_str
             curve_mode = 'realization'
 
+        elif _is_imt_hazard_curve_key(curve_keys[0]):
+            realization_reference_str = \
+                tokens.realization_value_from_hazard_curve_key(curve_keys[0])
+            imt_reference_str = \
+                tokens.imt_value_from_hazard_curve_key(curve_keys[0])
+            hc_attrib_update = {'endBranchLabel': realization_reference_str}
+            filename_part = "%s-%s" % (
+                imt_reference_str, realization_reference_str)
+            curve_mode = 'imt_realization'
+
         else:
             error_msg = "no valid hazard curve type found in KVS key"
             raise RuntimeError(error_msg)
@@ -328,6 +802,18 @@ class ClassicalMixin(BasePSHAMixin):
         iml_list = [float(param)
                     for param
                     in self.params['INTENSITY_MEASURE_LEVELS'].split(",")]
+        imt = self.params['INTENSITY_MEASURE_TYPE']
+
+        if curve_mode == 'imt_realization':
+            for (imt, period, iml_list) in intensity_measures(self.params):
+                if imt_id(imt, period) == imt_reference_str:
+                    break
+            else:
+                raise ValueError("unknown intensity measure type %s"
+                                 % imt_reference_str)
+            if imt == 'SA':
+                hc_attrib_update.update({'saPeriod': period,
+                                         'saDamping': self.params['DAMPING']})
 
         LOG.debug("Generating NRML hazard curve file for mode %s, "\
             "%s hazard curves: %s" % (curve_mode, len(curve_keys), nrml_file))
@@ -365,6 +851,19 @@ class ClassicalMixin(BasePSHAMixin):
                                 "hazard curves in an instance file"
                     raise ValueError(error_msg)
 
+            elif curve_mode == 'imt_realization':
+                if not _is_imt_hazard_curve_key(hc_key):
+                    error_msg = "non-IMT hazard curve key found in "\
+                                "IMT realization mode"
+                    raise RuntimeError(error_msg)
+                elif (tokens.realization_value_from_hazard_curve_key(
+                        hc_key) != realization_reference_str or
+                      tokens.imt_value_from_hazard_curve_key(hc_key) !=
+                        imt_reference_str):
+                    error_msg = "realization and IMT must be the same for "\
+                                "all hazard curves in an instance file"
+                    raise ValueError(error_msg)
+
             hc = kvs.get_value_json_decoded(hc_key)
 
             site_obj = shapes.Site(float(hc['site_lon']),
@@ -385,7 +884,7 @@ class ClassicalMixin(BasePSHAMixin):
             hc_attrib = {'investigationTimeSpan':
                             self.params['INVESTIGATION_TIME'],
                          'IMLValues': iml_list,
-                         'IMT': self.params['INTENSITY_MEASURE_TYPE'],
+                         'IMT': imt,
                          'PoEValues': curve_poe}
 
             hc_attrib.update(hc_attrib_update)
@@ -496,27 +995,78 @@ class ClassicalMixin(BasePSHAMixin):
         """ Compute hazard curves, write them to KVS as JSON,
         and return a list of the KVS keys for each curve. """
         jsite_list = self.parameterize_sites(site_list)
-        hazard_curves = java.jclass("HazardCalculator").getHazardCurvesAsJson(
-            jsite_list,
-            self.generate_erf(),
-            self.generate_gmpe_map(),
-            self.get_iml_list(),
-            float(self.params['MAXIMUM_DISTANCE']))
-
-        # write the curves to the KVS and return a list of the keys
-        kvs_client = kvs.get_client()
+        erf = self.generate_erf(block_bounds=sites_bounds(site_list))
+
+        return self.compute_and_store_hazard_curves(
+            site_list, jsite_list, erf, realization)
+
+    @preload
+    def compute_hazard_curves_for_gmpe_branches(self, site_list,
+                                                realizations, gmpe_keys):
+        """ Compute hazard curves for the currently stored source model
+        and each of the GMPE maps stored at gmpe_keys, building the ERF
+        only once. Return a list with the KVS keys of the curves of
+        each realization. """
+        jsite_list = self.parameterize_sites(site_list)
+        erf = self.generate_erf(block_bounds=sites_bounds(site_list))
+
         curve_keys = []
+        for realization, gmpe_key in zip(realizations, gmpe_keys):
+            curve_keys.append(self.compute_and_store_hazard_curves(
+                site_list, jsite_list, erf, realization, gmpe_key))
+
+        return curve_keys
+
+    def compute_and_store_hazard_curves(self, site_list, jsite_list, erf,
+                                        realization, gmpe_key=None):
+        """ Compute the hazard curves of a realization for all the
+        intensity measure types of the job, and write them to the KVS.
+
+        When additional intensity measure types are configured, the
+        ruptures of the ERF are enumerated once and evaluated with the
+        GMPEs of every intensity measure type. Return the KVS keys of the
+        curves of INTENSITY_MEASURE_TYPE. """
+        calculator = java.jclass("HazardCalculator")
+        max_distance = float(self.params['MAXIMUM_DISTANCE'])
+        measures = intensity_measures(self.params)
+
+        if len(measures) == 1:
+            hazard_curves = calculator.getHazardCurvesAsJson(
+                jsite_list, erf, self.generate_gmpe_map(gmpe_key),
+                self.get_iml_list(), max_distance)
+            return self.store_hazard_curves(
+                site_list, realization, hazard_curves)
+
+        gmpe_maps = java.jclass("ArrayList")()
+        iml_lists = java.jclass("ArrayList")()
+        for (imt, period, levels) in measures:
+            gmpe_maps.add(self.generate_gmpe_map(gmpe_key, imt, period))
+            iml_lists.add(self.get_iml_list(imt, levels))
+
+        hazard_curves = calculator.getMultiImtHazardCurvesAsJson(
+            jsite_list, erf, gmpe_maps, iml_lists, max_distance)
+
+        for (imt, period, _levels), imt_curves in zip(
+            measures[1:], hazard_curves[1:]):
+            self.store_hazard_curves(
+                site_list, realization, imt_curves, imt_id(imt, period))
+
+        return self.store_hazard_curves(
+            site_list, realization, hazard_curves[0])
+
+    def store_hazard_curves(self, site_list, realization, hazard_curves,
+                            imt=None):
+        """ Write the JSON hazard curves of a realization to the KVS,
+        and return a list of the keys.
+
+        imt is the id of one of the additional intensity measure types,
+        if the curves are not those of INTENSITY_MEASURE_TYPE. """
+        kvs_client = kvs.get_client()
+        curve_keys = self.hazard_curve_keys(site_list, realization, imt)
         for i in xrange(0, len(hazard_curves)):
             curve = hazard_curves[i]
-            site = site_list[i]
-            lon = site.longitude
-            lat = site.latitude
-            curve_key = kvs.tokens.hazard_curve_key(self.id,
-                                                    realization,
-                                                    lon,
-                                                    lat)
+            curve_key = curve_keys[i]
             kvs_client.set(curve_key, curve)
-            curve_keys.append(curve_key)
         return curve_keys
 
 
@@ -535,18 +1085,22 @@ class EventBasedMixin(BasePSHAMixin):
         """Main hazard processing block.
 
         Loops through various random realizations, spawning tasks to compute
-        GMFs."""
+        GMFs. The ruptures of each stochastic event set are sampled once,
+        then their GMFs are computed by a task per block of
+        GMF_SITES_PER_BLOCK sites. Up to GMF_TASKS_IN_FLIGHT tasks, of any
+        seismicity history, run at the same time, and the GMF files of each
+        stochastic event set are written as soon as its tasks are
+        completed. With COMPUTE_HAZARD_CURVES_FROM_GMFS, hazard curves are
+        then derived from the GMFs of all the stochastic event sets."""
         results = []
 
-        source_model_generator = random.Random()
-        source_model_generator.seed(
-                self.params.get('SOURCE_MODEL_LT_RANDOM_SEED', None))
-
-        gmpe_generator = random.Random()
-        gmpe_generator.seed(self.params.get('GMPE_LT_RANDOM_SEED', None))
-
-        gmf_generator = random.Random()
-        gmf_generator.seed(self.params.get('GMF_RANDOM_SEED', None))
+        # the seeds of each stochastic event set are taken from random
+        # streams of the set, and seeds drawn for the job are stored with
+        # it, so that the missing sets of an interrupted job get the same
+        # seeds of an uninterrupted run
+        source_model_seed = self.random_seed('SOURCE_MODEL_LT_RANDOM_SEED')
+        gmpe_seed = self.random_seed('GMPE_LT_RANDOM_SEED')
+        gmf_seed = self.random_seed('GMF_RANDOM_SEED')
 
         histories = int(self.params['NUMBER_OF_SEISMICITY_HISTORIES'])
         realizations = int(self.params['NUMBER_OF_LOGIC_TREE_SAMPLES'])
@@ -554,53 +1108,159 @@ class EventBasedMixin(BasePSHAMixin):
             "Going to run hazard for %s histories of %s realizations each."
             % (histories, realizations))
 
+        site_list = self.sites_to_compute()
+        gmf.store_sites(self.id, site_list)
+        if self.params.get('GMF_EXPORT') == 'set':
+            results.append(self.write_gmf_sites_file(site_list))
+        elif self.params.get('GMF_EXPORT') == 'statistics':
+            self.gmf_statistics = gmf.SiteStatistics(len(site_list),
+                self.gmf_statistics_thresholds())
+        sites_per_block = int(self.params['GMF_SITES_PER_BLOCK'])
+        gmf_tasks = GMFTasks(self.id, [site_list[i:i + sites_per_block]
+            for i in xrange(0, len(site_list), sites_per_block)],
+            int(self.params['GMF_TASKS_IN_FLIGHT']), gmf_seed)
+
         for i in range(0, histories):
-            pending_tasks = []
             for j in range(0, realizations):
-                self.store_source_model(source_model_generator.getrandbits(32))
-                self.store_gmpe_map(gmpe_generator.getrandbits(32))
                 stochastic_set_id = "%s!%s" % (i, j)
-                pending_tasks.append(
-                    tasks.compute_ground_motion_fields.delay(
-                        self.id, self.sites_for_region(), stochastic_set_id,
-                        gmf_generator.getrandbits(32)))
 
-            for task in pending_tasks:
-                task.wait()
-                if task.status != 'SUCCESS':
-                    raise Exception(task.result)
+                if checkpoint.is_done(
+                    self.id, checkpoint.STOCHASTIC_SET, stochastic_set_id):
+                    LOG.info("Stochastic event set %s already computed"
+                             % stochastic_set_id)
+                    results.extend(self.write_gmf_files(stochastic_set_id))
+                    continue
+
+                while gmf_tasks.full():
+                    results.extend(self.complete_stochastic_sets(
+                        gmf_tasks.wait()))
+
+                # each set has its own logic tree samples, since the
+                # tasks of several sets run at the same time
+                self.store_source_model(
+                    rng.Stream(source_model_seed, i, j).seed(),
+                    self.stochastic_set_key(
+                        kvs.tokens.SOURCE_MODEL_TOKEN, stochastic_set_id))
+                self.store_gmpe_map(rng.Stream(gmpe_seed, i, j).seed(),
+                    self.stochastic_set_key(
+                        kvs.tokens.GMPE_TOKEN, stochastic_set_id))
+                gmf_tasks.add(stochastic_set_id,
+                    rng.Stream(gmf_seed, i, j, "ses").seed())
+
+        while gmf_tasks.pending():
+            results.extend(self.complete_stochastic_sets(gmf_tasks.wait()))
+
+        if self.params.get('GMF_EXPORT') == 'statistics':
+            results.extend(self.write_gmf_statistics_files())
+
+        if self.params.get('COMPUTE_HAZARD_CURVES_FROM_GMFS') == 'true':
+            results.append(self.write_gmf_hazard_curves(
+                ["%s!%s" % (i, j) for i in xrange(histories)
+                 for j in xrange(realizations)]))
 
-            for j in range(0, realizations):
-                stochastic_set_id = "%s!%s" % (i, j)
-                stochastic_set_key = kvs.generate_product_key(
-                    self.id, kvs.tokens.STOCHASTIC_SET_TOKEN,
-                    stochastic_set_id)
-                print "Writing output for ses %s" % stochastic_set_key
-                ses = kvs.get_value_json_decoded(stochastic_set_key)
-                if ses:
-                    results.extend(self.write_gmf_files(ses))
         return results
 
-    def write_gmf_files(self, ses):
-        """Generate a GeoTiff file and a NRML file for each GMF."""
+    def write_gmf_hazard_curves(self, stochastic_set_ids):
+        """Compute the hazard curves at the sites of the job from the
+        ground motion fields of the given stochastic event sets, and write
+        them in a NRML file. Return the path of the file.
+
+        The exceedances of INTENSITY_MEASURE_LEVELS are counted over all
+        the ruptures of the sets, which together represent a time span of
+        INVESTIGATION_TIME times the number of sets (TSES). Since the sets
+        sample the logic trees, the curves are mean hazard curves."""
+
+        imls = [float(param) for param
+                in self.params['INTENSITY_MEASURE_LEVELS'].split(",")]
+        time_span = float(self.params['INVESTIGATION_TIME'])
+        sites = gmf.load_sites(self.id)
+
+        counts = numpy.zeros((len(sites), len(imls)), dtype=int)
+        for stochastic_set_id in stochastic_set_ids:
+            ruptures = gmf.ruptures_count(self.id, stochastic_set_id)
+            for start in xrange(0, ruptures, gmf.RUPTURES_PER_READ):
+                rupture_indexes = range(
+                    start, min(start + gmf.RUPTURES_PER_READ, ruptures))
+                counts += gmf.exceedance_counts(gmf.load_ruptures(
+                    self.id, stochastic_set_id, rupture_indexes), imls)
+
+        poes = gmf.probabilities_of_exceedance(counts,
+            time_span * len(stochastic_set_ids), time_span)
+
+        LOG.info("Writing hazard curves from the GMFs of %s stochastic "
+                 "event sets" % len(stochastic_set_ids))
+        nrml_path = os.path.join(self['BASE_PATH'], self['OUTPUT_DIR'],
+            hazard_curve_filename(GMF_HAZARD_CURVE_FILENAME_PART))
+
+        hc_data = []
+        for site, site_poes in zip(sites, poes):
+            hc_attrib = {'investigationTimeSpan': time_span,
+                         'IMLValues': imls,
+                         'IMT': self.params['INTENSITY_MEASURE_TYPE'],
+                         'PoEValues': list(site_poes),
+                         'statistics': 'mean'}
+            hc_data.append((site, hc_attrib))
+
+        hazard_output.HazardCurveXMLWriter(nrml_path).serialize(hc_data)
+        return nrml_path
+
+    def stochastic_set_key(self, token, stochastic_set_id):
+        """Return the KVS key of a product (e.g. the sampled source model)
+        of a stochastic event set."""
+        return kvs.generate_product_key(self.id, token, stochastic_set_id)
+
+    def complete_stochastic_sets(self, stochastic_set_ids):
+        """Record as done the given stochastic event sets, whose tasks are
+        all completed, and write their outputs. Return the files written."""
+
+        files = []
+        for stochastic_set_id in stochastic_set_ids:
+            kvs.get_client(binary=False).delete(
+                self.stochastic_set_key(
+                    kvs.tokens.SOURCE_MODEL_TOKEN, stochastic_set_id),
+                self.stochastic_set_key(
+                    kvs.tokens.GMPE_TOKEN, stochastic_set_id))
+            checkpoint.mark_done(
+                self.id, checkpoint.STOCHASTIC_SET, stochastic_set_id)
+            files.extend(self.write_gmf_files(stochastic_set_id))
+
+        return files
+
+    def write_gmf_files(self, stochastic_set_id):
+        """Generate a GeoTiff file and a NRML file for each GMF of a
+        stochastic event set, or the files of the whole set if GMF_EXPORT
+        is "set"."""
+        if self.params.get('GMF_EXPORT') == 'set':
+            return self.write_gmf_set_files(stochastic_set_id)
+        elif self.params.get('GMF_EXPORT') == 'statistics':
+            self.update_gmf_statistics(stochastic_set_id)
+            return []
+
         image_grid = self.region.grid
         iml_list = [float(param)
                     for param
                     in self.params['INTENSITY_MEASURE_LEVELS'].split(",")]
 
+        LOG.info("Writing output for ses %s" % stochastic_set_id)
         LOG.debug("Generating GMF image, grid is %s col by %s rows" % (
                 image_grid.columns, image_grid.rows))
         LOG.debug("IML: %s" % (iml_list))
+
+        sites = gmf.load_sites(self.id)
+        points = [image_grid.point_at(site) for site in sites]
+        ruptures = gmf.ruptures_count(self.id, stochastic_set_id)
+
         files = []
-        for event_set in ses:
-            for rupture in ses[event_set]:
+        for start in xrange(0, ruptures, gmf.RUPTURES_PER_READ):
+            rupture_indexes = range(
+                start, min(start + gmf.RUPTURES_PER_READ, ruptures))
+            ground_motions = numpy.exp(gmf.load_ruptures(
+                self.id, stochastic_set_id, rupture_indexes).astype(float))
 
-                # NOTE(fab): we have to explicitly convert the JSON-decoded
-                # tokens from Unicode to string, otherwise the path will not
-                # be accepted by the GeoTiffFile constructor
+            for rupture, values in zip(rupture_indexes, ground_motions):
                 common_path = os.path.join(self.base_path, self['OUTPUT_DIR'],
-                        "gmf-%s-%s" % (str(event_set.replace("!", "_")),
-                                       str(rupture.replace("!", "_"))))
+                        "gmf-%s-%s" % (stochastic_set_id.replace("!", "_"),
+                                       rupture))
                 tiff_path = "%s.tiff" % common_path
                 nrml_path = "%s.xml" % common_path
                 gwriter = geotiff.GMFGeoTiffFile(tiff_path, image_grid,
@@ -608,14 +1268,9 @@ class EventBasedMixin(BasePSHAMixin):
                     discrete=True)
                 xmlwriter = hazard_output.GMFXMLWriter(nrml_path)
                 gmf_data = {}
-                for site_key in ses[event_set][rupture]:
-                    site = ses[event_set][rupture][site_key]
-                    site_obj = shapes.Site(site['lon'], site['lat'])
-                    point = image_grid.point_at(site_obj)
-                    gwriter.write((point.row, point.column),
-                        math.exp(float(site['mag'])))
-                    gmf_data[site_obj] = \
-                        {'groundMotion': math.exp(float(site['mag']))}
+                for site, point, value in zip(sites, points, values):
+                    gwriter.write((point.row, point.column), value)
+                    gmf_data[site] = {'groundMotion': value}
 
                 gwriter.close()
                 xmlwriter.serialize(gmf_data)
@@ -624,22 +1279,316 @@ class EventBasedMixin(BasePSHAMixin):
                 files.append(nrml_path)
         return files
 
+    def gmf_output_path(self, filename_part):
+        """Return the path of a GMF output file."""
+        return os.path.join(self.base_path, self['OUTPUT_DIR'],
+                            "gmf-%s" % filename_part)
+
+    def write_gmf_sites_file(self, site_list):
+        """Write the (longitude, latitude) of the sites of the GMF arrays
+        (see write_gmf_set_files) in a numpy file, return its path."""
+        path = self.gmf_output_path("sites.npy")
+        numpy.save(path, numpy.array(
+            [(site.longitude, site.latitude) for site in site_list]))
+        return path
+
+    def write_gmf_set_files(self, stochastic_set_id):
+        """Generate a GeoTiff file with a band per GMF of a stochastic event
+        set, and a numpy file with a (ruptures x sites) array of their
+        ground motion values, the sites being those of the sites file.
+        Both are written rupture by rupture, reading the GMFs by chunks."""
+
+        LOG.info("Writing output for ses %s" % stochastic_set_id)
+
+        sites = gmf.load_sites(self.id)
+        points = [self.region.grid.point_at(site) for site in sites]
+        cells = [(point.row, point.column) for point in points]
+        ruptures = gmf.ruptures_count(self.id, stochastic_set_id)
+        if not ruptures:
+            return []
+
+        common_path = self.gmf_output_path(
+            stochastic_set_id.replace("!", "_"))
+        tiff_path = "%s.tiff" % common_path
+        array_path = "%s.npy" % common_path
+
+        gwriter = geotiff.GMFSetGeoTiffFile(tiff_path, self.region.grid,
+                                            ruptures)
+        array = numpy.lib.format.open_memmap(array_path, mode='w+',
+            dtype=gmf.DTYPE, shape=(ruptures, len(sites)))
+
+        for start in xrange(0, ruptures, gmf.RUPTURES_PER_READ):
+            rupture_indexes = range(
+                start, min(start + gmf.RUPTURES_PER_READ, ruptures))
+            ground_motions = numpy.exp(gmf.load_ruptures(
+                self.id, stochastic_set_id, rupture_indexes).astype(float))
+
+            for rupture, values in zip(rupture_indexes, ground_motions):
+                gwriter.write_band(rupture + 1, cells, values)
+            array[start:start + len(rupture_indexes)] = ground_motions
+            array.flush()
+
+        gwriter.close()
+        del array
+        return [tiff_path, array_path]
+
+    def gmf_statistics_thresholds(self):
+        """Return the thresholds whose exceedances are counted by the GMF
+        statistics, i.e. INTENSITY_MEASURE_LEVELS."""
+        return [float(param) for param
+                in self.params['INTENSITY_MEASURE_LEVELS'].split(",")]
+
+    def gmf_statistics_percentiles(self):
+        """Return the percentiles (as fractions) of GMF_SUMMARY_PERCENTILES,
+        given separated by spaces."""
+        return [float(param) for param
+                in self.params.get('GMF_SUMMARY_PERCENTILES', '').split()]
+
+    def update_gmf_statistics(self, stochastic_set_id):
+        """Add the GMFs of a stochastic event set to the statistics of
+        the sites, reading them by chunks."""
+        ruptures = gmf.ruptures_count(self.id, stochastic_set_id)
+        for start in xrange(0, ruptures, gmf.RUPTURES_PER_READ):
+            self.gmf_statistics.update(gmf.load_ruptures(
+                self.id, stochastic_set_id,
+                range(start, min(start + gmf.RUPTURES_PER_READ, ruptures))))
+
+    def write_gmf_statistics_files(self):
+        """Write the statistics of the GMFs of all the stochastic event
+        sets: a GeoTiff file with a band per statistic (maximum, mean,
+        GMF_SUMMARY_PERCENTILES, then the number of exceedances of each
+        of INTENSITY_MEASURE_LEVELS) and a NRML file with the ground
+        motion values of the maximum, the mean and each percentile.
+        Return the paths of the files."""
+
+        LOG.info("Writing the statistics of %s GMFs"
+                 % self.gmf_statistics.count)
+
+        sites = gmf.load_sites(self.id)
+        cells = [(point.row, point.column) for point
+                 in [self.region.grid.point_at(site) for site in sites]]
+
+        fields = [("max", self.gmf_statistics.maximum),
+                  ("mean", self.gmf_statistics.mean())]
+        fields.extend(("percentile-%s" % percentile,
+                       self.gmf_statistics.percentile(percentile))
+                      for percentile in self.gmf_statistics_percentiles())
+
+        tiff_path = self.gmf_output_path("statistics.tiff")
+        gwriter = geotiff.GMFSetGeoTiffFile(tiff_path, self.region.grid,
+            len(fields) + len(self.gmf_statistics.thresholds))
+        for band, (_name, values) in enumerate(fields):
+            gwriter.write_band(band + 1, cells, values)
+        for threshold_index in xrange(len(self.gmf_statistics.thresholds)):
+            gwriter.write_band(len(fields) + threshold_index + 1, cells,
+                self.gmf_statistics.exceedances[:, threshold_index])
+        gwriter.close()
+
+        files = [tiff_path]
+        for (name, values) in fields:
+            nrml_path = self.gmf_output_path("%s.xml" % name)
+            hazard_output.GMFXMLWriter(nrml_path).serialize(
+                [(site, {'groundMotion': value})
+                 for site, value in zip(sites, values)])
+            files.append(nrml_path)
+        return files
+
+    @preload
+    def compute_stochastic_event_set(self, stochastic_set_id, seed):
+        """Sample the ruptures of a stochastic event set, with their
+        inter-event residuals, runs on the workers."""
+        java.jclass("HazardCalculator").sampleAndSaveStochasticEventSet(
+                self.cache, self.stochastic_set_key(
+                    kvs.tokens.STOCHASTIC_SET_RUPTURES_TOKEN,
+                    stochastic_set_id),
+                self.generate_erf(key=self.stochastic_set_key(
+                    kvs.tokens.SOURCE_MODEL_TOKEN, stochastic_set_id)),
+                self.generate_gmpe_map(self.stochastic_set_key(
+                    kvs.tokens.GMPE_TOKEN, stochastic_set_id)),
+                java.jclass("Random")(seed))
+
     @preload
-    def compute_ground_motion_fields(self, site_list, stochastic_set_id, seed):
-        """Ground motion field calculation, runs on the workers."""
+    def compute_ground_motion_fields(self, site_list, stochastic_set_id, seed,
+                                     block_index=0, first_site_id=0):
+        """Ground motion field calculation for a block of sites of a
+        stochastic event set, runs on the workers.
+
+        first_site_id is the index of the first site of the block among
+        all the sites of the job, where the fields of the block are stored
+        in the arrays of the ruptures (see openquake.hazard.gmf). The
+        residuals of each rupture are drawn from its random stream at the
+        position of the sites, and the inter-event residual of each
+        rupture, sampled with the event set, is shared by all the blocks.
+        With GROUND_MOTION_CORRELATION, the intra-event residuals are
+        correlated only among the sites of the block."""
         jpype = java.jvm()
 
         jsite_list = self.parameterize_sites(site_list)
-        key = kvs.generate_product_key(
-            self.id, kvs.tokens.STOCHASTIC_SET_TOKEN, stochastic_set_id)
         gmc = self.params['GROUND_MOTION_CORRELATION']
         correlate = (gmc == "true" and True or False)
-        java.jclass("HazardCalculator").generateAndSaveGMFs(
-                self.cache, key, stochastic_set_id, jsite_list,
-                 self.generate_erf(),
-                self.generate_gmpe_map(),
-                java.jclass("Random")(seed),
+        statistics = java.jclass("HazardCalculator") \
+            .getBlockGroundMotionStatistics(
+                self.cache, self.stochastic_set_key(
+                    kvs.tokens.STOCHASTIC_SET_RUPTURES_TOKEN,
+                    stochastic_set_id), jsite_list,
+                self.generate_erf(key=self.stochastic_set_key(
+                    kvs.tokens.SOURCE_MODEL_TOKEN, stochastic_set_id)),
+                self.generate_gmpe_map(self.stochastic_set_key(
+                    kvs.tokens.GMPE_TOKEN, stochastic_set_id)),
                 jpype.JBoolean(correlate))
+        statistics = numpy.array(statistics[:]).reshape(
+            (-1, len(site_list), 3))
+
+        event_set = gmf.load_event_set(self.id, stochastic_set_id)
+        truncation_level = float(self.params['TRUNCATION_LEVEL'])
+        deviates = numpy.array([gmf.residuals(seed, stochastic_set_id,
+                rupture_index, first_site_id, len(site_list),
+                truncation_level, self.params['GMPE_TRUNCATION_TYPE'])
+            for rupture_index in xrange(len(event_set))])
+
+        factor = None
+        if correlate and len(event_set):
+            factor = self.correlation_factor(site_list)
+
+        gmf.store_block(self.id, stochastic_set_id, first_site_id,
+            gmf.ground_motion_fields(statistics,
+                [occurrence[2] for occurrence in event_set],
+                deviates.reshape((-1, len(site_list))), factor))
+
+    def correlation_factor(self, site_list):
+        """Return the factor of the correlation matrix of the intra-event
+        residuals at the given sites (see gmf.correlation_factor).
+
+        The matrix only depends on the distances between the sites and on
+        the intensity measure type, so the factor is cached on the worker
+        and computed once for all the ruptures of all the stochastic event
+        sets of a block."""
+
+        period = 0.0
+        if self.params['INTENSITY_MEASURE_TYPE'] == 'SA':
+            period = float(self.params['PERIOD'])
+
+        cache_key = _site_list_cache_key(site_list,
+            (self.params['INTENSITY_MEASURE_TYPE'], period))
+        factor = CORRELATION_FACTOR_CACHE.get(cache_key)
+
+        if factor is None:
+            factor = gmf.correlation_factor(site_list, period)
+
+            if len(CORRELATION_FACTOR_CACHE) >= CORRELATION_FACTOR_CACHE_SIZE:
+                CORRELATION_FACTOR_CACHE.clear()
+            CORRELATION_FACTOR_CACHE[cache_key] = factor
+
+        return factor
+
+
+class GMFTasks(object):
+    """The ground motion field tasks of an event based job.
+
+    For each stochastic event set, a first task samples its ruptures,
+    then a task per block of sites computes their ground motion fields.
+    At most max_in_flight tasks run at the same time, and the tasks of the
+    blocks of the sets already sampled are dispatched before new sets
+    are started. The tasks of the blocks all get the seed of the job, from
+    which the random streams of the residuals are derived."""
+
+    def __init__(self, job_id, blocks, max_in_flight, seed):
+        if max_in_flight < 1:
+            raise ValueError("GMF_TASKS_IN_FLIGHT must be at least 1, "
+                             "got %s" % max_in_flight)
+
+        self.job_id = job_id
+        self.blocks = blocks
+        self.max_in_flight = max_in_flight
+        self.seed = seed
+
+        # (stochastic set id, block index or None, task)
+        self.in_flight = []
+        # (stochastic set id, block index) of the blocks to dispatch
+        self.waiting = collections.deque()
+        self.remaining_blocks = {}
+
+    def full(self):
+        """Dispatch the waiting blocks and return true if no more tasks
+        can be dispatched."""
+        while self.waiting and len(self.in_flight) < self.max_in_flight:
+            (stochastic_set_id, block_index) = self.waiting.popleft()
+            self.in_flight.append((stochastic_set_id, block_index,
+                self.dispatch_block(stochastic_set_id, block_index)))
+        return len(self.in_flight) >= self.max_in_flight
+
+    def pending(self):
+        """Return true if some tasks are still to be completed."""
+        return bool(self.in_flight or self.waiting)
+
+    def add(self, stochastic_set_id, seed):
+        """Dispatch the tasks of a stochastic event set, whose ruptures are
+        sampled with the given seed."""
+        self.in_flight.append((stochastic_set_id, None,
+            self.dispatch_event_set(stochastic_set_id, seed)))
+
+    def wait(self):
+        """Wait until at least one of the tasks in flight is completed.
+        Return the ids of the stochastic sets whose tasks are all
+        completed."""
+
+        self.full()
+        while True:
+            finished = [entry for entry in self.in_flight if entry[2].ready()]
+            if finished:
+                break
+            time.sleep(GMF_TASKS_POLL_INTERVAL)
+
+        completed = []
+        for entry in finished:
+            self.in_flight.remove(entry)
+            (stochastic_set_id, block_index, task) = entry
+            if task.status != 'SUCCESS':
+                raise Exception(task.result)
+
+            if block_index is None:
+                self.remaining_blocks[stochastic_set_id] = len(self.blocks)
+                self.waiting.extend((stochastic_set_id, block_index)
+                    for block_index in xrange(len(self.blocks)))
+            else:
+                self.remaining_blocks[stochastic_set_id] -= 1
+                if not self.remaining_blocks[stochastic_set_id]:
+                    del self.remaining_blocks[stochastic_set_id]
+                    completed.append(stochastic_set_id)
+
+        return completed
+
+    def dispatch_event_set(self, stochastic_set_id, seed):
+        """Return the task sampling the ruptures of a stochastic set."""
+        return tasks.compute_stochastic_event_set.delay(
+            self.job_id, stochastic_set_id, seed)
+
+    def dispatch_block(self, stochastic_set_id, block_index):
+        """Return the task computing the ground motion fields of a block
+        of sites of a stochastic set."""
+        first_site_id = sum(len(block) for block
+                            in self.blocks[:block_index])
+        return tasks.compute_ground_motion_fields.delay(self.job_id,
+            self.blocks[block_index], stochastic_set_id, self.seed,
+            block_index, first_site_id)
+
+
+def sites_bounds(site_list):
+    """Return the bounding box (min_lon, min_lat, max_lon, max_lat)
+    of the given list of sites."""
+    lons = [site.longitude for site in site_list]
+    lats = [site.latitude for site in site_list]
+    return (min(lons), min(lats), max(lons), max(lats))
+
+
+def _site_list_cache_key(site_list, site_params):
+    """Return the key used to cache data of a list of sites (e.g. its
+    Java version) computed with the given parameters."""
+    digest = hashlib.sha1()
+    for site in site_list:
+        digest.update("%r,%r;" % (site.longitude, site.latitude))
+    digest.update(repr(site_params))
+    return digest.hexdigest()
 
 
 def gmf_id(history_idx, realization_idx, rupture_idx):
@@ -647,11 +1596,49 @@ def gmf_id(history_idx, realization_idx, rupture_idx):
     return "%s!%s!%s" % (history_idx, realization_idx, rupture_idx)
 
 
+def intensity_measures(params):
+    """Return the intensity measure types computed by a job as a list of
+    (IMT, period, IMLs) tuples. The first one is INTENSITY_MEASURE_TYPE,
+    followed by those in ADDITIONAL_INTENSITY_MEASURE_TYPES, given as
+    "IMT [PERIOD]: IML, IML, ..." and separated by "|"."""
+    measures = [(params['INTENSITY_MEASURE_TYPE'], float(params['PERIOD']),
+                 [float(val) for val
+                  in params['INTENSITY_MEASURE_LEVELS'].split(",")])]
+
+    for entry in params.get('ADDITIONAL_INTENSITY_MEASURE_TYPES',
+                            '').split("|"):
+        if not entry.strip():
+            continue
+        (imt_and_period, _sep, levels) = entry.partition(":")
+        fields = imt_and_period.split()
+        if (len(fields) not in (1, 2) or fields[0] not in IML_SCALING
+            or not levels.strip()):
+            raise ValueError(
+                "Invalid additional intensity measure type: %r" % entry)
+        period = 0.0
+        if len(fields) == 2:
+            period = float(fields[1])
+        measures.append((fields[0], period,
+                         [float(val) for val in levels.split(",")]))
+    return measures
+
+
+def imt_id(imt, period):
+    """ Return an id of an intensity measure type suitable for use in KVS
+    keys and file names """
+    return "%s-%s" % (imt, period)
+
+
 def _is_realization_hazard_curve_key(kvs_key):
     return (tokens.extract_product_type_from_kvs_key(kvs_key) == \
                 tokens.HAZARD_CURVE_KEY_TOKEN)
 
 
+def _is_imt_hazard_curve_key(kvs_key):
+    return (tokens.extract_product_type_from_kvs_key(kvs_key) == \
+                tokens.IMT_HAZARD_CURVE_KEY_TOKEN)
+
+
 def _is_mean_hazard_curve_key(kvs_key):
     return (tokens.extract_product_type_from_kvs_key(kvs_key) == \
                 tokens.MEAN_HAZARD_CURVE_KEY_TOKEN)
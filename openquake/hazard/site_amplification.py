@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+"""
+Rock to site amplification of hazard curves, as a post-processing of
+the reference rock curves computed by classical PSHA.
+
+Amplification factors depend on the intensity measure level. They are
+given for a set of site classes, each identified by its vs30, at the
+levels of INTENSITY_MEASURE_LEVELS. A rock level x with probability of
+exceedance p is moved to the site level x * AF(x), with the same
+probability of exceedance, and the site curve is interpolated back on
+INTENSITY_MEASURE_LEVELS in log-log space.
+
+Curves can be amplified for each site class (the same factors at all the
+sites) or with a map of the vs30 at the sites, in which case the factors
+of each site are interpolated between the site classes in log(vs30).
+"""
+
+import json
+import numpy
+
+from openquake import kvs
+from openquake import shapes
+
+# PoEs are interpolated in log space, zeros are floored to this value
+MIN_POE = 1e-300
+
+
+def parse_amplification_factors(factors, levels_count):
+    """Parse the SITE_AMPLIFICATION_FACTORS parameter, given as
+    "VS30: factor, factor, ..." per site class, separated by "|".
+
+    Return the vs30 of the site classes (in ascending order) and a
+    (site classes x IMLs) array with their amplification factors."""
+
+    classes = []
+    for entry in factors.split("|"):
+        if not entry.strip():
+            continue
+        (vs30, _sep, values) = entry.partition(":")
+        values = [float(x) for x in values.split(",") if x.strip()]
+        if len(values) != levels_count:
+            raise ValueError("Site class %s must have an amplification "
+                             "factor for each of the %s IMLs"
+                             % (vs30.strip(), levels_count))
+        classes.append((float(vs30), values))
+
+    if not classes:
+        raise ValueError("No site amplification factors given")
+
+    classes.sort()
+    return (numpy.array([vs30 for (vs30, _values) in classes]),
+            numpy.array([values for (_vs30, values) in classes]))
+
+
+def parse_vs30_map(text):
+    """Parse a vs30 map, given as "lon lat vs30" lines, into a dictionary
+    of vs30 values keyed by site."""
+
+    vs30_map = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        (lon, lat, vs30) = [float(x) for x in fields]
+        vs30_map[shapes.Site(lon, lat)] = vs30
+    return vs30_map
+
+
+def factors_for_vs30(vs30s, class_vs30s, class_factors):
+    """Return a (sites x IMLs) array with the amplification factors of
+    sites with the given vs30, linearly interpolated in log(vs30) between
+    the site classes. Factors are not extrapolated beyond the site
+    classes with the lowest and highest vs30."""
+
+    log_vs30s = numpy.log(numpy.clip(numpy.asarray(vs30s, dtype=float),
+            class_vs30s[0], class_vs30s[-1]))
+    log_class_vs30s = numpy.log(class_vs30s)
+
+    if len(class_vs30s) == 1:
+        return numpy.tile(class_factors[0], (len(log_vs30s), 1))
+
+    upper = numpy.clip(numpy.searchsorted(log_class_vs30s, log_vs30s),
+            1, len(class_vs30s) - 1)
+    lower = upper - 1
+    weights = ((log_vs30s - log_class_vs30s[lower])
+               / (log_class_vs30s[upper] - log_class_vs30s[lower]))
+
+    return (class_factors[lower] * (1.0 - weights[:, numpy.newaxis])
+            + class_factors[upper] * weights[:, numpy.newaxis])
+
+
+def interpolate_rows(x_values, xp_rows, fp_rows):
+    """Linear interpolation of each row of fp_rows at x_values, the
+    abscissae of each row being the same row of xp_rows (in ascending
+    order). Values outside the abscissae are clamped, as numpy.interp
+    does. Return a (rows x len(x_values)) array."""
+
+    x_values = numpy.asarray(x_values, dtype=float)
+    rows = numpy.arange(xp_rows.shape[0])[:, numpy.newaxis]
+
+    # index of the last abscissa not greater than each value
+    upper = (xp_rows[:, :, numpy.newaxis]
+             <= x_values[numpy.newaxis, numpy.newaxis, :]).sum(axis=1)
+    upper = numpy.clip(upper, 1, xp_rows.shape[1] - 1)
+    lower = upper - 1
+
+    x_lower = xp_rows[rows, lower]
+    x_upper = xp_rows[rows, upper]
+    span = numpy.where(x_upper > x_lower, x_upper - x_lower, 1.0)
+    weights = numpy.clip((x_values - x_lower) / span, 0.0, 1.0)
+
+    return (fp_rows[rows, lower] * (1.0 - weights)
+            + fp_rows[rows, upper] * weights)
+
+
+def amplify_curves(imls, poes, factors):
+    """Amplify a (sites x IMLs) array of rock hazard curves with a
+    (sites x IMLs) array of amplification factors, and return the site
+    hazard curves at the same IMLs."""
+
+    imls = numpy.asarray(imls, dtype=float)
+    poes = numpy.asarray(poes, dtype=float)
+
+    # site levels must be increasing to be interpolated
+    site_log_imls = numpy.maximum.accumulate(
+            numpy.log(imls * factors), axis=1)
+
+    log_poes = interpolate_rows(numpy.log(imls), site_log_imls,
+            numpy.log(numpy.maximum(poes, MIN_POE)))
+
+    return numpy.where(log_poes > numpy.log(MIN_POE),
+            numpy.exp(log_poes), 0.0)
+
+
+def hazard_map(imls, poes, poe):
+    """Return the IMLs with the given probability of exceedance at each
+    site, from a (sites x IMLs) array of hazard curves, interpolating
+    in log-log space."""
+
+    # PoEs decrease with the IML, reverse them to interpolate on PoEs
+    log_poes = numpy.log(numpy.maximum(
+            numpy.asarray(poes, dtype=float)[:, ::-1], MIN_POE))
+    log_imls = numpy.log(numpy.asarray(imls, dtype=float)[::-1])
+
+    return numpy.exp(interpolate_rows([numpy.log(poe)],
+            numpy.maximum.accumulate(log_poes, axis=1),
+            numpy.tile(log_imls, (log_poes.shape[0], 1))))[:, 0]
+
+
+def curves_from_kvs(keys):
+    """Return the sites and a (sites x IMLs) array with the PoEs of the
+    hazard curves stored at the given KVS keys."""
+
+    sites = []
+    poes = []
+    for raw_curve in kvs.get_client(binary=False).mget(keys):
+        curve = json.loads(raw_curve)
+        sites.append(shapes.Site(float(curve["site_lon"]),
+                                 float(curve["site_lat"])))
+        poes.append([float(point["y"]) for point in curve["curve"]])
+    return sites, numpy.array(poes)
@@ -24,6 +24,7 @@
 The following tasks are defined in the hazard engine:
     * generate_erf
     * compute_hazard_curve
+    * compute_hazard_curves_for_gmpe_branches
     * compute_mgm_intensity
 """
 
@@ -59,21 +60,31 @@ def generate_erf(job_id):
     return job_id
 
 @task
-def compute_ground_motion_fields(job_id, site_list, gmf_id, seed):
-    """ Generate ground motion fields """
+def compute_stochastic_event_set(job_id, gmf_id, seed):
+    """ Sample the ruptures of a stochastic event set """
+    hazengine = job.Job.from_kvs(job_id)
+    with mixins.Mixin(hazengine, hazjob.HazJobMixin, key="hazard"):
+        #pylint: disable=E1101
+        hazengine.compute_stochastic_event_set(gmf_id, seed)
+
+
+@task
+def compute_ground_motion_fields(job_id, site_list, gmf_id, seed,
+                                 block_index=0, first_site_id=0):
+    """ Generate ground motion fields for a block of sites """
     # TODO(JMC): Use a block_id instead of a site_list
     hazengine = job.Job.from_kvs(job_id)
     with mixins.Mixin(hazengine, hazjob.HazJobMixin, key="hazard"):
         #pylint: disable=E1101
-        hazengine.compute_ground_motion_fields(site_list, gmf_id, seed)
+        hazengine.compute_ground_motion_fields(site_list, gmf_id, seed,
+                                               block_index, first_site_id)
 
 
-def write_out_ses(job_file, stochastic_set_key):
+def write_out_ses(job_file, stochastic_set_id):
     """ Write out Stochastic Event Set """
     hazengine = job.Job.from_file(job_file)
     with mixins.Mixin(hazengine, hazjob.HazJobMixin, key="hazard"):
-        ses = kvs.get_value_json_decoded(stochastic_set_key)
-        hazengine.write_gmf_files(ses) #pylint: disable=E1101
+        hazengine.write_gmf_files(stochastic_set_id) #pylint: disable=E1101
 
 @task
 def compute_hazard_curve(job_id, site_list, realization, callback=None):
@@ -87,6 +98,17 @@ def compute_hazard_curve(job_id, site_list, realization, callback=None):
 
         return keys
 
+@task
+def compute_hazard_curves_for_gmpe_branches(job_id, site_list, realizations,
+                                            gmpe_keys):
+    """ Generate hazard curves for a given site list, for the stored
+    source model and several GMPE logic tree end branches. """
+    hazengine = job.Job.from_kvs(job_id)
+    with mixins.Mixin(hazengine, hazjob.HazJobMixin, key="hazard"):
+        #pylint: disable=E1101
+        return hazengine.compute_hazard_curves_for_gmpe_branches(
+            site_list, realizations, gmpe_keys)
+
 @task
 def compute_mgm_intensity(job_id, block_id, site_id):
     """
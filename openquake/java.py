@@ -40,6 +40,7 @@ JAVA_CLASSES = {
     "Random" : "java.util.Random",
     "GEM1ERF" : "org.gem.engine.hazard.GEM1ERF",
     "HazardCalculator" : "org.gem.calc.HazardCalculator",
+    "SourceFilter" : "org.gem.calc.SourceFilter",
     "Properties" : "java.util.Properties",
     "CalculatorConfigHelper" : "org.gem.engine.CalculatorConfigHelper",
     "Configuration" : "org.apache.commons.configuration.Configuration",
@@ -23,6 +23,7 @@
 
 import hashlib
 import os
+import random
 import re
 import urlparse
 
@@ -32,6 +33,7 @@ from openquake import flags
 from openquake import kvs
 from openquake import shapes
 from openquake.logs import LOG
+from openquake.job import checkpoint
 from openquake.job.handlers import resolve_handler
 from openquake.job.mixins import Mixin
 from openquake.parser import exposure
@@ -59,6 +61,35 @@ def run_job(job_file):
             print filepath
 
 
+def resume_job(job_id, additional_realizations=0):
+    """ Given the id of an interrupted job, run it again from the KVS,
+    skipping the work units it already completed.
+
+    If additional_realizations is given, a finished classical job is
+    extended with that number of further logic tree samples. """
+    a_job = Job.for_resume(job_id)
+    if a_job is None:
+        LOG.critical("Job %s not found in the KVS, aborting." % job_id)
+        return
+
+    if additional_realizations:
+        try:
+            a_job.add_realizations(additional_realizations)
+        except ValueError, e:
+            LOG.critical("Job %s cannot be extended: %s" % (job_id, e))
+            return
+
+    LOG.info("Resuming job %s, %s work units already completed"
+             % (job_id, checkpoint.done_units(job_id)))
+    results = a_job.launch()
+    if not results:
+        LOG.critical("The job configuration is inconsistent, "
+                "aborting computation.")
+    else:
+        for filepath in results:
+            print filepath
+
+
 def parse_config_file(config_file):
     """
     We have a single configuration file which may contain a risk section and
@@ -144,6 +175,22 @@ class Job(object):
         params = kvs.get_value_json_decoded(kvs.generate_job_key(job_id))
         return Job(params, job_id)
 
+    @staticmethod
+    def for_resume(job_id):
+        """Return the job in the underlying kvs system with the given id,
+        ready to be launched again, or None if it doesn't exist."""
+
+        params = kvs.get_value_json_decoded(kvs.generate_job_key(job_id))
+        if not params:
+            return None
+
+        sections = kvs.get_value_json_decoded(
+                kvs.tokens.job_sections_key(job_id)) or []
+        job = Job(params, job_id, sections=sections)
+        # the input files have already been stored in kvs
+        job.base_path = params['BASE_PATH']  # pylint: disable=W0201
+        return job
+
     @staticmethod
     def from_file(config_file):
         """ Create a job from external configuration files. """
@@ -335,6 +382,51 @@ class Job(object):
             self._write_super_config()
         key = kvs.generate_job_key(self.job_id)
         kvs.set_value_json_encoded(key, self.params)
+        kvs.set_value_json_encoded(
+                kvs.tokens.job_sections_key(self.job_id), self.sections)
+
+    def random_seed(self, name):
+        """Return the random seed given by the parameter name. If the
+        parameter is not set, a seed is drawn and stored in the parameters
+        of the job in kvs, so that a resumed job uses the same seed."""
+
+        if not self.has(name):
+            self.params[name] = str(random.getrandbits(32))
+            kvs.set_value_json_encoded(
+                    kvs.generate_job_key(self.job_id), self.params)
+
+        return self.params[name]
+
+    def add_realizations(self, count):
+        """Extend a classical job with count further logic tree samples.
+
+        The logic tree streams of the job must be seeded (seeds drawn for
+        a job are stored with it when it is first launched), so that the
+        samples already computed are drawn again in the same order and
+        skipped, and the new ones continue the streams. The statistics and
+        the risk of the job are marked to be computed again."""
+
+        mode = self.params.get('HAZARD_CALCULATION_MODE', '')
+        if mode not in ('Classical', 'Classical NumPy'):
+            raise ValueError("only classical jobs can be extended")
+        if self.params.get('ENUMERATE_LOGIC_TREES',
+                           'false').lower() == 'true':
+            raise ValueError("all the logic tree end branches are "
+                             "already computed")
+        for name in ('SOURCE_MODEL_LT_RANDOM_SEED', 'GMPE_LT_RANDOM_SEED'):
+            if not self.has(name):
+                raise ValueError("%s is not set, the samples already "
+                                 "computed cannot be drawn again" % name)
+
+        samples = int(self.params['NUMBER_OF_LOGIC_TREE_SAMPLES']) + count
+        self.params['NUMBER_OF_LOGIC_TREE_SAMPLES'] = str(samples)
+        kvs.set_value_json_encoded(
+                kvs.generate_job_key(self.job_id), self.params)
+
+        checkpoint.forget(self.job_id, checkpoint.HAZARD_STATISTICS)
+        checkpoint.forget(self.job_id, checkpoint.RISK)
+        LOG.info("Extending job %s to %s logic tree samples"
+                 % (self.job_id, samples))
 
     def sites_for_region(self):
         """Return the list of sites for the region at hand."""
@@ -344,6 +436,49 @@ class Job(object):
         region.cell_size = float(self.params['REGION_GRID_SPACING'])
         return [site for site in region]
 
+    def sites_to_compute(self):
+        """Return the list of sites where hazard has to be computed.
+
+        These are all the nodes of the region grid, unless
+        HAZARD_SITES_FROM_EXPOSURE is set and the job has an exposure. In
+        that case only the nodes of the cells containing at least one
+        asset are computed, plus the nodes within HAZARD_SITES_BUFFER cells
+        from them, each node only once."""
+
+        from_exposure = self.params.get('HAZARD_SITES_FROM_EXPOSURE', 'false')
+        if from_exposure.lower() != 'true' or not self.has(EXPOSURE):
+            return self.sites_for_region()
+
+        grid = self.region.grid
+        buffer_cells = int(self.params.get('HAZARD_SITES_BUFFER', 0))
+
+        exposure_points = set()
+        for site in self._read_sites_from_exposure():
+            point = grid.point_at(site)
+            exposure_points.add((point.row, point.column))
+
+        points = set()
+        for (row, column) in exposure_points:
+            for buffer_row in xrange(max(row - buffer_cells, 0),
+                                     min(row + buffer_cells + 1, grid.rows)):
+                for buffer_column in xrange(max(column - buffer_cells, 0),
+                        min(column + buffer_cells + 1, grid.columns)):
+                    points.add((buffer_row, buffer_column))
+
+        sites = []
+        # same order of the region grid
+        for (row, column) in sorted(points):
+            point = shapes.GridPoint(grid, column, row)
+            try:
+                grid.check_gridpoint(point)
+            except shapes.BoundsException:
+                continue
+            sites.append(point.site)
+
+        LOG.debug("Computing hazard at %s grid nodes for %s exposure cells"
+                  % (len(sites), len(exposure_points)))
+        return sites
+
 
 class AlwaysTrueConstraint():
     """ A stubbed constraint for block splitting """
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+"""
+Ledger of the work units completed by a job.
+
+A work unit is identified by the stage of the computation (e.g. hazard
+curves, risk), a realization and a block. Units are recorded in the KVS
+as soon as their results are stored, so that an interrupted job can be
+resumed dispatching only the missing ones.
+"""
+
+from openquake import kvs
+
+HAZARD_CURVES = "hazard_curves"
+HAZARD_STATISTICS = "hazard_statistics"
+STOCHASTIC_SET = "ses"
+GMF_TRANSPOSE = "gmf_transpose"
+EXPOSURE = "exposure"
+RISK = "risk"
+
+
+def _unit(stage, realization, block_id):
+    """Return the ledger entry of a work unit."""
+    return kvs.generate_key([stage, realization, block_id])
+
+
+def mark_done(job_id, stage, realization="", block_id=""):
+    """Record a work unit as completed."""
+    kvs.get_client(binary=False).sadd(kvs.tokens.checkpoint_key(job_id),
+            _unit(stage, realization, block_id))
+
+
+def is_done(job_id, stage, realization="", block_id=""):
+    """Return true if the work unit has already been completed."""
+    return bool(kvs.get_client(binary=False).sismember(
+            kvs.tokens.checkpoint_key(job_id),
+            _unit(stage, realization, block_id)))
+
+
+def forget(job_id, stage):
+    """Remove from the ledger all the completed work units of a stage,
+    so that they are computed again."""
+    client = kvs.get_client(binary=False)
+    key = kvs.tokens.checkpoint_key(job_id)
+
+    for unit in client.smembers(key):
+        if unit.split(kvs.KVS_KEY_SEPARATOR)[0] == stage:
+            client.srem(key, unit)
+
+
+def done_units(job_id):
+    """Return the number of work units completed by a job."""
+    return kvs.get_client(binary=False).scard(
+            kvs.tokens.checkpoint_key(job_id))
@@ -22,6 +22,10 @@
 
 import openquake.kvs
 
+# job tokens
+CHECKPOINT_TOKEN = 'checkpoint'
+JOB_SECTIONS_TOKEN = 'sections'
+
 # hazard tokens
 SOURCE_MODEL_TOKEN = 'sources'
 GMPE_TOKEN = 'gmpe'
@@ -31,11 +35,19 @@ MGM_KEY_TOKEN = 'mgm'
 HAZARD_CURVE_KEY_TOKEN = 'hazard_curve'
 MEAN_HAZARD_CURVE_KEY_TOKEN = 'mean_hazard_curve'
 QUANTILE_HAZARD_CURVE_KEY_TOKEN = 'quantile_hazard_curve'
+IMT_HAZARD_CURVE_KEY_TOKEN = 'imt_hazard_curve'
 STOCHASTIC_SET_TOKEN = 'ses'
+STOCHASTIC_SET_RUPTURES_TOKEN = 'ses_ruptures'
+GMF_SITES_TOKEN = 'gmf_sites'
+GMF_RUPTURE_TOKEN = 'ses_gmf'
+GMF_SITE_TOKEN = 'site_gmf'
 MEAN_HAZARD_MAP_KEY_TOKEN = 'mean_hazard_map'
 QUANTILE_HAZARD_MAP_KEY_TOKEN = 'quantile_hazard_map'
+AMPLIFIED_HAZARD_CURVE_KEY_TOKEN = 'amplified_hazard_curve'
+REALIZATION_WEIGHTS_TOKEN = 'realization_weights'
 
 # risk tokens
+AGGREGATE_LOSSES_KEY_TOKEN = 'AGGREGATE_LOSSES'
 CONDITIONAL_LOSS_KEY_TOKEN = 'LOSS_AT_'
 EXPOSURE_KEY_TOKEN = 'ASSET'
 GMF_KEY_TOKEN = 'GMF'
@@ -50,6 +62,16 @@ def loss_token(poe):
     return "%s%s" % (CONDITIONAL_LOSS_KEY_TOKEN, str(poe))
 
 
+def checkpoint_key(job_id):
+    """Return the key used to store the work units completed by a job."""
+    return openquake.kvs.generate_product_key(job_id, CHECKPOINT_TOKEN)
+
+
+def job_sections_key(job_id):
+    """Return the key used to store the config sections of a job."""
+    return openquake.kvs.generate_product_key(job_id, JOB_SECTIONS_TOKEN)
+
+
 def vuln_key(job_id):
     """Generate the key used to store vulnerability curves."""
     return openquake.kvs.generate_product_key(job_id, "VULN_CURVES")
@@ -73,6 +95,13 @@ def loss_curve_key(job_id, row, col, asset_id):
             LOSS_CURVE_KEY_TOKEN, asset_id])
 
 
+def aggregate_losses_key(job_id, row, col):
+    """ Return the key of the losses per event of the assets of a grid
+    point, summed for the aggregate loss curve """
+    return openquake.kvs.generate_product_key(job_id,
+            AGGREGATE_LOSSES_KEY_TOKEN, row, col)
+
+
 def loss_key(job_id, row, col, asset_id, poe):
     """ Return a loss key generated by openquake.kvs.generate_key """
     return openquake.kvs.generate_key([job_id, row, col, loss_token(poe),
@@ -111,6 +140,14 @@ def quantile_hazard_map_key(job_id, site, poe, quantile):
             str(poe), str(quantile)])
 
 
+def amplified_hazard_curve_key(job_id, site_class, statistics, site):
+    """Return the key used to store a hazard curve amplified for a site
+    class (or vs30 map), for a single site. statistics is either 'mean'
+    or the quantile value."""
+    return openquake.kvs.generate_key([AMPLIFIED_HAZARD_CURVE_KEY_TOKEN,
+            job_id, site_class, statistics, site.longitude, site.latitude])
+
+
 def quantile_value_from_hazard_curve_key(kvs_key):
     """Extract quantile value from a KVS key for a quantile hazard curve."""
     if extract_product_type_from_kvs_key(kvs_key) == \
@@ -147,6 +184,13 @@ def poe_value_from_hazard_map_key(kvs_key):
         return None
 
 
+def realization_weights_key(job_id):
+    """Return the key used to store the weights of the realizations
+    of a job, when the logic trees are enumerated."""
+    return openquake.kvs.generate_product_key(job_id,
+            REALIZATION_WEIGHTS_TOKEN)
+
+
 def hazard_curve_key(job_id, realization_num, site_lon, site_lat):
     """ Result a hazard curve key (for a single site) generated by
     openquake.kvs.generate_key """
@@ -157,10 +201,34 @@ def hazard_curve_key(job_id, realization_num, site_lon, site_lat):
                                        site_lat])
 
 
+def imt_hazard_curve_key(job_id, imt, realization_num, site_lon, site_lat):
+    """ Result the key of a hazard curve (for a single site) of one of the
+    additional intensity measure types of a job """
+    return openquake.kvs.generate_key([IMT_HAZARD_CURVE_KEY_TOKEN,
+                                       job_id,
+                                       realization_num,
+                                       site_lon,
+                                       site_lat,
+                                       imt])
+
+
+def imt_value_from_hazard_curve_key(kvs_key):
+    """Extract the intensity measure type (as string) from a KVS key
+    for a hazard curve of an additional intensity measure type."""
+    if extract_product_type_from_kvs_key(kvs_key) == \
+        IMT_HAZARD_CURVE_KEY_TOKEN:
+        (_part_before, _sep, imt_str) = kvs_key.rpartition(
+            openquake.kvs.KVS_KEY_SEPARATOR)
+        return imt_str
+    else:
+        return None
+
+
 def realization_value_from_hazard_curve_key(kvs_key):
     """Extract realization value (as string) from a KVS key
     for a hazard curve."""
-    if extract_product_type_from_kvs_key(kvs_key) == HAZARD_CURVE_KEY_TOKEN:
+    if extract_product_type_from_kvs_key(kvs_key) in (
+        HAZARD_CURVE_KEY_TOKEN, IMT_HAZARD_CURVE_KEY_TOKEN):
 
         # the realization is the third component of the key, after product
         # token and job ID
@@ -120,7 +120,10 @@ class GeoTiffFile(writer.FileWriter):
             pixel_type = gdal.GDT_Byte
         self.target = driver.Create(self.path, self.grid.columns,
             self.grid.rows, TIFF_BAND, pixel_type)
+        self._set_georeference()
 
+    def _set_georeference(self):
+        """Set the geo transform and the spatial reference of the image."""
         corner = self.grid.region.upper_left_corner
 
         # this is the order of arguments to SetGeoTransform()
@@ -203,6 +206,39 @@ class GeoTiffFile(writer.FileWriter):
         self.close()
 
 
+class GMFSetGeoTiffFile(GeoTiffFile):
+    """Writes the ground motion fields of a stochastic event set as a
+    single float32 GeoTIFF, with one band per rupture. Each band is
+    written as soon as it is given, so that only one raster is kept in
+    memory. No HTML wrapper is generated."""
+
+    def __init__(self, path, image_grid, bands, init_value=0.0):
+        self.bands = bands
+        super(GMFSetGeoTiffFile, self).__init__(path, image_grid,
+            init_value=init_value, html_wrapper=False)
+        self.init_value = init_value
+
+    def _init_file(self):
+        driver = gdal.GetDriverByName(self.format)
+        self.target = driver.Create(self.path, self.grid.columns,
+            self.grid.rows, self.bands, GDAL_PIXEL_DATA_TYPE)
+        self._set_georeference()
+
+    def write_band(self, band, cells, values):
+        """Write the band of a rupture (starting from 1), given the
+        (row, column) cells of the sites and their ground motion values.
+        Cells without a value are set to init_value."""
+        self.raster.fill(self.init_value)
+        if len(cells):
+            (rows, columns) = zip(*cells)
+            self.raster[list(rows), list(columns)] = values
+        self.target.GetRasterBand(band).WriteArray(self.raster)
+
+    def close(self):
+        """Flush the file."""
+        self.target = None
+
+
 class MapGeoTiffFile(GeoTiffFile):
     """ Write RGBA geotiff images for loss/hazard maps. Color scale is from
     0(0x00)-100(0xff). In addition, we write out an HTML wrapper around
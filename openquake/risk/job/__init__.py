@@ -26,10 +26,12 @@ import os
 
 from openquake.output import geotiff
 from openquake import job
+from openquake.job import checkpoint
 from openquake.job import mixins
 from openquake import kvs
 from openquake import logs
 from openquake import shapes
+from openquake.hazard import gmf
 from openquake.output import curve
 from openquake.output import risk as risk_output
 from openquake.parser import exposure
@@ -46,7 +48,10 @@ def preload(fn):
     def preloader(self, *args, **kwargs):
         """A decorator for preload steps that must run on the Jobber"""
 
-        self.store_exposure_assets()
+        # the exposure is parsed only once per job
+        if not checkpoint.is_done(self.id, checkpoint.EXPOSURE):
+            self.store_exposure_assets()
+            checkpoint.mark_done(self.id, checkpoint.EXPOSURE)
         self.store_vulnerability_model()
 
         return fn(self, *args, **kwargs)
@@ -108,15 +113,27 @@ def compute_risk(job_id, block_id, **kwargs):
         mixed.compute_risk(block_id, **kwargs)
 
 
+@task
+def transpose_gmfs(job_id, stochastic_set_id, offset):
+    """ A task for copying the GMFs of a stochastic event set to the site
+    major arrays read by the risk blocks """
+    gmf.transpose_stochastic_set(job_id, stochastic_set_id, offset)
+
+
 class RiskJobMixin(mixins.Mixin):
     """ A mixin proxy for Risk jobs """
     mixins = {}
 
     def store_exposure_assets(self):
-        """ Load exposure assets and write to kvs """
+        """ Load exposure assets and write to kvs
+
+        The asset lists of the grid points are replaced in a single
+        transaction, so storing the assets again (e.g. when a job is
+        resumed) does not duplicate them. """
         exposure_parser = exposure.ExposurePortfolioFile("%s/%s" %
             (self.base_path, self.params[job.EXPOSURE]))
 
+        assets = {}
         for site, asset in exposure_parser.filter(self.region):
             # TODO(JMC): This is kludgey
             asset['lat'] = site.latitude
@@ -124,7 +141,15 @@ class RiskJobMixin(mixins.Mixin):
             gridpoint = self.region.grid.point_at(site)
             asset_key = kvs.tokens.asset_key(self.id, gridpoint.row,
                 gridpoint.column)
-            kvs.get_client().rpush(asset_key, json.JSONEncoder().encode(asset))
+            assets.setdefault(asset_key, []).append(
+                json.JSONEncoder().encode(asset))
+
+        pipe = kvs.get_client().pipeline()
+        for asset_key, encoded_assets in assets.items():
+            pipe.delete(asset_key)
+            for encoded_asset in encoded_assets:
+                pipe.rpush(asset_key, encoded_asset)
+        pipe.execute()
 
     def store_vulnerability_model(self):
         """ load vulnerability and write to kvs """
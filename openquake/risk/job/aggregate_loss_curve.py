@@ -24,6 +24,7 @@ Module to compute and plot an aggregate loss curve.
 
 import os
 
+from openquake.job import Block
 from openquake.logs import LOG
 from openquake.output import curve
 from openquake.risk import probabilistic_event_based as prob
@@ -51,11 +52,24 @@ def _for_plotting(loss_curve, time_span):
     return data
 
 
+def _grid_points(job):
+    """Return the (row, column) of the grid points of the blocks of the
+    job, each point once even if its sites are split across blocks."""
+    points = []
+    used_points = set()
+    for block_id in job.blocks_keys:
+        for point in Block.from_kvs(block_id).grid(job.region):
+            if (point.row, point.column) not in used_points:
+                used_points.add((point.row, point.column))
+                points.append((point.row, point.column))
+    return points
+
+
 def compute_aggregate_curve(job):
     """Compute and plot an aggreate loss curve.
 
-    This function expects to find in kvs a set of pre computed
-    GMFs and assets.
+    This function expects to find in kvs the losses per event of
+    each grid point, summed over its assets by the risk tasks.
 
     This function is triggered only if the AGGREGATE_LOSS_CURVE
     parameter is specified in the configuration file.
@@ -70,7 +84,8 @@ def compute_aggregate_curve(job):
 
         return
 
-    aggregate_loss_curve = prob.AggregateLossCurve.from_kvs(job.id, job)
+    aggregate_loss_curve = prob.AggregateLossCurve.from_kvs(
+            job.id, _grid_points(job))
 
     path = os.path.join(job.params["BASE_PATH"],
             job.params["OUTPUT_DIR"], _filename(job.id))
@@ -23,6 +23,7 @@ import json
 from openquake import job
 from celery.exceptions import TimeoutError
 
+from openquake.job import checkpoint
 from openquake.parser import vulnerability
 from openquake.shapes import Curve
 from openquake.risk import job as risk_job
@@ -45,19 +46,24 @@ class ClassicalPSHABasedMixin:
         tasks = []
         results = []
         for block_id in self.blocks_keys:
+            if checkpoint.is_done(self.id, checkpoint.RISK, block_id=block_id):
+                LOGGER.debug("block %s already computed" % block_id)
+                continue
             LOGGER.debug("starting task block, block_id = %s of %s"
                         % (block_id, len(self.blocks_keys)))
-            tasks.append(risk_job.compute_risk.delay(self.id, block_id))
+            tasks.append((block_id,
+                risk_job.compute_risk.delay(self.id, block_id)))
 
         # task compute_risk has return value 'True' (writes its results to
         # kvs).
-        for task in tasks:
+        for block_id, task in tasks:
             try:
                 # TODO(chris): Figure out where to put that timeout.
                 task.wait(timeout=None)
             except TimeoutError:
                 # TODO(jmc): Cancel and respawn this task
                 return []
+            checkpoint.mark_done(self.id, checkpoint.RISK, block_id=block_id)
         return results
 
     def compute_risk(self, block_id, **kwargs):  # pylint: disable=W0613
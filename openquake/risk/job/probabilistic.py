@@ -26,15 +26,17 @@ compute_risk task
 """
 
 import json
+import numpy
 
 from celery.exceptions import TimeoutError
-from scipy.stats import norm
 
 from openquake import job
 from openquake import kvs
 from openquake import logs
-from openquake import shapes
+from openquake import rng
 
+from openquake.hazard import gmf
+from openquake.job import checkpoint
 from openquake.risk import common
 from openquake.risk import probabilistic_event_based
 from openquake.risk import job as risk_job
@@ -61,22 +63,30 @@ class ProbabilisticEventMixin:
         """ Execute a ProbabilisticLossRatio Job """
 
         results = []
+        if not self.transpose_gmfs():
+            return []
+
         tasks = []
         for block_id in self.blocks_keys:
+            if checkpoint.is_done(self.id, checkpoint.RISK, block_id=block_id):
+                LOGGER.debug("block %s already computed" % block_id)
+                continue
             LOGGER.debug("starting task block, block_id = %s of %s"
                         % (block_id, len(self.blocks_keys)))
             # pylint: disable=E1101
-            tasks.append(risk_job.compute_risk.delay(self.id, block_id))
+            tasks.append((block_id,
+                risk_job.compute_risk.delay(self.id, block_id)))
 
         # task compute_risk has return value 'True' (writes its results to
         # kvs)
-        for task in tasks:
+        for block_id, task in tasks:
             try:
                 # TODO(chris): Figure out where to put that timeout.
                 task.wait(timeout=None)
             except TimeoutError:
                 # TODO(jmc): Cancel and respawn this task
                 return []
+            checkpoint.mark_done(self.id, checkpoint.RISK, block_id=block_id)
 
         # the aggregation must be computed after the slicing
         # of the gmfs has been completed
@@ -84,43 +94,88 @@ class ProbabilisticEventMixin:
 
         return results  # TODO(jmc): Move output from being a decorator
 
+    def stochastic_set_ids(self):
+        """Return the ids of the stochastic event sets of the job, in the
+        order their GMFs are collated."""
+        histories = int(self['NUMBER_OF_SEISMICITY_HISTORIES'])
+        realizations = int(self['NUMBER_OF_LOGIC_TREE_SAMPLES'])
+
+        return ["%s!%s" % (i, j)
+                for i in range(0, histories)
+                for j in range(0, realizations)]
+
+    def transpose_gmfs(self):
+        """Copy the GMFs of the stochastic event sets, stored by rupture,
+        to a single array per site (see openquake.hazard.gmf), one task
+        per event set. This is done once, so that each block only reads
+        the GMFs of its own sites. Return False if a task timed out."""
+
+        stochastic_set_ids = self.stochastic_set_ids()
+        offsets = gmf.stochastic_set_offsets(self.id, stochastic_set_ids)
+
+        tasks = []
+        for stochastic_set_id, offset in zip(stochastic_set_ids, offsets):
+            if checkpoint.is_done(self.id, checkpoint.GMF_TRANSPOSE,
+                                  stochastic_set_id):
+                LOGGER.debug("GMFs of %s already transposed"
+                             % stochastic_set_id)
+                continue
+            # pylint: disable=E1101
+            tasks.append((stochastic_set_id, risk_job.transpose_gmfs.delay(
+                self.id, stochastic_set_id, offset)))
+
+        for stochastic_set_id, task in tasks:
+            try:
+                task.wait(timeout=None)
+            except TimeoutError:
+                return False
+            checkpoint.mark_done(self.id, checkpoint.GMF_TRANSPOSE,
+                                 stochastic_set_id)
+
+        return True
+
     def slice_gmfs(self, block_id):
         """Load and collate GMF values for all sites in this block. """
         # TODO(JMC): Confirm this works regardless of the method of haz calc.
-        histories = int(self['NUMBER_OF_SEISMICITY_HISTORIES'])
-        realizations = int(self['NUMBER_OF_LOGIC_TREE_SAMPLES'])
-        num_ses = histories * realizations
+        num_ses = len(self.stochastic_set_ids())
 
         block = job.Block.from_kvs(block_id)
         sites_list = block.sites
-        gmfs = {}
+
+        # index of the hazard sites, by grid point
+        hazard_sites = {}
+        for index, site in enumerate(gmf.load_sites(self.id)):
+            point = self.region.grid.point_at(site)
+            hazard_sites[(point.row, point.column)] = index
+
+        points = []
         for site in sites_list:
             risk_point = self.region.grid.point_at(site)
-            key = "%s!%s" % (risk_point.row, risk_point.column)
-            gmfs[key] = []
-
-        for i in range(0, histories):
-            for j in range(0, realizations):
-                key = kvs.generate_product_key(
-                        self.id, kvs.tokens.STOCHASTIC_SET_TOKEN, "%s!%s" %
-                            (i, j))
-                fieldset = shapes.FieldSet.from_json(kvs.get(key),
-                    self.region.grid)
-
-                for field in fieldset:
-                    for key in gmfs.keys():
-                        (row, col) = key.split("!")
-                        gmfs[key].append(field.get(int(row), int(col)))
-
-        for key, gmf_slice in gmfs.items():
-            (row, col) = key.split("!")
+            if (risk_point.row, risk_point.column) not in points:
+                points.append((risk_point.row, risk_point.column))
+
+        site_ids = [hazard_sites[point] for point in points
+                    if point in hazard_sites]
+        site_gmfs = dict(zip(site_ids, gmf.load_site_gmfs(self.id, site_ids)))
+
+        ruptures = None
+        for (row, col) in points:
+            if (row, col) in hazard_sites:
+                gmf_slice = numpy.exp(site_gmfs[
+                    hazard_sites[(row, col)]].astype(float)).tolist()
+            else:
+                if ruptures is None:
+                    ruptures = sum(gmf.ruptures_count(self.id, set_id)
+                                   for set_id in self.stochastic_set_ids())
+                gmf_slice = [0.0] * ruptures
+
             key_gmf = kvs.tokens.gmfs_key(self.id, col, row)
             LOGGER.debug("GMF_SLICE for %s X %s : \n\t%s" % (
                     col, row, gmf_slice))
             timespan = float(self['INVESTIGATION_TIME'])
-            gmf = {"IMLs": gmf_slice, "TSES": num_ses * timespan,
+            gmf_data = {"IMLs": gmf_slice, "TSES": num_ses * timespan,
                     "TimeSpan": timespan}
-            kvs.set_value_json_encoded(key_gmf, gmf)
+            kvs.set_value_json_encoded(key_gmf, gmf_data)
 
     def compute_risk(self, block_id, **kwargs):  # pylint: disable=W0613
         """This task computes risk for a block of sites. It requires to have
@@ -151,13 +206,31 @@ class ProbabilisticEventMixin:
                 kvs.tokens.GMF_KEY_TOKEN, point.column, point.row)
             gmf_slice = kvs.get_value_json_decoded(key)
 
+            # losses per event of the point, summed over the assets
+            self.point_losses = None
+
             asset_key = kvs.tokens.asset_key(self.id, point.row, point.column)
             asset_list = kvs.get_client().lrange(asset_key, 0, -1)
+
+            # the assets of a point sharing a vulnerability function are
+            # computed together
+            groups = {}
+            references = []
             for asset in [json.JSONDecoder().decode(x) for x in asset_list]:
-                LOGGER.debug("processing asset %s" % (asset))
-                loss_ratio_curve = self.compute_loss_ratio_curve(
-                        point.column, point.row, asset, gmf_slice)
-                if loss_ratio_curve is not None:
+                reference = asset["vulnerabilityFunctionReference"]
+                if reference not in groups:
+                    groups[reference] = []
+                    references.append(reference)
+                groups[reference].append(asset)
+
+            for assets in [groups[reference] for reference in references]:
+                LOGGER.debug("processing assets %s" % (assets))
+                loss_ratio_curves = self.compute_loss_ratio_curves(
+                        point.column, point.row, assets, gmf_slice)
+
+                for asset, loss_ratio_curve in zip(assets, loss_ratio_curves):
+                    if loss_ratio_curve is None:
+                        continue
 
                     # compute loss curve
                     loss_curve = self.compute_loss_curve(
@@ -167,8 +240,40 @@ class ProbabilisticEventMixin:
                     for loss_poe in conditional_loss_poes:
                         self.compute_conditional_loss(point.column, point.row,
                                 loss_curve, asset, loss_poe)
+
+            self.store_point_losses(point)
+
         return True
 
+    def store_point_losses(self, point):
+        """Store the losses per event of the assets of a grid point, summed
+        for the aggregate loss curve. A point whose sites are split across
+        several blocks stores the same losses from each of them, under the
+        same key, so the losses of each point are added once."""
+        if getattr(self, "point_losses", None) is None:
+            return
+
+        kvs.set_value_json_encoded(kvs.tokens.aggregate_losses_key(
+                self.id, point.row, point.column), self.point_losses)
+
+    def add_point_losses(self, assets, loss_ratios, gmf_slice):
+        """Add the losses of the given assets, computed from their
+        (assets x events) loss ratios, to the losses of the grid point, if
+        an aggregate loss curve is requested."""
+        if not self.has("AGGREGATE_LOSS_CURVE") or not loss_ratios.size:
+            return
+
+        losses = (loss_ratios * numpy.array([asset["assetValue"]
+                for asset in assets])[:, numpy.newaxis]).sum(axis=0)
+
+        if getattr(self, "point_losses", None) is None:
+            self.point_losses = {"losses": losses.tolist(),
+                    "TSES": gmf_slice["TSES"],
+                    "TimeSpan": gmf_slice["TimeSpan"]}
+        else:
+            self.point_losses["losses"] = (
+                    numpy.array(self.point_losses["losses"]) + losses).tolist()
+
     def compute_conditional_loss(self, col, row, loss_curve, asset, loss_poe):
         """ Compute the conditional loss for a loss curve and probability of
         exceedance """
@@ -185,33 +290,52 @@ class ProbabilisticEventMixin:
 
     def compute_loss_ratio_curve(self, col, row, asset, gmf_slice):
         """Compute the loss ratio curve for a single site."""
+        return self.compute_loss_ratio_curves(col, row, [asset], gmf_slice)[0]
+
+    def compute_loss_ratio_curves(self, col, row, assets, gmf_slice):
+        """Compute the loss ratio curves of assets of a single site sharing
+        the same vulnerability function. Return a curve per asset, None for
+        the assets without losses."""
 
-        # fail if the asset has an unknown vulnerability code
+        # fail if the assets have an unknown vulnerability code
         vuln_function = self.vuln_curves.get(
-                asset["vulnerabilityFunctionReference"], None)
+                assets[0]["vulnerabilityFunctionReference"], None)
 
         if not vuln_function:
-            LOGGER.error(
-                "Unknown vulnerability function %s for asset %s"
-                % (asset["vulnerabilityFunctionReference"], asset["assetID"]))
+            for asset in assets:
+                LOGGER.error(
+                    "Unknown vulnerability function %s for asset %s"
+                    % (asset["vulnerabilityFunctionReference"],
+                       asset["assetID"]))
 
-            return None
+            return [None] * len(assets)
 
-        loss_ratio_curve = probabilistic_event_based.compute_loss_ratio_curve(
-                vuln_function, gmf_slice, self, asset,
-                self._get_number_of_samples())
+        loss_ratios = probabilistic_event_based.compute_loss_ratios(
+                vuln_function, gmf_slice, self, assets)
+        self.add_point_losses(assets, loss_ratios, gmf_slice)
 
-        # NOTE(JMC): Early exit if the loss ratio is all zeros
-        if not False in (loss_ratio_curve.ordinates == 0.0):
-            return None
+        loss_ratio_curves = \
+                probabilistic_event_based.compute_loss_ratio_curves(
+                vuln_function, gmf_slice, self, assets,
+                self._get_number_of_samples(), loss_ratios)
 
-        key = kvs.tokens.loss_ratio_key(self.id, row, col, asset["assetID"])
-        kvs.set(key, loss_ratio_curve.to_json())
+        results = []
+        for asset, loss_ratio_curve in zip(assets, loss_ratio_curves):
+            # NOTE(JMC): Early exit if the loss ratio is all zeros
+            if not False in (loss_ratio_curve.ordinates == 0.0):
+                results.append(None)
+                continue
 
-        LOGGER.warn("RESULT: loss ratio curve is %s, write to key %s" % (
-                loss_ratio_curve, key))
+            key = kvs.tokens.loss_ratio_key(
+                    self.id, row, col, asset["assetID"])
+            kvs.set(key, loss_ratio_curve.to_json())
 
-        return loss_ratio_curve
+            LOGGER.warn("RESULT: loss ratio curve is %s, write to key %s" % (
+                    loss_ratio_curve, key))
+
+            results.append(loss_ratio_curve)
+
+        return results
 
     def _get_number_of_samples(self):
         """Return the number of samples used to compute the loss ratio
@@ -259,28 +383,107 @@ class ProbabilisticEventMixin:
         structure category is the same. The asset's `structureCategory` is
         only needed for correlated jobs and unlikely to be available for
         uncorrelated ones.
+
+        Samples are taken from counter based random streams seeded with
+        EPSILON_RANDOM_SEED, one per asset (the n-th call for an asset
+        returns the n-th number of its stream) or per building typology,
+        so they do not depend on the task computing the asset nor on the
+        order of the assets.
         """
-        correlation = getattr(self, "ASSET_CORRELATION", None)
-        if not correlation:
-            # Sample per asset
-            return norm.rvs(loc=0, scale=1)
-        elif correlation != "perfect":
-            raise ValueError('Invalid "ASSET_CORRELATION": %s' % correlation)
-        else:
-            # Sample per building typology
-            samples = getattr(self, "samples", None)
-            if samples is None:
-                # These are two references for the same dictionary.
-                samples = self.samples = dict()
+        return self.epsilons_for(asset, 1)[0]
+
+    def epsilons_for(self, asset, count):
+        """Return the next count samples for the given asset, as an array.
 
+        The samples are the same as those of count calls to `epsilon`."""
+        return self.epsilon_matrix([asset], count)[0]
+
+    def epsilon_matrix(self, assets, count):
+        """Return an (assets x count) array with the next count samples of
+        each of the given assets, e.g. one per ground motion value.
+
+        With "perfect" correlation the assets of the same building typology
+        share the same row. With a partial correlation (an ASSET_CORRELATION
+        between 0 and 1) the samples of an asset are the sum of the sample
+        of its typology and of its own samples, weighted so that two assets
+        of the same typology have the given correlation."""
+
+        correlation = self._asset_correlation()
+
+        if correlation == 1.0:
+            return numpy.repeat(self._typology_samples(assets)[
+                    :, numpy.newaxis], count, axis=1)
+
+        epsilons = numpy.array([self._asset_samples(asset, count)
+                for asset in assets]).reshape((len(assets), count))
+
+        if correlation > 0.0:
+            epsilons = (numpy.sqrt(correlation) * self._typology_samples(
+                    assets)[:, numpy.newaxis]
+                    + numpy.sqrt(1.0 - correlation) * epsilons)
+
+        return epsilons
+
+    def _asset_correlation(self):
+        """Return the correlation of the epsilons of the assets of the same
+        building typology, as given by the ASSET_CORRELATION parameter
+        (none, "perfect" or a number between 0 and 1)."""
+
+        params = getattr(self, "params", {})
+        correlation = (params.get("ASSET_CORRELATION") or "none").strip()
+        if correlation.lower() in ("", "none"):
+            return 0.0
+        if correlation.lower() == "perfect":
+            return 1.0
+
+        try:
+            value = float(correlation)
+        except ValueError:
+            value = None
+
+        if value is None or not 0.0 <= value <= 1.0:
+            raise ValueError('Invalid "ASSET_CORRELATION": %s' % correlation)
+        return value
+
+    def _asset_samples(self, asset, count):
+        """Return the next count samples of the stream of an asset."""
+        draws = getattr(self, "epsilon_draws", None)
+        if draws is None:
+            draws = self.epsilon_draws = dict()
+
+        asset_id = asset["assetID"]
+        draw = draws.get(asset_id, 0)
+        draws[asset_id] = draw + count
+        return self.epsilon_stream("asset", asset_id).normal(count, draw)
+
+    def _typology_samples(self, assets):
+        """Return the samples of the building typologies of the given
+        assets, drawn once per typology and job."""
+        samples = getattr(self, "samples", None)
+        if samples is None:
+            # These are two references for the same dictionary.
+            samples = self.samples = dict()
+
+        categories = []
+        for asset in assets:
             category = asset.get("structureCategory")
             if category is None:
                 raise ValueError(
                     "Asset %s has no structure category" % asset["assetID"])
 
             if category not in samples:
-                samples[category] = norm.rvs(loc=0, scale=1)
-            return samples[category]
+                samples[category] = self.epsilon_stream(
+                    "category", category).normal(1)[0]
+            categories.append(category)
+
+        return numpy.array([samples[category] for category in categories],
+                           dtype=float)
+
+    def epsilon_stream(self, *path):
+        """Return the random stream of the epsilons of an asset or of a
+        building typology."""
+        params = getattr(self, "params", {})
+        return rng.Stream(params.get("EPSILON_RANDOM_SEED"), *path)
 
 
 RiskJobMixin.register("Probabilistic Event", ProbabilisticEventMixin)
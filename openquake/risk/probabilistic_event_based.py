@@ -24,15 +24,13 @@ using the probabilistic event based approach.
 """
 
 import json
-import math
 
-from numpy import zeros, array, linspace # pylint: disable=E1101, E0611
-from numpy import histogram, where, mean # pylint: disable=E1101, E0611
+from numpy import zeros, array, arange, newaxis # pylint: disable=E1101, E0611
+from numpy import where # pylint: disable=E1101, E0611
+from numpy import clip, exp, log, sqrt, tile # pylint: disable=E1101, E0611
 
 from openquake import kvs, shapes
-from openquake.parser import vulnerability
 from openquake.logs import LOG
-from openquake.risk.common import collect, loop
 
 DEFAULT_NUMBER_OF_SAMPLES = 25
 
@@ -78,75 +76,155 @@ def _sampled_based(vuln_function, ground_motion_field_set,
     (Coefficent of Variation) defined in the vulnerability function
     is greater than zero."""
 
-    loss_ratios = []
+    return _sampled_based_matrix(vuln_function, ground_motion_field_set,
+            epsilon_provider, [asset])[0]
 
-    for ground_motion_field in ground_motion_field_set["IMLs"]:
-        mean_ratio = vuln_function.ordinate_for(ground_motion_field)
 
-        if mean_ratio <= 0.0:
-            loss_ratios.append(0.0)
-        else:
-            variance = (mean_ratio * vuln_function.cov_for(
-                    ground_motion_field)) ** 2.0
+def _sampled_based_matrix(vuln_function, ground_motion_field_set,
+        epsilon_provider, assets):
+    """Compute the loss ratios of several assets with the sampled based
+    algorithm, as an (assets x ground motion values) array.
+
+    The mean loss ratios and the CVs are interpolated for all the
+    ground motion values at once, and shared by all the assets. For each
+    asset, an epsilon is drawn for each value with a positive mean loss
+    ratio, in the order of the values, all the epsilons being taken from
+    a single (assets x values) matrix."""
+
+    imls = array(ground_motion_field_set["IMLs"], dtype=float)
+    loss_ratios = zeros((len(assets), imls.size))
+
+    if not imls.size:
+        return loss_ratios
+
+    mean_ratios = vuln_function.ordinate_for(imls)
+    positive = mean_ratios > 0.0
+
+    if positive.any():
+        mean_ratios = mean_ratios[positive]
+        variances = (mean_ratios * vuln_function.cov_for(
+                imls[positive])) ** 2.0
+
+        epsilons = _epsilon_matrix(epsilon_provider, assets,
+                positive.sum())
+        sigmas = sqrt(log((variances / mean_ratios ** 2.0) + 1.0))
+
+        mus = log(mean_ratios ** 2.0 / sqrt(
+                variances + mean_ratios ** 2.0))
+
+        loss_ratios[:, positive] = exp(mus + (epsilons * sigmas))
+
+    return loss_ratios
+
+
+def _epsilons(epsilon_provider, asset, count):
+    """Return count epsilons for the given asset, drawn in one batch if
+    the provider defines an epsilons_for(asset, count) method, or with
+    count calls to its epsilon(asset) method otherwise."""
+
+    epsilons_for = getattr(epsilon_provider, "epsilons_for", None)
+
+    if epsilons_for is not None:
+        return array(epsilons_for(asset, count), dtype=float)
+
+    return array([epsilon_provider.epsilon(asset)
+            for _ in xrange(count)], dtype=float)
+
 
-            epsilon = epsilon_provider.epsilon(asset)
-            sigma = math.sqrt(math.log((variance / mean_ratio ** 2.0) + 1.0))
+def _epsilon_matrix(epsilon_provider, assets, count):
+    """Return an (assets x count) array of epsilons, drawn for all the
+    assets at once if the provider defines an epsilon_matrix(assets,
+    count) method, or asset by asset with _epsilons otherwise."""
 
-            mu = math.log(mean_ratio ** 2.0 / math.sqrt(
-                    variance + mean_ratio ** 2.0))
+    epsilon_matrix = getattr(epsilon_provider, "epsilon_matrix", None)
 
-            loss_ratios.append(math.exp(mu + (epsilon * sigma)))
+    if epsilon_matrix is not None:
+        return array(epsilon_matrix(assets, count), dtype=float)
 
-    return array(loss_ratios)
+    return array([_epsilons(epsilon_provider, asset, count)
+            for asset in assets], dtype=float).reshape((len(assets), count))
 
 
 def _mean_based(vuln_function, ground_motion_field_set):
     """Compute the set of loss ratios when the vulnerability function
     has all the CVs (Coefficent of Variation) set to zero."""
 
-    loss_ratios = []
     imls = vuln_function.imls
+    ground_motion_fields = array(ground_motion_field_set["IMLs"],
+            dtype=float)
 
-    # seems like with numpy you can only specify a single fill value
-    # if the x_new is outside the range. Here we need two different values,
-    # depending if the x_new is below or upon the defined values
-    for ground_motion_field in ground_motion_field_set["IMLs"]:
-        if ground_motion_field < imls[0]:
-            loss_ratios.append(0.0)
-        elif ground_motion_field > imls[-1]:
-            loss_ratios.append(vuln_function.means[-1])
-        else:
-            loss_ratios.append(vuln_function.ordinate_for(
-                    ground_motion_field))
+    if not ground_motion_fields.size:
+        return zeros(0)
+
+    # values below the defined IMLs have a null loss ratio, values
+    # above have the loss ratio of the last IML
+    loss_ratios = vuln_function.ordinate_for(
+            clip(ground_motion_fields, imls[0], imls[-1]))
+    loss_ratios[ground_motion_fields < imls[0]] = 0.0
+    loss_ratios[ground_motion_fields > imls[-1]] = vuln_function.means[-1]
 
-    return array(loss_ratios)
+    return loss_ratios
 
 
 def _compute_loss_ratios_range(loss_ratios,
         number_of_samples=None):
     """Compute the range of loss ratios used to build the loss ratio curve."""
 
+    return _compute_loss_ratios_ranges(
+            array(loss_ratios)[newaxis], number_of_samples)[0]
+
+
+def _compute_loss_ratios_ranges(loss_ratios, number_of_samples=None):
+    """Compute the ranges of loss ratios used to build the loss ratio
+    curves of an (assets x events) array of loss ratios, as an
+    (assets x samples) array. Each row is the same as numpy.linspace
+    between the minimum and the maximum loss ratios of the asset."""
+
     if number_of_samples is None:
         number_of_samples = DEFAULT_NUMBER_OF_SAMPLES
 
-    return linspace(loss_ratios.min(), loss_ratios.max(), number_of_samples)
+    starts = loss_ratios.min(axis=1)[:, newaxis] * 1.0
+    stops = loss_ratios.max(axis=1)[:, newaxis] * 1.0
+
+    divisions = number_of_samples - 1
+    deltas = stops - starts
+    steps = deltas / divisions
+    samples = arange(0, number_of_samples, dtype=float)[newaxis]
+
+    # computed as numpy.linspace does, to get the same values
+    ranges = where(steps == 0, samples / divisions * deltas,
+            samples * steps) + starts
+    ranges[:, -1] = stops[:, 0]
+
+    return ranges
 
 
 def _compute_cumulative_histogram(loss_ratios, loss_ratios_range):
     "Compute the cumulative histogram."
 
-    # ruptures (earthquake) occured but probably due to distance,
-    # magnitude and soil conditions, no ground motion was felt at that location
-    if (loss_ratios <= 0.0).all():
-        return zeros(loss_ratios_range.size - 1)
+    return _compute_cumulative_histograms(array(loss_ratios)[newaxis],
+            array(loss_ratios_range)[newaxis])[0]
+
+
+def _compute_cumulative_histograms(loss_ratios, loss_ratios_ranges):
+    """Compute the cumulative histograms of an (assets x events) array of
+    loss ratios over the (assets x samples) ranges of the assets.
 
-    invalid_ratios = lambda ratios: where(array(ratios) <= 0.0)[0].size
+    All the loss ratios of an asset are within its range, so the value
+    of the cumulative histogram at a bin is the number of loss ratios
+    not lower than the left edge of the bin, as numpy.histogram counts
+    them."""
 
-    hist = histogram(loss_ratios, bins=loss_ratios_range)
-    hist = hist[0][::-1].cumsum()[::-1]
+    hist = (loss_ratios[:, :, newaxis]
+            >= loss_ratios_ranges[:, newaxis, :-1]).sum(axis=1)
 
     # ratios with value 0.0 must be deleted on the first bin
-    hist[0] = hist[0] - invalid_ratios(loss_ratios)
+    invalid_ratios = (loss_ratios <= 0.0).sum(axis=1)
+    hist[:, 0] = hist[:, 0] - invalid_ratios
+
+    # ruptures (earthquake) occured but probably due to distance,
+    # magnitude and soil conditions, no ground motion was felt at that location
+    hist[invalid_ratios == loss_ratios.shape[1]] = 0
     return hist
 
 
@@ -164,8 +242,28 @@ def _compute_probs_of_exceedance(rates_of_exceedance, time_span):
     """Compute the probabilities of exceedance using the given rates of
     exceedance and the given time span."""
 
-    poe = lambda rate: 1 - math.exp((rate * -1) * time_span)
-    return array([poe(rate) for rate in rates_of_exceedance])
+    return 1 - exp((array(rates_of_exceedance, dtype=float) * -1)
+            * time_span)
+
+
+def _compute_loss_ratio_curves_matrix(loss_ratios, tses, time_span,
+        number_of_samples=None):
+    """Compute the loss ratio curves of an (assets x events) array of loss
+    ratios, all the steps being computed for all the assets at once.
+
+    Return the (assets x bins) arrays of the mean loss ratios of the bins
+    and of their probabilities of exceedance."""
+
+    loss_ratios = array(loss_ratios, dtype=float)
+
+    loss_ratios_ranges = _compute_loss_ratios_ranges(
+            loss_ratios, number_of_samples)
+
+    probs_of_exceedance = _compute_probs_of_exceedance(
+            _compute_rates_of_exceedance(_compute_cumulative_histograms(
+            loss_ratios, loss_ratios_ranges), tses), time_span)
+
+    return _mean_losses(loss_ratios_ranges), probs_of_exceedance
 
 
 def compute_loss_ratio_curve(vuln_function, ground_motion_field_set,
@@ -203,74 +301,106 @@ def compute_loss_ratio_curve(vuln_function, ground_motion_field_set,
     loss_ratios = _compute_loss_ratios(vuln_function,
             ground_motion_field_set, epsilon_provider, asset)
 
-    loss_ratios_range = _compute_loss_ratios_range(
-            loss_ratios, number_of_samples)
+    mean_losses, probs_of_exceedance = _compute_loss_ratio_curves_matrix(
+            loss_ratios[newaxis], ground_motion_field_set["TSES"],
+            ground_motion_field_set["TimeSpan"], number_of_samples)
 
-    probs_of_exceedance = _compute_probs_of_exceedance(
-            _compute_rates_of_exceedance(_compute_cumulative_histogram(
-            loss_ratios, loss_ratios_range), ground_motion_field_set["TSES"]),
-            ground_motion_field_set["TimeSpan"])
+    return shapes.Curve(zip(mean_losses[0], probs_of_exceedance[0]))
+
+
+def compute_loss_ratios(vuln_function, ground_motion_field_set,
+        epsilon_provider, assets):
+    """Compute the loss ratios of several assets sharing the same
+    vulnerability function and ground motion fields, as an
+    (assets x ground motion values) array."""
+
+    if vuln_function.is_empty:
+        return zeros((len(assets), 0))
+
+    if (vuln_function.covs <= 0.0).all():
+        return tile(_mean_based(vuln_function, ground_motion_field_set),
+                (len(assets), 1))
 
-    return _generate_curve(loss_ratios_range, probs_of_exceedance)
+    return _sampled_based_matrix(vuln_function, ground_motion_field_set,
+            epsilon_provider, assets)
 
 
-def _generate_curve(losses, probs_of_exceedance):
-    """Generate a loss ratio (or loss) curve, given a set of losses
-    and corresponding PoEs (Probabilities of Exceedance).
+def compute_loss_ratio_curves(vuln_function, ground_motion_field_set,
+        epsilon_provider, assets, number_of_samples=None, loss_ratios=None):
+    """Compute the loss ratio curves of several assets sharing the same
+    vulnerability function and ground motion fields, in the order of the
+    assets. The curves are the same as those computed by
+    compute_loss_ratio_curve for each asset.
 
-    This function is intended to be used internally.
+    With a mean based vulnerability function, all the assets have the
+    same curve, computed once. Otherwise the loss ratios of all the
+    assets are computed as an (assets x ground motion values) array, and
+    converted to PoEs together. The array can be given as loss_ratios if
+    already computed with compute_loss_ratios.
     """
 
-    mean_losses = collect(loop(losses, lambda x, y: mean([x, y])))
-    return shapes.Curve(zip(mean_losses, probs_of_exceedance))
+    if (not ground_motion_field_set["IMLs"] or vuln_function.is_empty
+            or (vuln_function.covs <= 0.0).all()):
+        curve = compute_loss_ratio_curve(vuln_function,
+                ground_motion_field_set, epsilon_provider, assets[0],
+                number_of_samples)
+        return [curve] * len(assets)
 
+    if loss_ratios is None:
+        loss_ratios = _sampled_based_matrix(vuln_function,
+                ground_motion_field_set, epsilon_provider, assets)
 
-def _assets_keys_for_gmfs(job_id, gmfs_key):
-    """Return the asset related to the GMFs given."""
+    mean_losses, probs_of_exceedance = _compute_loss_ratio_curves_matrix(
+            loss_ratios, ground_motion_field_set["TSES"],
+            ground_motion_field_set["TimeSpan"], number_of_samples)
 
-    row = lambda key: key.split(kvs.KVS_KEY_SEPARATOR)[3]
-    column = lambda key: key.split(kvs.KVS_KEY_SEPARATOR)[2]
+    return [shapes.Curve(zip(asset_losses, asset_poes))
+            for asset_losses, asset_poes
+            in zip(mean_losses, probs_of_exceedance)]
 
-    key = kvs.tokens.asset_key(
-            job_id, row(gmfs_key), column(gmfs_key))
 
-    return kvs.get_client().lrange(key, 0, -1)
+def _mean_losses(losses):
+    """Return the means of the consecutive losses of each row of an
+    array, i.e. the mean losses of the bins they delimit."""
+    return (losses[:, :-1] + losses[:, 1:]) / 2.0
 
 
 class AggregateLossCurve(object):
-    """Aggregate a set of losses and produce the resulting loss curve."""
+    """Aggregate a set of losses and produce the resulting loss curve.
 
-    @staticmethod
-    def from_kvs(job_id, epsilon_provider):
-        """Return an aggregate curve using the GMFs and assets
-        stored in the underlying kvs system."""
-
-        vuln_model = vulnerability.load_vuln_model_from_kvs(job_id)
-        aggregate_curve = AggregateLossCurve(vuln_model, epsilon_provider)
+    The losses are summed event by event as they are added, so only the
+    total distribution is kept in memory."""
 
-        gmfs_keys = kvs.get_keys("%s*%s*" % (
-                job_id, kvs.tokens.GMF_KEY_TOKEN))
+    @staticmethod
+    def from_kvs(job_id, points):
+        """Return an aggregate curve summing the losses per event of the
+        given (row, column) grid points, as stored in kvs by the risk
+        tasks. Each point must be given once."""
 
-        LOG.debug("Found %s stored GMFs..." % len(gmfs_keys))
-        asset_counter = 0
+        aggregate_curve = AggregateLossCurve({}, None)
 
-        for gmfs_key in gmfs_keys:
-            assets = _assets_keys_for_gmfs(job_id, gmfs_key)
+        keys = [kvs.tokens.aggregate_losses_key(job_id, row, col)
+                for (row, col) in points]
 
-            for asset in assets:
-                asset_counter += 1
-                gmfs = kvs.get_value_json_decoded(gmfs_key)
+        for raw_losses in kvs.get_client(binary=False).mget(keys) \
+                if keys else []:
+            # points without assets store no losses
+            if raw_losses is None:
+                continue
 
-                aggregate_curve.append(gmfs,
-                        json.JSONDecoder().decode(asset))
+            losses = json.loads(raw_losses)
+            aggregate_curve.append_losses(losses["losses"],
+                    losses["TSES"], losses["TimeSpan"])
 
-        LOG.debug("Found %s stored assets..." % asset_counter)
+        LOG.debug("Found the losses of %s grid points..."
+                % aggregate_curve.size)
         return aggregate_curve
 
     def __init__(self, vuln_model, epsilon_provider):
         self._tses = self._time_span = self._gmfs_length = None
 
-        self.distribution = []
+        self._losses = None
+        self.size = 0
         self.vuln_model = vuln_model
         self.epsilon_provider = epsilon_provider
 
@@ -278,44 +408,67 @@ class AggregateLossCurve(object):
         """Add the losses distribution identified by the given GMFs
         and asset to the set used to compute the aggregate curve."""
 
-        if self.empty:
-            self._initialize_parameters(gmfs)
-
-        assert gmfs["TimeSpan"] == self._time_span
-        assert gmfs["TSES"] == self._tses
-        assert len(gmfs["IMLs"]) == self._gmfs_length
+        self._check_parameters(gmfs["TSES"], gmfs["TimeSpan"],
+                len(gmfs["IMLs"]))
 
         if asset["vulnerabilityFunctionReference"] in self.vuln_model:
             loss_ratios = _compute_loss_ratios(self.vuln_model[
                     asset["vulnerabilityFunctionReference"]], gmfs,
                     self.epsilon_provider, asset)
 
-            self.distribution.append(loss_ratios * asset["assetValue"])
+            self._add(loss_ratios * asset["assetValue"])
         else:
             LOG.debug("Unknown vulnerability function %s, asset %s will " \
                     "not be included in the aggregate computation"
                     % (asset["vulnerabilityFunctionReference"],
                     asset["assetID"]))
 
-    def _initialize_parameters(self, gmfs):
+    def append_losses(self, losses, tses, time_span):
+        """Add a distribution of losses per event, e.g. the sum of the
+        losses of the assets of a block."""
+
+        losses = array(losses, dtype=float)
+        self._check_parameters(tses, time_span, losses.size)
+        self._add(losses)
+
+    def _add(self, losses):
+        """Add a distribution of losses to the total."""
+        if self._losses is None:
+            self._losses = array(losses, dtype=float)
+        else:
+            self._losses = self._losses + losses
+
+        self.size += 1
+
+    def _check_parameters(self, tses, time_span, gmfs_length):
+        """Check that the distributions are defined on the same events."""
+
+        if self._tses is None:
+            self._initialize_parameters(tses, time_span, gmfs_length)
+
+        assert time_span == self._time_span
+        assert tses == self._tses
+        assert gmfs_length == self._gmfs_length
+
+    def _initialize_parameters(self, tses, time_span, gmfs_length):
         """Initialize the GMFs parameters."""
-        self._tses = gmfs["TSES"]
-        self._time_span = gmfs["TimeSpan"]
-        self._gmfs_length = len(gmfs["IMLs"])
+        self._tses = tses
+        self._time_span = time_span
+        self._gmfs_length = gmfs_length
 
     @property
     def empty(self):
         """Return true is this aggregate curve has no losses
         associated, false otherwise."""
-        return len(self.distribution) == 0
+        return self._losses is None
 
     @property
     def losses(self):
         """Return the losses used to compute the aggregate curve."""
         if self.empty:
             return array([])
-        else: # if needed because numpy returns a scalar if the list is empty
-            return array(self.distribution).sum(axis=0)
+        else:
+            return self._losses
 
     def compute(self, number_of_samples=None):
         """Compute the aggregate loss curve."""
@@ -323,11 +476,8 @@ class AggregateLossCurve(object):
         if self.empty:
             return shapes.EMPTY_CURVE
 
-        losses = self.losses
-        loss_range = _compute_loss_ratios_range(losses, number_of_samples)
-
-        probs_of_exceedance = _compute_probs_of_exceedance(
-                _compute_rates_of_exceedance(_compute_cumulative_histogram(
-                losses, loss_range), self._tses), self._time_span)
+        mean_losses, probs_of_exceedance = _compute_loss_ratio_curves_matrix(
+                self.losses[newaxis], self._tses, self._time_span,
+                number_of_samples)
 
-        return _generate_curve(loss_range, probs_of_exceedance)
+        return shapes.Curve(zip(mean_losses[0], probs_of_exceedance[0]))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+"""
+Counter based random streams.
+
+A stream is identified by a job seed and a path, e.g. (history,
+realization, rupture) for the residuals of a rupture or an asset id for
+its epsilons. The n-th number of a stream is the Philox4x32-10 block
+cipher (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3",
+SC11) applied to the counter n, with a key derived from the seed and the
+path. Any task can thus draw the numbers of any stream, starting from any
+position, without sharing a generator: results are the same whatever the
+partition of the work in tasks and the order of execution.
+"""
+
+import hashlib
+import struct
+
+import numpy
+from scipy.special import ndtr, ndtri
+
+PHILOX_M0 = numpy.uint64(0xD2511F53)
+PHILOX_M1 = numpy.uint64(0xCD9E8D57)
+PHILOX_W0 = 0x9E3779B9
+PHILOX_W1 = 0xBB67AE85
+PHILOX_ROUNDS = 10
+
+_LOW_32 = numpy.uint64(0xFFFFFFFF)
+_SHIFT_32 = numpy.uint64(32)
+
+
+def philox(counters, key):
+    """Apply Philox4x32-10 to a (n x 4) array of 32 bit counters with
+    the given (2) 32 bit key, return a (n x 4) uint32 array."""
+
+    counters = numpy.asarray(counters, dtype=numpy.uint64).reshape((-1, 4))
+    (c0, c1, c2, c3) = [counters[:, i] for i in range(4)]
+    (k0, k1) = [int(word) for word in key]
+
+    for _ in xrange(PHILOX_ROUNDS):
+        product0 = PHILOX_M0 * c0
+        product1 = PHILOX_M1 * c2
+        (c0, c1, c2, c3) = (
+            (product1 >> _SHIFT_32) ^ c1 ^ numpy.uint64(k0),
+            product1 & _LOW_32,
+            (product0 >> _SHIFT_32) ^ c3 ^ numpy.uint64(k1),
+            product0 & _LOW_32)
+        k0 = (k0 + PHILOX_W0) & 0xFFFFFFFF
+        k1 = (k1 + PHILOX_W1) & 0xFFFFFFFF
+
+    return numpy.column_stack([c0, c1, c2, c3]).astype(numpy.uint32)
+
+
+class Stream(object):
+    """A counter based random stream."""
+
+    def __init__(self, seed, *path):
+        digest = hashlib.sha1(
+            "!".join(str(part) for part in (seed,) + path)).digest()
+        self.key = struct.unpack("<2I", digest[:8])
+
+    def integers(self, size, offset=0):
+        """Return the 32 bit integers of the stream from the given
+        position."""
+        first = offset // 4
+        last = (offset + size + 3) // 4
+        counters = numpy.zeros((last - first, 4), dtype=numpy.uint64)
+        counters[:, 0] = numpy.arange(first, last) & 0xFFFFFFFF
+        counters[:, 1] = numpy.arange(first, last) >> 32
+        start = offset - first * 4
+        return philox(counters, self.key).ravel()[start:start + size]
+
+    def seed(self):
+        """Return a 32 bit seed (e.g. for a java.util.Random) taken from
+        the stream."""
+        return int(self.integers(1)[0])
+
+    def uniform(self, size, offset=0):
+        """Return uniform numbers in (0, 1) from the given position."""
+        return (self.integers(size, offset) + 0.5) / 2.0 ** 32
+
+    def normal(self, size, offset=0, truncation_level=None,
+               truncation_type=None):
+        """Return standard normal deviates from the given position,
+        truncated as the GMPEs do (truncation_type "1 Sided" or
+        "2 Sided", in units of standard deviation) if truncation_level
+        is given. A deviate only depends on a single number of the
+        stream, so truncation does not shift the following ones."""
+        return truncated_normal(self.uniform(size, offset),
+                                truncation_level, truncation_type)
+
+
+def truncated_normal(uniforms, truncation_level=None, truncation_type=None):
+    """Transform uniform numbers in (0, 1) to standard normal deviates,
+    truncated at truncation_level (on both sides for "2 Sided", on the
+    upper side for "1 Sided"), by inverting the truncated distribution."""
+
+    lower = 0.0
+    upper = 1.0
+    if truncation_level is not None and truncation_type is not None:
+        truncation_type = truncation_type.lower()
+        if truncation_type.startswith("2"):
+            lower = ndtr(-truncation_level)
+            upper = ndtr(truncation_level)
+        elif truncation_type.startswith("1"):
+            upper = ndtr(truncation_level)
+
+    return ndtri(lower + numpy.asarray(uniforms) * (upper - lower))
@@ -41,8 +41,12 @@ from openquake import xml
 from openquake.job import mixins
 from openquake.kvs import tokens
 from openquake.hazard import tasks
+from openquake.hazard import classical_numpy
 from openquake.hazard import classical_psha
+from openquake.hazard import gmf
+from openquake.hazard import interpolation
 from openquake.hazard import opensha
+from openquake.hazard import site_amplification
 import openquake.hazard.job
 
 from tests.kvs_unittest import ONE_CURVE_MODEL
@@ -552,6 +556,15 @@ class MeanHazardCurveComputationTestCase(unittest.TestCase):
         # no values
         self.assertTrue(numpy.allclose([], numpy.array(result["curve"])))
 
+    def test_a_site_without_curves_produces_an_empty_mean_curve(self):
+        self._run([shapes.Site(2.0, 5.0)])
+
+        result = kvs.get_value_json_decoded(
+                kvs.tokens.mean_hazard_curve_key(
+                self.job_id, shapes.Site(2.0, 5.0)))
+
+        self.assertEqual([], result["curve"])
+
     def test_reads_and_stores_the_mean_curve_in_kvs(self):
         hazard_curve_1 = {"site_lon": 2.0, "site_lat": 5.0, "curve": [
                 {"y": 9.8161000e-01, "x": 0.5}, {"y": 9.7837000e-01, "x": 0.5},
@@ -642,6 +655,26 @@ class MeanHazardCurveComputationTestCase(unittest.TestCase):
         self.assertTrue(numpy.allclose(numpy.array(19 * [0.5]),
         numpy.array(x_values)))
 
+    def test_the_mean_curve_is_updated_with_new_realizations(self):
+        site = shapes.Site(2.0, 5.0)
+        self._store_hazard_curve_at(site, {"site_lon": 2.0, "site_lat": 5.0,
+                "curve": [{"x": 0.1, "y": 0.9}, {"x": 0.2, "y": 0.5}]}, 0)
+        self._store_hazard_curve_at(site, {"site_lon": 2.0, "site_lat": 5.0,
+                "curve": [{"x": 0.1, "y": 0.7}, {"x": 0.2, "y": 0.3}]}, 1)
+        self._run([site])
+
+        # the job is extended with a third realization
+        self._store_hazard_curve_at(site, {"site_lon": 2.0, "site_lat": 5.0,
+                "curve": [{"x": 0.1, "y": 0.2}, {"x": 0.2, "y": 0.1}]}, 2)
+        self._run([site])
+
+        result = kvs.get_value_json_decoded(
+                kvs.tokens.mean_hazard_curve_key(self.job_id, site))
+
+        self.assertEqual(3, result["realizations"])
+        self.assertTrue(numpy.allclose([0.6, 0.3],
+                classical_psha._extract_y_values_from(result["curve"])))
+
     def _run(self, sites):
         classical_psha.compute_mean_hazard_curves(
                 self.job_id, sites)
@@ -1123,3 +1156,591 @@ class MeanQuantileHazardMapsComputationTestCase(unittest.TestCase):
                 (kvs.tokens.MEAN_HAZARD_MAP_KEY_TOKEN,
                 self.job_id, site.longitude, site.latitude,
                 str(poe))))
+
+
+class SiteListCacheKeyTestCase(unittest.TestCase):
+    """Tests the key used to cache Java site lists on the workers."""
+
+    def setUp(self):
+        self.sites = [shapes.Site(1.0, 2.0), shapes.Site(1.5, 2.0)]
+        self.params = (760.0, 1.0, "Rock")
+
+    def test_same_sites_and_params_share_the_key(self):
+        self.assertEqual(
+            opensha._site_list_cache_key(self.sites, self.params),
+            opensha._site_list_cache_key(list(self.sites), self.params))
+
+    def test_site_order_changes_the_key(self):
+        self.assertNotEqual(
+            opensha._site_list_cache_key(self.sites, self.params),
+            opensha._site_list_cache_key(self.sites[::-1], self.params))
+
+    def test_site_params_change_the_key(self):
+        self.assertNotEqual(
+            opensha._site_list_cache_key(self.sites, self.params),
+            opensha._site_list_cache_key(
+                self.sites, (800.0, 1.0, "Rock")))
+
+
+class SitesBoundsTestCase(unittest.TestCase):
+    """Tests the bounding box used to prefilter sources per block."""
+
+    def test_bounds_of_a_single_site(self):
+        self.assertEqual((1.0, 2.0, 1.0, 2.0),
+            opensha.sites_bounds([shapes.Site(1.0, 2.0)]))
+
+    def test_bounds_of_multiple_sites(self):
+        sites = [shapes.Site(1.0, 2.0), shapes.Site(-1.0, 3.0),
+                 shapes.Site(0.5, 1.5)]
+        self.assertEqual((-1.0, 1.5, 1.0, 3.0), opensha.sites_bounds(sites))
+
+
+class WeightedStatisticsTestCase(unittest.TestCase):
+    """Tests mean and quantile curves of enumerated logic tree branches."""
+
+    def setUp(self):
+        self.curves = [numpy.array([0.9, 0.5, 0.1]),
+                       numpy.array([0.8, 0.4, 0.2]),
+                       numpy.array([0.7, 0.3, 0.3])]
+
+    def test_equal_weights_give_the_plain_mean(self):
+        self.assertTrue(numpy.allclose(
+            classical_psha.compute_mean_curve(self.curves),
+            classical_psha.compute_mean_curve(self.curves, [0.2, 0.2, 0.2])))
+
+    def test_weighted_mean(self):
+        self.assertTrue(numpy.allclose([0.84, 0.44, 0.16],
+            classical_psha.compute_mean_curve(self.curves, [0.5, 0.4, 0.1])))
+
+    def test_weighted_quantile_is_interpolated_on_cumulative_weights(self):
+        # sorted PoEs at the first IML are 0.7, 0.8, 0.9 with cumulative
+        # weights 0.25, 0.5, 1.0
+        quantile_curve = classical_psha.compute_weighted_quantile_curve(
+            self.curves, [0.5, 0.25, 0.25], 0.75)
+        self.assertTrue(numpy.allclose([0.85, 0.45, 0.2], quantile_curve))
+
+    def test_weighted_quantile_of_no_curves_is_empty(self):
+        self.assertEqual([],
+            classical_psha.compute_weighted_quantile_curve([], [], 0.5))
+
+
+class NumpyClassicalKernelTestCase(unittest.TestCase):
+    """Tests the numpy classical PSHA kernel."""
+
+    def setUp(self):
+        self.params = {"MINIMUM_MAGNITUDE": "5.0",
+            "INCLUDE_GRID_SOURCES": "true", "INCLUDE_AREA_SOURCES": "true",
+            "INCLUDE_FAULT_SOURCE": "false",
+            "INCLUDE_SUBDUCTION_FAULT_SOURCE": "false",
+            "TREAT_AREA_SOURCE_AS": "Point Sources",
+            "AREA_SOURCE_DISCRETIZATION": "0.1",
+            "INTENSITY_MEASURE_TYPE": "PGA",
+            "INTENSITY_MEASURE_LEVELS": "0.005, 0.05, 0.5",
+            "REFERENCE_VS30_VALUE": "760.0", "MAXIMUM_DISTANCE": "200.0",
+            "GMPE_TRUNCATION_TYPE": "2 Sided", "TRUNCATION_LEVEL": "3",
+            "STANDARD_DEVIATION_TYPE": "Total", "INVESTIGATION_TIME": "50.0"}
+
+        self.point_source = {"id": "src01", "tectReg": "ACTIVE_SHALLOW",
+            "hypoMagFreqDistAtLoc": {
+                "location": {"lon": numpy.radians(-122.0),
+                             "lat": numpy.radians(38.0), "depth": 0.0},
+                "magFreqDist": [{"minX": 4.95, "delta": 0.1,
+                                 "points": [0.1, 0.01, 0.001]}],
+                "focalMechanism": [{"strike": 0.0, "dip": 90.0,
+                                    "rake": 0.0}]}}
+
+        self.gmpe_map = {"Active Shallow Crust":
+            "org.opensha.sha.imr.attenRelImpl.BA_2008_AttenRel"}
+
+    def test_distances_between_sites_and_ruptures(self):
+        result = classical_numpy.distances([0.0, 0.0], [0.0, 1.0],
+                                           [1.0], [0.0])
+        self.assertEqual((2, 1), result.shape)
+        self.assertAlmostEqual(111.195, result[0, 0], 3)
+
+    def test_two_sided_truncation(self):
+        poes = classical_numpy.probabilities_of_exceedance(
+            numpy.array([-4.0, 0.0, 4.0]), "2 Sided", 3.0)
+        self.assertTrue(numpy.allclose([1.0, 0.5, 0.0], poes))
+
+    def test_no_truncation(self):
+        poes = classical_numpy.probabilities_of_exceedance(
+            numpy.array([0.0]), "None", 3.0)
+        self.assertTrue(numpy.allclose([0.5], poes))
+
+    def test_magnitudes_below_the_minimum_are_discarded(self):
+        ruptures = classical_numpy.ruptures_from_sources(
+            [self.point_source], self.params)
+        self.assertTrue(numpy.allclose([5.05, 5.15], ruptures.mags))
+        self.assertTrue(numpy.allclose([0.01, 0.001], ruptures.rates))
+        self.assertTrue(numpy.allclose([-122.0, -122.0], ruptures.lons))
+
+    def test_fault_sources_are_not_supported(self):
+        self.params["INCLUDE_FAULT_SOURCE"] = "true"
+        self.assertRaises(ValueError, classical_numpy.ruptures_from_sources,
+                          [{"id": "src02", "trace": []}], self.params)
+
+    def test_no_site_amplification_at_the_reference_vs30(self):
+        mean, std = classical_numpy.ba_2008("PGA", numpy.array([6.0]),
+            numpy.array([[10.0]]), numpy.array([0.0]), 760.0, "Total")
+        soft_mean, _ = classical_numpy.ba_2008("PGA", numpy.array([6.0]),
+            numpy.array([[10.0]]), numpy.array([0.0]), 300.0, "Total")
+        rock_mean = classical_numpy._ba_2008_rock(
+            classical_numpy.BA_2008_PGA, numpy.array([6.0]),
+            numpy.array([[10.0]]), numpy.array([0.0]))
+
+        # at the reference vs30 the mean is the one without site term
+        self.assertTrue(numpy.allclose(rock_mean, mean))
+        self.assertTrue(numpy.allclose(0.564, std))
+        self.assertTrue(soft_mean[0, 0] > mean[0, 0])
+
+    def test_hazard_curves_decrease_with_the_iml(self):
+        ruptures = classical_numpy.ruptures_from_sources(
+            [self.point_source], self.params)
+        sites = [shapes.Site(-122.0, 38.0), shapes.Site(-122.5, 38.0)]
+
+        curves = classical_numpy.hazard_curves(
+            sites, ruptures, self.gmpe_map, self.params)
+
+        self.assertEqual((2, 3), curves.shape)
+        self.assertTrue(numpy.all(numpy.diff(curves, axis=1) <= 0.0))
+        self.assertTrue(numpy.all(curves[0] >= curves[1]))
+
+    def test_ruptures_beyond_the_maximum_distance_are_ignored(self):
+        ruptures = classical_numpy.ruptures_from_sources(
+            [self.point_source], self.params)
+        self.params["MAXIMUM_DISTANCE"] = "10.0"
+
+        curves = classical_numpy.hazard_curves([shapes.Site(-123.0, 38.0)],
+            ruptures, self.gmpe_map, self.params)
+
+        self.assertTrue(numpy.allclose(0.0, curves))
+
+    def test_curves_of_several_imts_share_the_distances(self):
+        ruptures = classical_numpy.ruptures_from_sources(
+            [self.point_source], self.params)
+        sites = [shapes.Site(-122.0, 38.0), shapes.Site(-122.5, 38.0)]
+        measures = [("PGA", 0.0, [0.005, 0.05, 0.5]), ("PGA", 0.0, [0.05])]
+
+        curves = classical_numpy.hazard_curves(
+            sites, ruptures, self.gmpe_map, self.params, measures)
+
+        self.assertEqual(2, len(curves))
+        self.assertTrue(numpy.allclose(classical_numpy.hazard_curves(
+            sites, ruptures, self.gmpe_map, self.params), curves[0]))
+        self.assertTrue(numpy.allclose(curves[0][:, 1:2], curves[1]))
+
+
+class IntensityMeasuresTestCase(unittest.TestCase):
+    """Tests the parsing of the intensity measure types of a job."""
+
+    def setUp(self):
+        self.params = {"INTENSITY_MEASURE_TYPE": "PGA", "PERIOD": "0.0",
+            "INTENSITY_MEASURE_LEVELS": "0.005, 0.05"}
+
+    def test_only_the_main_imt_by_default(self):
+        self.assertEqual([("PGA", 0.0, [0.005, 0.05])],
+            opensha.intensity_measures(self.params))
+
+    def test_additional_imts_follow_the_main_one(self):
+        self.params["ADDITIONAL_INTENSITY_MEASURE_TYPES"] = \
+            "SA 0.2: 0.01, 0.1 | SA 1.0: 0.02 | PGV: 1.0, 10.0"
+
+        self.assertEqual([("PGA", 0.0, [0.005, 0.05]),
+                          ("SA", 0.2, [0.01, 0.1]), ("SA", 1.0, [0.02]),
+                          ("PGV", 0.0, [1.0, 10.0])],
+                         opensha.intensity_measures(self.params))
+        self.assertEqual("SA-0.2", opensha.imt_id("SA", 0.2))
+
+    def test_additional_imts_need_levels(self):
+        self.params["ADDITIONAL_INTENSITY_MEASURE_TYPES"] = "SA 0.2"
+        self.assertRaises(ValueError, opensha.intensity_measures,
+                          self.params)
+
+    def test_unknown_imts_are_rejected(self):
+        self.params["ADDITIONAL_INTENSITY_MEASURE_TYPES"] = "XYZ 0.2: 0.1"
+        self.assertRaises(ValueError, opensha.intensity_measures,
+                          self.params)
+
+
+class SiteAmplificationTestCase(unittest.TestCase):
+    """Tests the rock to site amplification of hazard curves."""
+
+    def setUp(self):
+        self.imls = [0.01, 0.1, 1.0]
+        self.poes = numpy.array([[0.9, 0.3, 0.01], [0.5, 0.1, 0.0]])
+        self.class_vs30s, self.class_factors = \
+            site_amplification.parse_amplification_factors(
+                "760: 1.0, 1.0, 1.0 | 360: 2.0, 1.5, 1.0", 3)
+
+    def test_site_classes_are_sorted_by_vs30(self):
+        self.assertTrue(numpy.allclose([360.0, 760.0], self.class_vs30s))
+        self.assertTrue(numpy.allclose([[2.0, 1.5, 1.0], [1.0, 1.0, 1.0]],
+                                       self.class_factors))
+
+    def test_each_site_class_needs_a_factor_per_iml(self):
+        self.assertRaises(ValueError,
+            site_amplification.parse_amplification_factors, "360: 2.0", 3)
+
+    def test_factors_are_interpolated_in_log_vs30(self):
+        factors = site_amplification.factors_for_vs30(
+            [760.0, 360.0, (760.0 * 360.0) ** 0.5, 100.0],
+            self.class_vs30s, self.class_factors)
+
+        self.assertTrue(numpy.allclose([[1.0, 1.0, 1.0], [2.0, 1.5, 1.0],
+            [1.5, 1.25, 1.0], [2.0, 1.5, 1.0]], factors))
+
+    def test_unit_factors_leave_the_curves_unchanged(self):
+        self.assertTrue(numpy.allclose(self.poes,
+            site_amplification.amplify_curves(
+                self.imls, self.poes, numpy.ones((2, 3)))))
+
+    def test_rock_levels_are_moved_to_the_amplified_levels(self):
+        site_poes = site_amplification.amplify_curves(
+            self.imls, self.poes, 10.0 * numpy.ones((2, 3)))
+
+        self.assertTrue(numpy.allclose([[0.9, 0.9, 0.3], [0.5, 0.5, 0.1]],
+                                       site_poes))
+
+    def test_hazard_map_interpolates_in_log_log_space(self):
+        imls = site_amplification.hazard_map(self.imls, self.poes, 0.3)
+
+        self.assertAlmostEqual(0.1, imls[0])
+        self.assertTrue(0.01 < imls[1] < 0.1)
+
+
+class InterpolationTestCase(unittest.TestCase):
+    """Tests the interpolation of hazard curves from a coarse grid."""
+
+    def setUp(self):
+        self.grid = interpolation.CoarseGrid(shapes.Site(10.0, 40.0), 0.5)
+
+    def test_weights_at_the_center_of_a_cell(self):
+        columns, rows, weights = self.grid.cells([shapes.Site(10.75, 40.25)])
+
+        self.assertEqual([1], list(columns))
+        self.assertEqual([0], list(rows))
+        self.assertTrue(numpy.allclose([[0.25, 0.25, 0.25, 0.25]], weights))
+
+    def test_a_site_on_a_node_only_needs_that_node(self):
+        self.assertEqual([shapes.Site(11.0, 40.5)],
+                         self.grid.nodes_for([shapes.Site(11.0, 40.5)]))
+
+    def test_nodes_are_unique_and_sorted_by_row(self):
+        nodes = self.grid.nodes_for([shapes.Site(10.25, 40.0),
+                                     shapes.Site(10.5, 40.25),
+                                     shapes.Site(10.0, 40.0)])
+
+        self.assertEqual([shapes.Site(10.0, 40.0), shapes.Site(10.5, 40.0),
+                          shapes.Site(10.5, 40.5)], nodes)
+
+    def test_curves_are_interpolated_in_log_poe(self):
+        corner_poes = [[[0.1, 0.01], [0.4, 0.04], [0.1, 0.0], [0.4, 0.04]]]
+
+        poes = interpolation.interpolate_curves(
+            corner_poes, [[0.25, 0.25, 0.25, 0.25]])
+        self.assertTrue(numpy.allclose([[0.2, 0.0]], poes))
+
+        # a null curve with a null weight is not used
+        poes = interpolation.interpolate_curves(
+            corner_poes, [[0.5, 0.5, 0.0, 0.0]])
+        self.assertTrue(numpy.allclose([[0.2, 0.02]], poes))
+
+
+class FakeHazardCurveTask(object):
+    """A completed hazard curve task."""
+
+    def __init__(self, result):
+        self.status = 'SUCCESS'
+        self.result = result
+
+    def wait(self):
+        pass
+
+
+class FakeComputeHazardCurve(object):
+    """Stores the hazard curves of a realization (the realization number
+    as the PoE, for all the intensity measure types) instead of computing
+    them, and records the realizations dispatched."""
+
+    def __init__(self, mixin):
+        self.mixin = mixin
+        self.dispatched = []
+
+    def delay(self, job_id, site_list, realization):
+        self.dispatched.append(realization)
+        for imt in (None, "SA-1.0"):
+            for key in self.mixin.hazard_curve_keys(
+                site_list, realization, imt):
+                kvs.set_value_json_encoded(
+                    key, {"curve": [{"x": 0.1, "y": realization}]})
+        return FakeHazardCurveTask(
+            self.mixin.hazard_curve_keys(site_list, realization))
+
+
+class FakeClassicalMixin(opensha.ClassicalMixin):
+    """Samples the given logic tree paths, one per realization."""
+
+    def __init__(self, params, paths):
+        self.id = 1234
+        self.params = params
+        self.paths = list(paths)
+
+    def random_seed(self, name):
+        return 42
+
+    def store_source_model(self, seed, key=None):
+        return self.paths[0][0]
+
+    def store_gmpe_map(self, seed, key=None):
+        return self.paths.pop(0)[1]
+
+    def write_realization_hazardcurve_files(self, site_list, realization,
+                                            curve_keys):
+        pass
+
+
+class RepeatedLogicTreePathsTestCase(unittest.TestCase):
+    """Tests that the hazard curves of a logic tree path sampled again
+    are copied instead of being computed again."""
+
+    def setUp(self):
+        kvs.flush()
+
+        self.sites = [shapes.Site(10.0, 40.0), shapes.Site(10.1, 40.0)]
+        self.mixin = FakeClassicalMixin(
+            {"NUMBER_OF_LOGIC_TREE_SAMPLES": "3",
+             "INTENSITY_MEASURE_TYPE": "PGA", "PERIOD": "0.0",
+             "INTENSITY_MEASURE_LEVELS": "0.1, 0.2",
+             "ADDITIONAL_INTENSITY_MEASURE_TYPES": "SA 1.0: 0.1, 0.2"},
+            [("source model A", "gmpe A"), ("source model B", "gmpe A"),
+             ("source model A", "gmpe A")])
+
+        self.compute_hazard_curve = tasks.compute_hazard_curve
+        tasks.compute_hazard_curve = FakeComputeHazardCurve(self.mixin)
+
+    def tearDown(self):
+        tasks.compute_hazard_curve = self.compute_hazard_curve
+
+    def test_repeated_paths_are_not_computed_again(self):
+        keys = self.mixin.execute_sampled(self.sites)
+
+        self.assertEqual([0, 1], tasks.compute_hazard_curve.dispatched)
+        self.assertEqual(self.mixin.hazard_curve_keys(self.sites, 2),
+                         keys[-2:])
+
+        for imt in (None, "SA-1.0"):
+            for (key, copied_key) in zip(
+                self.mixin.hazard_curve_keys(self.sites, 0, imt),
+                self.mixin.hazard_curve_keys(self.sites, 2, imt)):
+                self.assertEqual(kvs.get_value_json_decoded(key),
+                                 kvs.get_value_json_decoded(copied_key))
+
+
+class FakeGMFTask(object):
+    """A completed ground motion fields task."""
+
+    def __init__(self, status='SUCCESS', result=None):
+        self.status = status
+        self.result = result
+
+    def ready(self):
+        return True
+
+
+class FakeGMFTasks(opensha.GMFTasks):
+    """Records the tasks dispatched instead of running them."""
+
+    def __init__(self, *args):
+        super(FakeGMFTasks, self).__init__(*args)
+        self.dispatched = []
+        self.max_seen_in_flight = 0
+
+    def _dispatch(self, entry):
+        self.dispatched.append(entry)
+        self.max_seen_in_flight = max(self.max_seen_in_flight,
+                                      len(self.in_flight) + 1)
+        return FakeGMFTask()
+
+    def dispatch_event_set(self, stochastic_set_id, seed):
+        return self._dispatch((stochastic_set_id, None))
+
+    def dispatch_block(self, stochastic_set_id, block_index):
+        return self._dispatch((stochastic_set_id, block_index))
+
+
+class GMFTasksTestCase(unittest.TestCase):
+    """Tests the scheduling of the event based tasks."""
+
+    def setUp(self):
+        sites = [shapes.Site(10.0, 40.0), shapes.Site(10.1, 40.0),
+                 shapes.Site(10.2, 40.0)]
+        self.gmf_tasks = FakeGMFTasks("job", [sites[:2], sites[2:]], 2, 42)
+
+    def test_blocks_are_dispatched_after_the_event_set(self):
+        self.gmf_tasks.add("0!0", 42)
+        self.gmf_tasks.add("0!1", 43)
+        self.assertTrue(self.gmf_tasks.full())
+
+        completed = []
+        while self.gmf_tasks.pending():
+            completed.extend(self.gmf_tasks.wait())
+
+        self.assertEqual([("0!0", None), ("0!1", None), ("0!0", 0),
+                          ("0!0", 1), ("0!1", 0), ("0!1", 1)],
+                         self.gmf_tasks.dispatched)
+        self.assertEqual(["0!0", "0!1"], completed)
+        self.assertEqual(2, self.gmf_tasks.max_seen_in_flight)
+
+    def test_at_least_one_task_must_be_in_flight(self):
+        self.assertRaises(ValueError, FakeGMFTasks, "job", [], 0, 42)
+        self.assertRaises(ValueError, FakeGMFTasks, "job", [], -1, 42)
+
+    def test_failed_tasks_stop_the_job(self):
+        self.gmf_tasks.in_flight.append(
+            ("0!0", None, FakeGMFTask('FAILURE', "boom")))
+        self.assertRaises(Exception, self.gmf_tasks.wait)
+
+    def test_residuals_do_not_depend_on_the_blocks(self):
+        residuals = gmf.residuals(42, "0!0", 3, 0, 5, 3.0, "2 Sided")
+
+        self.assertTrue(numpy.allclose(residuals, numpy.concatenate([
+            gmf.residuals(42, "0!0", 3, 0, 2, 3.0, "2 Sided"),
+            gmf.residuals(42, "0!0", 3, 2, 3, 3.0, "2 Sided")])))
+        self.assertFalse(numpy.allclose(residuals,
+            gmf.residuals(42, "0!0", 4, 0, 5, 3.0, "2 Sided")))
+        self.assertTrue((numpy.abs(residuals) <= 3.0).all())
+
+    def test_ground_motion_fields(self):
+        statistics = [[[1.0, 0.5, 0.2], [2.0, 0.0, 0.4]]]
+        fields = gmf.ground_motion_fields(statistics, [2.0],
+                                          [[1.0, -1.0]])
+
+        self.assertTrue(numpy.allclose([[2.2, 1.6]], fields))
+
+    def test_correlation_decreases_with_distance(self):
+        sites = [shapes.Site(10.0, 40.0), shapes.Site(10.1, 40.0),
+                 shapes.Site(11.0, 40.0)]
+        factor = gmf.correlation_factor(sites, 0.0)
+        correlation = numpy.dot(factor, factor.T)
+
+        self.assertTrue(numpy.allclose(1.0, numpy.diag(correlation)))
+        self.assertTrue(correlation[0, 1] > correlation[0, 2] > 0.0)
+
+
+class FakeEventBasedMixin(opensha.EventBasedMixin):
+    """Only holds the parameters of a job."""
+
+    def __init__(self, params):
+        self.params = params
+
+
+class CorrelationFactorTestCase(unittest.TestCase):
+    """Tests the cache of the correlation factors of the blocks."""
+
+    def setUp(self):
+        opensha.CORRELATION_FACTOR_CACHE.clear()
+        self.sites = [shapes.Site(10.0, 40.0), shapes.Site(10.1, 40.0)]
+        self.mixin = FakeEventBasedMixin(
+            {'INTENSITY_MEASURE_TYPE': 'PGA', 'PERIOD': '0.0'})
+
+    def test_factors_are_computed_once_per_block(self):
+        factor = self.mixin.correlation_factor(self.sites)
+
+        self.assertTrue(factor is self.mixin.correlation_factor(
+            [shapes.Site(10.0, 40.0), shapes.Site(10.1, 40.0)]))
+        self.assertFalse(factor is self.mixin.correlation_factor(
+            self.sites[:1]))
+
+    def test_factors_depend_on_the_period(self):
+        factor = self.mixin.correlation_factor(self.sites)
+        self.mixin.params = {'INTENSITY_MEASURE_TYPE': 'SA', 'PERIOD': '1.0'}
+
+        self.assertTrue(
+            self.mixin.correlation_factor(self.sites)[1, 0] > factor[1, 0])
+
+
+class SiteStatisticsTestCase(unittest.TestCase):
+    """Tests the online statistics of the GMFs at the sites."""
+
+    def setUp(self):
+        self.statistics = gmf.SiteStatistics(2, [0.05, 0.2])
+        self.statistics.update(numpy.log([[0.1, 0.01], [0.3, 0.02]]))
+        self.statistics.update(numpy.log([[0.2, 0.04]]))
+        self.statistics.update(numpy.zeros((0, 2)))
+
+    def test_maximum_mean_and_exceedances(self):
+        self.assertEqual(3, self.statistics.count)
+        self.assertTrue(numpy.allclose([0.3, 0.04], self.statistics.maximum))
+        self.assertTrue(numpy.allclose([0.2, 0.07 / 3],
+                                       self.statistics.mean()))
+        self.assertEqual([[3, 1], [0, 0]],
+                         self.statistics.exceedances.tolist())
+
+    def test_percentiles_are_bin_upper_edges(self):
+        median = self.statistics.percentile(0.5)
+        step = 10 ** (1.0 / gmf.SiteStatistics.PERCENTILE_BINS_PER_DECADE)
+
+        self.assertTrue(0.2 <= median[0] < 0.2 * step)
+        self.assertTrue(0.02 <= median[1] < 0.02 * step)
+        self.assertTrue(0.3 <= self.statistics.percentile(1.0)[0] < 0.3 * step)
+
+
+class GMFStorageTestCase(unittest.TestCase):
+    """Tests the dense storage of the ground motion fields."""
+
+    def setUp(self):
+        self.job_id = "gmf_storage_test"
+        kvs.set_value_json_encoded(kvs.generate_product_key(self.job_id,
+            kvs.tokens.STOCHASTIC_SET_RUPTURES_TOKEN, "0!1"),
+            [[0, 1, 0.5], [0, 1, -0.5], [2, 3, 0.0]])
+
+    def test_blocks_fill_the_arrays_of_the_ruptures(self):
+        gmf.store_block(self.job_id, "0!1", 0, [[1.0, 2.0]] * 3)
+        gmf.store_block(self.job_id, "0!1", 2,
+                        [[3.0], [4.0], [5.0]])
+
+        self.assertEqual(3, gmf.ruptures_count(self.job_id, "0!1"))
+        self.assertTrue(numpy.allclose([1.0, 2.0, 4.0],
+                                       gmf.load_rupture(self.job_id, "0!1", 1)))
+        self.assertTrue(numpy.allclose([[1.0, 2.0, 3.0], [1.0, 2.0, 5.0]],
+            gmf.load_ruptures(self.job_id, "0!1", [0, 2])))
+        self.assertEqual((3, 3),
+                         gmf.load_stochastic_set(self.job_id, "0!1").shape)
+
+    def test_stochastic_sets_are_transposed_by_site(self):
+        kvs.set_value_json_encoded(kvs.generate_product_key(self.job_id,
+            kvs.tokens.STOCHASTIC_SET_RUPTURES_TOKEN, "0!0"),
+            [[0, 1, 0.5], [0, 1, -0.5]])
+        gmf.store_block(self.job_id, "0!0", 0, [[6.0, 7.0], [8.0, 9.0]])
+        gmf.store_block(self.job_id, "0!1", 0,
+                        [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+
+        offsets = gmf.stochastic_set_offsets(self.job_id, ["0!0", "0!1"])
+        self.assertEqual([0, 2], offsets)
+
+        # event sets can be transposed in any order
+        gmf.transpose_stochastic_set(self.job_id, "0!1", offsets[1])
+        gmf.transpose_stochastic_set(self.job_id, "0!0", offsets[0])
+
+        (first, second) = gmf.load_site_gmfs(self.job_id, [0, 1])
+        self.assertTrue(numpy.allclose([6.0, 8.0, 1.0, 3.0, 5.0], first))
+        self.assertTrue(numpy.allclose([7.0, 9.0, 2.0, 4.0, 6.0], second))
+
+    def test_sites_are_stored_in_order(self):
+        sites = [shapes.Site(10.1, 40.0), shapes.Site(10.0, 40.0)]
+        gmf.store_sites(self.job_id, sites)
+
+        self.assertEqual(sites, gmf.load_sites(self.job_id))
+
+    def test_hazard_curves_from_gmfs(self):
+        gmfs = numpy.log([[0.1, 0.5], [0.3, 0.05], [0.2, 0.01]])
+        counts = gmf.exceedance_counts(gmfs, [0.02, 0.15, 0.4])
+
+        self.assertEqual([[3, 2, 0], [2, 1, 1]], counts.tolist())
+
+        poes = gmf.probabilities_of_exceedance(counts, 100.0, 50.0)
+        self.assertTrue(numpy.allclose(1.0 - numpy.exp(-1.5), poes[0, 0]))
+        self.assertEqual(0.0, poes[0, 2])
+        self.assertRaises(ValueError,
+                          gmf.probabilities_of_exceedance, counts, 0.0, 50.0)
@@ -28,6 +28,8 @@ from openquake import shapes
 from utils import test
 from openquake import job
 from openquake import flags
+from openquake import kvs
+from openquake.job import checkpoint
 from openquake.job import Job, EXPOSURE, INPUT_REGION, LOG
 from openquake.job.mixins import Mixin
 from openquake.risk.job import RiskJobMixin
@@ -141,6 +143,61 @@ class JobTestCase(unittest.TestCase):
         self.generated_files.append(self.job.super_config_path)
         self.assertEqual(self.job, Job.from_kvs(self.job.id))
 
+    def test_a_stored_job_can_be_resumed(self):
+        self.job = Job.from_file(os.path.join(test.DATA_DIR, CONFIG_FILE))
+        self.generated_files.append(self.job.super_config_path)
+
+        resumed = Job.for_resume(self.job.id)
+        self.assertEqual(self.job, resumed)
+        self.assertEqual(sorted(self.job.sections), sorted(resumed.sections))
+        self.assertEqual(self.job.base_path, resumed.base_path)
+
+    def test_an_unknown_job_cannot_be_resumed(self):
+        self.assertEqual(None, Job.for_resume("unknown-job"))
+
+    def test_drawn_random_seeds_are_stored_with_the_job(self):
+        a_job = Job({"GMF_RANDOM_SEED": "37"})
+
+        self.assertEqual("37", a_job.random_seed("GMF_RANDOM_SEED"))
+
+        seed = a_job.random_seed("GMPE_LT_RANDOM_SEED")
+        self.assertEqual(seed, a_job.random_seed("GMPE_LT_RANDOM_SEED"))
+        self.assertEqual(seed, Job.from_kvs(a_job.id).random_seed(
+                "GMPE_LT_RANDOM_SEED"))
+
+    def test_a_classical_job_can_be_extended(self):
+        a_job = Job({"HAZARD_CALCULATION_MODE": "Classical",
+                     "NUMBER_OF_LOGIC_TREE_SAMPLES": "200",
+                     "SOURCE_MODEL_LT_RANDOM_SEED": "23",
+                     "GMPE_LT_RANDOM_SEED": "5"})
+        checkpoint.mark_done(a_job.id, checkpoint.HAZARD_STATISTICS)
+
+        a_job.add_realizations(300)
+
+        self.assertEqual("500", kvs.get_value_json_decoded(
+            kvs.generate_job_key(a_job.id))["NUMBER_OF_LOGIC_TREE_SAMPLES"])
+        self.assertFalse(checkpoint.is_done(
+            a_job.id, checkpoint.HAZARD_STATISTICS))
+
+    def test_only_sampled_classical_jobs_can_be_extended(self):
+        a_job = Job({"HAZARD_CALCULATION_MODE": "Event Based",
+                     "NUMBER_OF_LOGIC_TREE_SAMPLES": "200"})
+        self.assertRaises(ValueError, a_job.add_realizations, 300)
+
+        a_job.params.update({"HAZARD_CALCULATION_MODE": "Classical",
+                             "ENUMERATE_LOGIC_TREES": "true"})
+        self.assertRaises(ValueError, a_job.add_realizations, 300)
+
+    def test_only_seeded_classical_jobs_can_be_extended(self):
+        a_job = Job({"HAZARD_CALCULATION_MODE": "Classical",
+                     "NUMBER_OF_LOGIC_TREE_SAMPLES": "200",
+                     "SOURCE_MODEL_LT_RANDOM_SEED": "23"})
+        self.assertRaises(ValueError, a_job.add_realizations, 300)
+
+        a_job.random_seed("GMPE_LT_RANDOM_SEED")
+        a_job.add_realizations(300)
+        self.assertEqual("500", a_job.params["NUMBER_OF_LOGIC_TREE_SAMPLES"])
+
     def test_prepares_blocks_using_the_exposure(self):
         a_job = Job({EXPOSURE: os.path.join(test.SCHEMA_EXAMPLES_DIR,
                                             EXPOSURE_TEST_FILE)})
@@ -168,6 +225,53 @@ class JobTestCase(unittest.TestCase):
         self.assertEqual(1, len(blocks_keys))
         self.assertEqual(expected_block, job.Block.from_kvs(blocks_keys[0]))
 
+    def test_hazard_sites_are_the_grid_nodes_of_the_exposure(self):
+        a_job = Job({EXPOSURE: os.path.join(test.SCHEMA_EXAMPLES_DIR,
+                                            EXPOSURE_TEST_FILE),
+                     "REGION_VERTEX": "45.3, 9.0, 45.3, 9.3, 45.0, 9.3, "
+                                      "45.0, 9.0",
+                     "REGION_GRID_SPACING": "0.05",
+                     "HAZARD_SITES_FROM_EXPOSURE": "true"})
+
+        # the three exposure sites fall in three different cells
+        self.assertEqual([shapes.Site(9.15, 45.10), shapes.Site(9.15, 45.15),
+                          shapes.Site(9.15, 45.20)],
+                         a_job.sites_to_compute())
+
+        a_job.params["HAZARD_SITES_BUFFER"] = "1"
+        self.assertEqual(15, len(a_job.sites_to_compute()))
+
+        a_job.params["HAZARD_SITES_FROM_EXPOSURE"] = "false"
+        self.assertEqual(a_job.sites_for_region(), a_job.sites_to_compute())
+
+    def test_storing_the_exposure_again_does_not_duplicate_assets(self):
+        a_job = Job({EXPOSURE: EXPOSURE_TEST_FILE,
+                     "RISK_CALCULATION_MODE": "Probabilistic Event",
+                     "REGION_VERTEX": "45.3, 9.0, 45.3, 9.3, 45.0, 9.3, "
+                                      "45.0, 9.0",
+                     "REGION_GRID_SPACING": "0.05"},
+                    base_path=test.SCHEMA_EXAMPLES_DIR)
+        self.generated_files.append(a_job.super_config_path)
+
+        def asset_list_lengths():
+            lengths = []
+            for site in a_job.sites_to_compute():
+                point = a_job.region.grid.point_at(site)
+                lengths.append(len(kvs.get_client().lrange(
+                    kvs.tokens.asset_key(a_job.id, point.row, point.column),
+                    0, -1)))
+            return lengths
+
+        with Mixin(a_job, RiskJobMixin, key="risk"):
+            a_job.store_exposure_assets()
+            lengths = asset_list_lengths()
+
+            # e.g. the job is resumed before the exposure checkpoint
+            a_job.store_exposure_assets()
+
+        self.assertTrue(sum(lengths) > 0)
+        self.assertEqual(lengths, asset_list_lengths())
+
     @test.skipit
     def test_prepares_blocks_using_the_input_region(self):
         """ This test might be currently catastrophically retarded. If it is
@@ -289,3 +393,51 @@ class BlockSplitterTestCase(unittest.TestCase):
             counter += 1
 
         self.assertEqual(number, counter)
+
+
+class CheckpointTestCase(unittest.TestCase):
+    """Tests the ledger of the work units completed by a job."""
+
+    def setUp(self):
+        self.job_id = kvs.generate_random_id()
+
+    def tearDown(self):
+        kvs.get_client(binary=False).delete(
+            kvs.tokens.checkpoint_key(self.job_id))
+
+    def test_a_unit_is_not_done_until_marked(self):
+        self.assertFalse(checkpoint.is_done(
+            self.job_id, checkpoint.HAZARD_CURVES, 3))
+
+        checkpoint.mark_done(self.job_id, checkpoint.HAZARD_CURVES, 3)
+
+        self.assertTrue(checkpoint.is_done(
+            self.job_id, checkpoint.HAZARD_CURVES, 3))
+        self.assertEqual(1, checkpoint.done_units(self.job_id))
+
+    def test_units_are_identified_by_stage_realization_and_block(self):
+        checkpoint.mark_done(self.job_id, checkpoint.RISK, block_id="BLOCK!1")
+
+        self.assertTrue(checkpoint.is_done(
+            self.job_id, checkpoint.RISK, block_id="BLOCK!1"))
+        self.assertFalse(checkpoint.is_done(
+            self.job_id, checkpoint.RISK, block_id="BLOCK!2"))
+        self.assertFalse(checkpoint.is_done(
+            self.job_id, checkpoint.HAZARD_CURVES, block_id="BLOCK!1"))
+
+    def test_the_units_of_a_stage_can_be_forgotten(self):
+        checkpoint.mark_done(self.job_id, checkpoint.HAZARD_CURVES, 0)
+        checkpoint.mark_done(self.job_id, checkpoint.RISK, block_id="BLOCK!1")
+        checkpoint.mark_done(self.job_id, checkpoint.RISK, block_id="BLOCK!2")
+
+        checkpoint.forget(self.job_id, checkpoint.RISK)
+
+        self.assertEqual(1, checkpoint.done_units(self.job_id))
+        self.assertTrue(checkpoint.is_done(
+            self.job_id, checkpoint.HAZARD_CURVES, 0))
+
+    def test_marking_a_unit_twice_counts_once(self):
+        checkpoint.mark_done(self.job_id, checkpoint.HAZARD_STATISTICS)
+        checkpoint.mark_done(self.job_id, checkpoint.HAZARD_STATISTICS)
+
+        self.assertEqual(1, checkpoint.done_units(self.job_id))
@@ -70,6 +70,7 @@ GEOTIFF_FILENAME_MULTISEGMENT_COLORSCALE = "test.colorscale-multisegment.tiff"
 GEOTIFF_FILENAME_DISCRETE_COLORSCALE = "test.colorscale-discrete.tiff"
 GEOTIFF_FILENAME_DISCRETE_CUSTOMBIN_COLORSCALE = \
     "test.colorscale-discrete-custombins.tiff"
+GEOTIFF_FILENAME_GMF_SET = "test.gmf-set.tiff"
 
 HAZARDCURVE_PLOT_SIMPLE_FILENAME = "hazard-curves-simple.svg"
 
@@ -447,6 +448,27 @@ class OutputTestCase(unittest.TestCase):
         self._assert_geotiff_metadata_and_raster_is_correct(path,
             asymmetric_region, GEOTIFF_USED_CHANNEL_IDX, reference_raster)
 
+    def test_geotiff_generation_gmf_set(self):
+        """Create a GeoTIFF with a band per ground motion field, and check
+        that each band has the values of its field."""
+        path = test.do_test_output_file(GEOTIFF_FILENAME_GMF_SET)
+        squareregion = shapes.Region.from_coordinates(TEST_REGION_SQUARE)
+        gwriter = geotiff.GMFSetGeoTiffFile(path, squareregion.grid, 2)
+
+        gwriter.write_band(1, [(0, 0), (1, 2)], [0.5, 0.25])
+        gwriter.write_band(2, [(0, 0), (1, 2)], [0.1, 0.75])
+        gwriter.close()
+
+        dataset = gdal.Open(path, gdalconst.GA_ReadOnly)
+        self.assertEqual(2, dataset.RasterCount)
+
+        reference_raster = numpy.zeros((squareregion.grid.rows,
+                                        squareregion.grid.columns),
+                                       dtype=numpy.float)
+        reference_raster[0, 0] = 0.1
+        reference_raster[1, 2] = 0.75
+        self._assert_geotiff_raster_is_correct(path, 2, reference_raster)
+
     @test.skipit
     def test_geotiff_output(self):
         """Generate a geotiff file with a smiley face."""
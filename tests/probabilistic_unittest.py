@@ -20,10 +20,13 @@
 
 
 
+import numpy
 import os
 import unittest
 
 from openquake import shapes
+from openquake.job import Job
+from openquake.job.mixins import Mixin
 from openquake.risk.job.probabilistic import ProbabilisticEventMixin
 from openquake.risk import probabilistic_event_based as prob
 from openquake.parser import exposure
@@ -67,7 +70,7 @@ class EpsilonTestCase(unittest.TestCase):
         roughly equivalent.
         """
         samples = dict()
-        self.mixin.__dict__["ASSET_CORRELATION"] = "perfect"
+        self.mixin.params = {"ASSET_CORRELATION": "perfect"}
         for _, asset in self.exposure_parser:
             sample = self.mixin.epsilon(asset)
             category = asset["structureCategory"]
@@ -86,20 +89,85 @@ class EpsilonTestCase(unittest.TestCase):
                 isinstance(sample, float),
                 "Invalid sample (%s) for category %s" % (sample, category))
 
+    def test_samples_do_not_depend_on_the_instance(self):
+        """The samples of an asset are the same in any task."""
+        assets = [asset for _, asset in self.exposure_parser]
+        other_mixin = ProbabilisticEventMixin()
+
+        samples = [self.mixin.epsilon(asset) for asset in assets]
+        samples.append(self.mixin.epsilon(assets[0]))
+        for asset in reversed(assets):
+            other_mixin.epsilon(asset)
+
+        self.assertEqual(samples[-1], other_mixin.epsilon(assets[0]))
+        self.assertNotEqual(samples[0], samples[-1])
+
+    def test_matrix_rows_are_the_samples_of_the_assets(self):
+        """A row of the epsilon matrix has the samples of an asset, and
+        perfectly correlated assets of the same typology share a row."""
+        assets = [asset for _, asset in self.exposure_parser]
+        other_mixin = ProbabilisticEventMixin()
+
+        matrix = self.mixin.epsilon_matrix(assets, 3)
+        self.assertEqual((len(assets), 3), matrix.shape)
+        for asset, row in zip(assets, matrix):
+            self.assertEqual(row.tolist(),
+                             other_mixin.epsilons_for(asset, 3).tolist())
+
+        self.mixin.params = {"ASSET_CORRELATION": "perfect"}
+        matrix = self.mixin.epsilon_matrix(assets, 3)
+        for asset, row in zip(assets, matrix):
+            self.assertEqual([self.mixin.epsilon(asset)] * 3, row.tolist())
+
+    def test_partially_correlated(self):
+        """With a partial correlation, the samples of an asset mix the
+        sample of its typology and its own samples."""
+        assets = [asset for _, asset in self.exposure_parser][:2]
+        uncorrelated = ProbabilisticEventMixin().epsilon_matrix(assets, 4)
+        correlated = ProbabilisticEventMixin()
+        correlated.params = {"ASSET_CORRELATION": "perfect"}
+        correlated = correlated.epsilon_matrix(assets, 4)
+
+        self.mixin.params = {"ASSET_CORRELATION": "0.36"}
+        matrix = self.mixin.epsilon_matrix(assets, 4)
+
+        self.assertTrue(numpy.allclose(
+            0.6 * correlated + 0.8 * uncorrelated, matrix))
+
+        self.mixin.params = {"ASSET_CORRELATION": "1.5"}
+        self.assertRaises(ValueError, self.mixin.epsilon_matrix, assets, 4)
+
+    def test_correlation_is_read_from_the_job_configuration(self):
+        """The asset correlation is taken from the parameters of the job,
+        "none" meaning uncorrelated samples."""
+        assets = [asset for _, asset in self.exposure_parser]
+        uncorrelated = ProbabilisticEventMixin().epsilon_matrix(assets, 2)
+
+        a_job = Job({"ASSET_CORRELATION": "none"})
+        with Mixin(a_job, ProbabilisticEventMixin):
+            self.assertEqual(uncorrelated.tolist(),
+                             a_job.epsilon_matrix(assets, 2).tolist())
+
+        a_job = Job({"ASSET_CORRELATION": "perfect"})
+        with Mixin(a_job, ProbabilisticEventMixin):
+            for asset, row in zip(assets, a_job.epsilon_matrix(assets, 2)):
+                self.assertEqual(row[0], row[1])
+                self.assertEqual(a_job.epsilon(asset), row[0])
+
     def test_incorrect_configuration_setting(self):
         """The correctness of the asset correlation configuration is enforced.
 
         If the `ASSET_CORRELATION` parameter is set in the job configuration
         file it should have a correct value ("perfect").
         """
-        self.mixin.__dict__["ASSET_CORRELATION"] = "this-is-wrong"
+        self.mixin.params = {"ASSET_CORRELATION": "this-is-wrong"}
         for _, asset in self.exposure_parser:
             self.assertRaises(ValueError, self.mixin.epsilon, asset)
             break
 
     def test_correlated_with_no_structure_category(self):
         """For correlated jobs assets require a structure category property."""
-        self.mixin.__dict__["ASSET_CORRELATION"] = "perfect"
+        self.mixin.params = {"ASSET_CORRELATION": "perfect"}
         for _, asset in self.exposure_parser:
             del asset["structureCategory"]
             e = self.assertRaises(ValueError, self.mixin.epsilon, asset)
@@ -23,6 +23,7 @@
 This is a basic set of tests for risk engine.
 """
 
+import math
 import os
 import json
 import numpy
@@ -35,6 +36,7 @@ from utils import test
 
 from openquake.risk.job import aggregate_loss_curve as aggregate
 from openquake.risk.job.classical_psha import ClassicalPSHABasedMixin
+from openquake.risk.job.probabilistic import ProbabilisticEventMixin
 from openquake.risk import probabilistic_event_based as prob
 from openquake.risk import classical_psha_based as psha
 from openquake.risk import common
@@ -308,6 +310,35 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
                 self.EpsilonProvider(expected_asset, epsilons),
                 expected_asset), atol=0.0001))
 
+    def test_epsilons_can_be_drawn_in_one_batch(self):
+        """Providers with an epsilons_for method give all the epsilons of
+        an asset at once, with the same loss ratios as one by one."""
+
+        class BatchEpsilonProvider(self.EpsilonProvider):
+
+            def epsilons_for(self, asset, count):
+                assert self.asset is asset
+                (batch, self.epsilons) = (self.epsilons[:count],
+                        self.epsilons[count:])
+                return batch
+
+        vuln_function = shapes.VulnerabilityFunction([
+                (0.10, (0.00, 0.30)),
+                (0.30, (0.10, 0.30)),
+                (1.00, (0.30, 0.20))])
+
+        epsilons = [0.5377, 1.8339, -2.2588]
+        expected_asset = object()
+        gmfs = {"IMLs": (0.1000, 0.9706, 0.2000, 0.4854)}
+
+        self.assertTrue(numpy.array_equal(
+                prob._compute_loss_ratios(vuln_function, gmfs,
+                self.EpsilonProvider(expected_asset, list(epsilons)),
+                expected_asset),
+                prob._compute_loss_ratios(vuln_function, gmfs,
+                BatchEpsilonProvider(expected_asset, list(epsilons)),
+                expected_asset)))
+
     def test_when_the_mean_is_zero_the_loss_ratio_is_zero(self):
         """In sampled based, when an interpolated mean loss ratio is zero,
         the resulting loss ratio is also zero.
@@ -572,6 +603,71 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
         self.assertEqual(expected_curve, prob.compute_loss_ratio_curve(
                 self.vuln_function_1, gmfs, None, None))
 
+    def test_loss_ratio_curves_of_assets_computed_together(self):
+        """The loss ratio curves of assets sharing a vulnerability function
+        are the same as when they are computed one by one."""
+
+        vuln_function = shapes.VulnerabilityFunction([
+                (0.10, (0.05, 0.30)),
+                (0.30, (0.10, 0.30)),
+                (0.50, (0.15, 0.20)),
+                (1.00, (0.30, 0.20))])
+
+        assets = [{"assetID": "a1"}, {"assetID": "a2"}, {"assetID": "a3"}]
+        gmfs = {"IMLs": (0.1576, 0.9706, 0.9572, 0.4854, 0.8003,
+                0.1419, 0.4218, 0.9157, 0.7922, 0.9595),
+                "TSES": 900, "TimeSpan": 50}
+
+        curves = prob.compute_loss_ratio_curves(vuln_function, gmfs,
+                ProbabilisticEventMixin(), assets)
+
+        provider = ProbabilisticEventMixin()
+        for asset, curve in zip(assets, curves):
+            self.assertEqual(prob.compute_loss_ratio_curve(
+                    vuln_function, gmfs, provider, asset), curve)
+
+        self.assertNotEqual(curves[0], curves[1])
+
+    def test_loss_ratio_curves_of_a_matrix_of_loss_ratios(self):
+        """Each row of the curves computed for an (assets x events) matrix
+        of loss ratios is the curve of the asset, as computed with
+        numpy.histogram."""
+
+        loss_ratios = numpy.array([
+                [0.0, 0.0, 0.0, 0.0],
+                [0.1, 0.4, 0.0, 0.2],
+                [0.3, 0.3, 0.3, 0.3],
+                [0.0113, 0.2417, 0.0852, 0.5326]])
+
+        losses, poes = prob._compute_loss_ratio_curves_matrix(
+                loss_ratios, 900, 50, 6)
+
+        self.assertEqual((4, 5), losses.shape)
+        self.assertEqual((4, 5), poes.shape)
+
+        for asset_loss_ratios, asset_losses, asset_poes in zip(
+                loss_ratios, losses, poes):
+            loss_ratios_range = numpy.linspace(asset_loss_ratios.min(),
+                    asset_loss_ratios.max(), 6)
+
+            if (asset_loss_ratios <= 0.0).all():
+                cum_histogram = numpy.zeros(5)
+            else:
+                cum_histogram = numpy.histogram(asset_loss_ratios,
+                        bins=loss_ratios_range)[0][::-1].cumsum()[::-1]
+                cum_histogram[0] -= (asset_loss_ratios <= 0.0).sum()
+
+            self.assertEqual([1 - math.exp(-count / 900.0 * 50)
+                    for count in cum_histogram], asset_poes.tolist())
+            self.assertEqual([numpy.mean(loss_ratios_range[i:i + 2])
+                    for i in range(5)], asset_losses.tolist())
+
+        self.assertEqual([0.0] * 5, poes[0].tolist())
+        self.assertEqual([3, 3, 2, 1, 1], prob._compute_cumulative_histogram(
+                loss_ratios[1], numpy.linspace(0.0, 0.4, 6)).tolist())
+        self.assertEqual([4, 4, 4, 4, 4], prob._compute_cumulative_histogram(
+                loss_ratios[2], [0.3] * 6).tolist())
+
     def test_an_empty_distribution_produces_an_empty_aggregate_curve(self):
         self.assertEqual(shapes.EMPTY_CURVE,
                 prob.AggregateLossCurve({}, None).compute())
@@ -654,27 +750,87 @@ class ProbabilisticEventBasedTestCase(unittest.TestCase):
                 aggregate_curve.append, {
                 "IMLs": (1.0, ), "TSES": 1, "TimeSpan": 1}, asset)
 
-    def test_creating_the_aggregate_curve_from_kvs_loads_the_vuln_model(self):
-        # we have just self.vuln_function_2 stored in kvs
-        aggregate_curve = prob.AggregateLossCurve.from_kvs(self.job_id, None)
+    def _store_point_losses(self, row, col, gmfs_and_assets):
+        point_curve = prob.AggregateLossCurve(
+                {"ID": self.vuln_function_2}, None)
+
+        for gmfs, asset in gmfs_and_assets:
+            point_curve.append(gmfs, asset)
+
+        kvs.set_value_json_encoded(
+                kvs.tokens.aggregate_losses_key(self.job_id, row, col),
+                {"losses": point_curve.losses.tolist(),
+                "TSES": gmfs["TSES"], "TimeSpan": gmfs["TimeSpan"]})
+
+    def test_creating_the_aggregate_curve_from_kvs_adds_the_points(self):
+        self._store_point_losses(1, 1, [(self.gmfs_1, self.asset_1)])
+        self._store_point_losses(1, 2, [(self.gmfs_2, self.asset_2)])
 
-        self.assertEqual(self.vuln_function_2,
-                aggregate_curve.vuln_model["ID"])
+        # points without assets have no losses stored
+        aggregate_curve = prob.AggregateLossCurve.from_kvs(
+                self.job_id, [(1, 1), (1, 2), (1, 3)])
 
-    def test_creating_the_aggregate_curve_from_kvs_gets_all_the_gmfs(self):
-        # we have 6 gmfs stored in kvs
-        aggregate_curve = prob.AggregateLossCurve.from_kvs(self.job_id, None)
-        self.assertEqual(6, len(aggregate_curve.distribution))
+        self.assertEqual(2, aggregate_curve.size)
+        self.assertEqual(0, prob.AggregateLossCurve.from_kvs(
+                self.job_id, []).size)
 
     def test_creating_the_aggregate_curve_from_kvs_gets_all_the_sites(self):
         expected_curve = shapes.Curve([(39.52702042, 0.99326205),
                 (106.20489077, 0.917915), (172.88276113, 0.77686984),
                 (239.56063147, 0.52763345), (306.23850182, 0.22119922)])
 
-        # result is correct, so we are getting the correct assets
-        aggregate_curve = prob.AggregateLossCurve.from_kvs(self.job_id, None)
+        self._store_point_losses(1, 1, [(self.gmfs_1, self.asset_1),
+                (self.gmfs_2, self.asset_2), (self.gmfs_3, self.asset_3)])
+        self._store_point_losses(1, 2, [(self.gmfs_4, self.asset_4),
+                (self.gmfs_5, self.asset_5), (self.gmfs_6, self.asset_6)])
+
+        # result is correct, so we are getting the losses of all the points
+        aggregate_curve = prob.AggregateLossCurve.from_kvs(
+                self.job_id, [(1, 1), (1, 2)])
         self.assertEqual(expected_curve, aggregate_curve.compute(6))
 
+    def test_a_cell_split_across_blocks_is_aggregated_once(self):
+        region = shapes.Region.from_simple((10.0, 10.3), (10.3, 10.0))
+        region.cell_size = 0.1
+
+        # the first two sites are in the same cell
+        sites = [shapes.Site(10.01, 10.01), shapes.Site(10.02, 10.02),
+                shapes.Site(10.21, 10.01)]
+
+        first_block = job.Block(sites[:1])
+        second_block = job.Block(sites[1:])
+        first_block.to_kvs()
+        second_block.to_kvs()
+
+        class FakeJob(object):
+            blocks_keys = [first_block.id, second_block.id]
+
+        FakeJob.region = region
+
+        points = aggregate._grid_points(FakeJob())
+        self.assertEqual(2, len(points))
+
+        for (row, col) in points:
+            self._store_point_losses(row, col,
+                    [(self.gmfs_1, self.asset_1)])
+
+        aggregate_curve = prob.AggregateLossCurve.from_kvs(
+                self.job_id, points)
+
+        self.assertEqual(2, aggregate_curve.size)
+        self.assertTrue(numpy.allclose(2 * prob._compute_loss_ratios(
+                self.vuln_function_2, self.gmfs_1, None, self.asset_1)
+                * self.asset_1["assetValue"], aggregate_curve.losses))
+
+    def test_losses_per_event_can_be_added(self):
+        aggregate_curve = prob.AggregateLossCurve({}, None)
+        aggregate_curve.append_losses([1.0, 2.0], 1, 1)
+        aggregate_curve.append_losses([3.0, 5.0], 1, 1)
+
+        self.assertEqual([4.0, 7.0], aggregate_curve.losses.tolist())
+        self.assertRaises(AssertionError,
+                aggregate_curve.append_losses, [1.0], 1, 1)
+
     def test_curve_to_plot_interface_translation(self):
         curve = shapes.Curve([(0.1, 1.0), (0.2, 2.0)])
 
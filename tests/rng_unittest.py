@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2011, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3
+# only, as published by the Free Software Foundation.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License version 3 for more details
+# (a copy is included in the LICENSE file that accompanied this code).
+#
+# You should have received a copy of the GNU Lesser General Public License
+# version 3 along with OpenQuake.  If not, see
+# <http://www.gnu.org/licenses/lgpl-3.0.txt> for a copy of the LGPLv3 License.
+
+
+
+
+import unittest
+import numpy
+
+from openquake import rng
+
+
+class PhiloxTestCase(unittest.TestCase):
+    """Tests the Philox4x32-10 block cipher with its known answers."""
+
+    def test_known_answers(self):
+        self.assertEqual(
+            [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8],
+            list(rng.philox([0, 0, 0, 0], [0, 0])[0]))
+        self.assertEqual(
+            [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd],
+            list(rng.philox([0xffffffff] * 4, [0xffffffff] * 2)[0]))
+        self.assertEqual(
+            [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1],
+            list(rng.philox(
+                [0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344],
+                [0xa4093822, 0x299f31d0])[0]))
+
+
+class StreamTestCase(unittest.TestCase):
+    """Tests the counter based random streams."""
+
+    def setUp(self):
+        self.stream = rng.Stream(42, "0!0", 7)
+
+    def test_numbers_only_depend_on_their_position(self):
+        self.assertEqual(list(self.stream.integers(8)[3:5]),
+                         list(self.stream.integers(2, 3)))
+        self.assertEqual(list(self.stream.integers(8)),
+                         list(rng.Stream(42, "0!0", 7).integers(8)))
+
+    def test_streams_are_different(self):
+        self.assertNotEqual(list(self.stream.integers(4)),
+                            list(rng.Stream(42, "0!0", 8).integers(4)))
+        self.assertNotEqual(list(self.stream.integers(4)),
+                            list(rng.Stream(43, "0!0", 7).integers(4)))
+
+    def test_normal_deviates(self):
+        deviates = self.stream.normal(10000)
+
+        self.assertTrue(abs(deviates.mean()) < 0.05)
+        self.assertTrue(abs(deviates.std() - 1.0) < 0.05)
+
+    def test_truncated_normal_deviates(self):
+        two_sided = self.stream.normal(10000, 0, 1.0, "2 Sided")
+        one_sided = self.stream.normal(10000, 0, 1.0, "1 Sided")
+
+        self.assertTrue((numpy.abs(two_sided) <= 1.0).all())
+        self.assertTrue((one_sided <= 1.0).all())
+        self.assertTrue((one_sided < -1.0).any())
+        self.assertTrue(numpy.allclose(self.stream.normal(10000),
+            self.stream.normal(10000, 0, 1.0, "None")))